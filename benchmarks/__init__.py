@@ -0,0 +1,10 @@
+# Description: Benchmarks for the hot paths of the bot. Run them from the repository root, e.g.
+# python -m benchmarks.eval_benchmark
+
+import os
+
+# settings.py requires these, benchmarks never talk to Discord so placeholders are enough
+os.environ.setdefault('DISCORD_TOKEN', 'benchmark')
+os.environ.setdefault('COMMAND_PREFIX', 'bench!')
+os.environ.setdefault('EMBED_COLOR', '0')
+os.environ.setdefault('FEEDBACK_CHANNEL_ID', '0')
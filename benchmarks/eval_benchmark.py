@@ -0,0 +1,95 @@
+# Description: Micro-benchmark of helper.eval.safe_eval against the previous ast.parse based evaluator.
+# Usage: python -m benchmarks.eval_benchmark [--number 20000] [--no-cache]
+
+import argparse
+import ast
+import math
+import operator
+import timeit
+
+import benchmarks  # noqa: F401 (sets placeholder environment variables for settings.py)
+import helper.eval as eval
+
+# Messages as they show up in counting channels: mostly plain numbers, some math and some chat
+CORPUS = [
+    "4821", "4822", "4823", "4824", "4825", "4826", "4827", "4828", "4829", "4830",
+    "12", "13", "14", "99", "100", "101", "1000", "1001",
+    "4830 + 1", "2 * 2416", "9664 / 2", "69 * 70 + 2", "4833-1+1", "2**12 + 738",
+    "sqrt(16) + 4830", "(4836)", "-(-4837)", "4838.0", "pi", "e * 2",
+    "log10(100) + 4837", "sin(pi/2) + 4839", "exp(0) + 4840", "4842 - 0.4",
+    "nice", "lol", "who broke it", "gg", "4843?", "no u", "5 apples", "ok 4844",
+]
+
+
+# The ast based evaluator safe_eval used before the hand-written parser, kept here as the baseline
+def ast_safe_eval(expr):
+    allowed_operators = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: operator.truediv,
+        ast.Pow: operator.pow,
+        ast.USub: operator.neg,
+    }
+    allowed_functions = {
+        'sin': math.sin, 'cos': math.cos, 'tan': math.tan, 'log': math.log, 'log10': math.log10,
+        'sqrt': math.sqrt, 'exp': math.exp, 'pi': math.pi, 'e': math.e,
+    }
+
+    def eval_(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return node.value
+        elif isinstance(node, ast.UnaryOp):
+            return allowed_operators[type(node.op)](eval_(node.operand))
+        elif isinstance(node, ast.BinOp):
+            return allowed_operators[type(node.op)](eval_(node.left), eval_(node.right))
+        elif isinstance(node, ast.Name):
+            if node.id.lower() in allowed_functions:
+                return allowed_functions[node.id.lower()]
+        elif isinstance(node, ast.Call):
+            if node.func.id.lower() in allowed_functions:
+                return allowed_functions[node.func.id.lower()](*[eval_(arg) for arg in node.args])
+        raise TypeError(f"Unsupported type or operation: {type(node)}")
+
+    return eval_(ast.parse(expr, mode='eval').body)
+
+
+# safe_eval without the LRU cache, every expression is tokenized, parsed and compiled
+def uncached_safe_eval(expr):
+    if expr.isdigit():
+        return int(expr)
+    if not eval.is_expression(expr):
+        raise ValueError(expr)
+    return eval.compile_expression(expr)()
+
+
+def run_corpus(function):
+    for message in CORPUS:
+        try:
+            function(message)
+        except Exception:
+            pass
+
+
+def measure(name, function, number):
+    seconds = min(timeit.repeat(lambda: run_corpus(function), number=number // len(CORPUS), repeat=5))
+    per_message = seconds / (number // len(CORPUS) * len(CORPUS)) * 1e6
+    print(f"{name:<28} {per_message:8.3f} us/message")
+    return per_message
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare safe_eval against the ast.parse based evaluator.")
+    parser.add_argument('--number', type=int, default=20000, help="messages evaluated per run")
+    parser.add_argument('--no-cache', action='store_true', help="also measure the parser without the LRU cache")
+    args = parser.parse_args()
+
+    baseline = measure("ast.parse safe_eval", ast_safe_eval, args.number)
+    current = measure("safe_eval (cached)", eval.safe_eval, args.number)
+    if args.no_cache:
+        measure("safe_eval (uncached)", uncached_safe_eval, args.number)
+    print(f"speedup: {baseline / current:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
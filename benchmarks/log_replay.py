@@ -0,0 +1,196 @@
+# Description: Replays production traffic recorded in logs/user.log through bot.on_message.
+# compile turns one or more (rotated) logs into a compact replay file, run feeds it to the handlers against a
+# temporary SQLite database at the original timing, N times faster or as fast as possible, and reports the
+# performance and every message whose outcome differs from the logged one.
+# Usage: python -m benchmarks.log_replay compile logs/user.log* -o replay.jsonl.gz
+#        (a cluster writes one log per process: compile logs/cluster*/user.log* -o replay.jsonl.gz)
+#        python -m benchmarks.log_replay run replay.jsonl.gz [--speed 1] [--write-behind]
+
+import argparse
+import asyncio
+import gzip
+import json
+import re
+import shutil
+import time
+from collections import Counter
+from datetime import datetime
+
+import benchmarks  # noqa: F401 (sets placeholder environment variables for settings.py)
+from benchmarks.message_benchmark import FakeChannel, FakeMessage, FakeUser, load_bot, print_stats, \
+    use_temporary_database
+
+# The verbose formatter of settings.py followed by the line on_message logs for every counted message,
+# lines written before the outcome was logged have none, rate limited logs note the lines they dropped
+LINE_PATTERN = re.compile(
+    r"^\w+\s+- (?P<time>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}) - bot\s+: "
+    r"\[(?P<channel>\d+)\] (?P<author>\d+): (?P<content>.*) \((?P<number>-?\d+)\)(?: (?P<outcome>correct|twice|wrong))?"
+    r"(?: \(\d+ earlier records dropped\))?$"
+)
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S,%f"
+
+
+def open_text(path, mode='rt'):
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+# Parse the counted messages of the given log files, ordered by time
+def parse_logs(paths):
+    """Return the records as (time, channel_id, author_id, content, number, outcome) and the number of skipped lines."""
+    records, skipped = [], 0
+    for path in paths:
+        with open_text(path) as file:
+            for line in file:
+                match = LINE_PATTERN.match(line.rstrip('\n'))
+                if not match:
+                    skipped += 1
+                    continue
+                records.append((
+                    datetime.strptime(match['time'], TIME_FORMAT),
+                    int(match['channel']),
+                    int(match['author']),
+                    match['content'],
+                    int(match['number']),
+                    match['outcome'],
+                ))
+    # Stable, so lines logged within the same millisecond keep their order
+    records.sort(key=lambda record: record[0])
+    return records, skipped
+
+
+# Write the records as a replay file: a header with the starting count of every channel, then one event per line
+def compile_replay(args):
+    records, skipped = parse_logs(args.logs)
+    if not records:
+        print(f"no counted messages found ({skipped} other lines)")
+        return
+
+    # The log starts mid-count, the first correct message of a channel tells what its count was
+    channels = {}
+    for _, channel_id, _, _, number, outcome in records:
+        if channel_id not in channels:
+            channels[channel_id] = number - 1 if outcome in (None, 'correct') else 0
+
+    start = records[0][0]
+    with open_text(args.output, 'wt') as file:
+        file.write(json.dumps({'start': start.isoformat(), 'channels': channels}) + '\n')
+        for time_, channel_id, author_id, content, _, outcome in records:
+            offset = round((time_ - start).total_seconds() * 1000)
+            file.write(json.dumps([offset, channel_id, author_id, content, outcome]) + '\n')
+
+    duration = (records[-1][0] - start).total_seconds()
+    print(f"{len(records)} messages in {len(channels)} channels over {duration:.1f}s "
+          f"({skipped} other lines skipped) written to {args.output}")
+
+
+def load_replay(path):
+    with open_text(path) as file:
+        header = json.loads(file.readline())
+        events = [json.loads(line) for line in file if line.strip()]
+    return {int(channel_id): count for channel_id, count in header['channels'].items()}, events
+
+
+async def replay(args):
+    channel_counts, events = load_replay(args.replay)
+    bot, outcomes = load_bot()
+    import helper.async_database as db
+
+    await db.setup_database()
+    for channel_id, count in channel_counts.items():
+        await db.add_channel(channel_id)
+        await db.update_count(channel_id, count, 0)
+    await db.load_allowed_channels()
+
+    channels = {channel_id: FakeChannel(channel_id) for channel_id in channel_counts}
+    users = {}
+    messages = []
+    for message_id, (offset, channel_id, author_id, content, outcome) in enumerate(events):
+        author = users.setdefault(author_id, FakeUser(author_id))
+        messages.append((offset, FakeMessage(message_id, content, author, channels[channel_id]), outcome))
+
+    async def handle(message, dispatched):
+        await bot.on_message(message)
+        latencies.append(time.perf_counter() - dispatched)
+
+    backend = db.database.backend
+    latencies = []
+    lag = 0.0
+    before = backend.queries
+    start = time.perf_counter()
+    if args.speed:
+        # Open loop like the gateway: every message is dispatched at its (scaled) time whether or not the
+        # previous ones are done, the channel locks keep each channel in order
+        tasks = []
+        for offset, message, _ in messages:
+            delay = start + offset / 1000 / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lag = max(lag, -delay)
+            tasks.append(asyncio.create_task(handle(message, time.perf_counter())))
+        await asyncio.gather(*tasks)
+    else:
+        # As fast as possible: each channel replays its messages back to back, the channels run concurrently
+        streams = {}
+        for _, message, _ in messages:
+            streams.setdefault(message.channel.id, []).append(message)
+
+        async def replay_stream(stream):
+            for message in stream:
+                await handle(message, time.perf_counter())
+        await asyncio.gather(*(replay_stream(stream) for stream in streams.values()))
+    elapsed = time.perf_counter() - start
+    queries = backend.queries - before
+
+    speed = f"{args.speed:g}x" if args.speed else "max"
+    print(f"backend: {backend.name}, write-behind: {args.write_behind}, speed: {speed}")
+    print(f"messages: {len(messages)} in {len(channels)} channels by {len(users)} users in {elapsed:.1f}s")
+    print_stats(len(messages), elapsed, latencies, queries)
+    if args.speed:
+        print(f"max dispatch lag: {lag * 1e3:.3f} ms")
+
+    # Messages logged without an outcome cannot diverge
+    divergences = Counter(
+        (outcome, outcomes.get(message.id)) for _, message, outcome in messages
+        if outcome is not None and outcomes.get(message.id) != outcome
+    )
+    if divergences:
+        print(f"divergence: {sum(divergences.values())} messages")
+        for (logged, replayed), count in divergences.most_common():
+            print(f"  logged {logged}, replayed {replayed}: {count}")
+    else:
+        print("divergence: none")
+
+    await db.flush_write_behind()
+    db.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay logged counting traffic through the message handler.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    compile_parser = subparsers.add_parser('compile', help="turn user.log files into a replay file")
+    compile_parser.add_argument('logs', nargs='+', help="user.log files, rotated ones in any order, .gz allowed")
+    compile_parser.add_argument('-o', '--output', default='replay.jsonl.gz', help="replay file, .gz to compress")
+
+    run_parser = subparsers.add_parser('run', help="replay a replay file against a temporary database")
+    run_parser.add_argument('replay', help="replay file written by compile")
+    run_parser.add_argument('--speed', type=float, default=1.0,
+                            help="1 for the original timing, N for N times faster, 0 for as fast as possible")
+    run_parser.add_argument('--write-behind', action='store_true', help="buffer the count updates")
+    args = parser.parse_args()
+
+    if args.command == 'compile':
+        compile_replay(args)
+        return
+
+    directory = use_temporary_database(args.write_behind)
+    try:
+        asyncio.run(replay(args))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
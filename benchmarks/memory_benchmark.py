@@ -0,0 +1,153 @@
+# Description: Measures the memory disnake's caches retain for synthetic guilds in each CLIENT_PROFILE. The guild and
+# message payloads are shaped the way the gateway sends them for the profile's intents and fed into the client's
+# connection state, every profile runs in a fresh process and the retained memory is measured with tracemalloc.
+# Usage: python -m benchmarks.memory_benchmark [--guilds 1000] [--channels 25] [--voice 3] [--messages 20]
+
+import argparse
+import gc
+import multiprocessing
+import random
+import tracemalloc
+
+import benchmarks  # noqa: F401 (sets placeholder environment variables for settings.py)
+
+PROFILES = ['default', 'lean']
+BOT_ID = 10 ** 17
+
+
+def snowflake(next_id):
+    return str(next(next_id))
+
+
+def user_payload(user_id):
+    return {'id': str(user_id), 'username': f'user{user_id % 100000}', 'global_name': None,
+            'discriminator': '0', 'avatar': 'a' * 32, 'bot': user_id == BOT_ID}
+
+
+def member_payload(user_id, role_ids):
+    return {'user': user_payload(user_id), 'roles': role_ids, 'joined_at': '2024-01-01T00:00:00+00:00',
+            'nick': None, 'deaf': False, 'mute': False, 'flags': 0}
+
+
+# A GUILD_CREATE payload, members and voice states are only sent with the voice states intent (and without
+# the members and presences intents only the bot's own member and the members in voice channels are sent)
+def guild_payload(args, intents, next_id):
+    guild_id = snowflake(next_id)
+    roles = [{'id': guild_id if index == 0 else snowflake(next_id), 'name': f'role {index}', 'color': 0,
+              'colors': {'primary_color': 0, 'secondary_color': None, 'tertiary_color': None},
+              'hoist': False, 'position': index, 'permissions': '1071698660929', 'managed': False,
+              'mentionable': False, 'flags': 0} for index in range(args.roles)]
+    channels = [{'id': snowflake(next_id), 'type': 0 if index % 5 else 2, 'guild_id': guild_id,
+                 'name': f'channel-{index}', 'position': index, 'topic': 'Count up from 1, no counting twice',
+                 'nsfw': False, 'parent_id': None, 'rate_limit_per_user': 0, 'bitrate': 64000, 'user_limit': 0,
+                 'permission_overwrites': [{'id': roles[0]['id'], 'type': 0, 'allow': '0', 'deny': '2048'}]}
+                for index in range(args.channels)]
+    emojis = [{'id': snowflake(next_id), 'name': f'emoji{index}', 'roles': [], 'require_colons': True,
+               'managed': False, 'animated': False, 'available': True} for index in range(args.emojis)]
+
+    role_ids = [role['id'] for role in roles[1:3]]
+    members = [member_payload(BOT_ID, role_ids)]
+    voice_states = []
+    if intents.voice_states:
+        voice_channel = next(channel['id'] for channel in channels if channel['type'] == 2)
+        for _ in range(args.voice):
+            user_id = int(snowflake(next_id))
+            members.append(member_payload(user_id, role_ids))
+            voice_states.append({'user_id': str(user_id), 'channel_id': voice_channel, 'session_id': 's' * 32,
+                                 'deaf': False, 'mute': False, 'self_deaf': False, 'self_mute': False,
+                                 'self_video': False, 'suppress': False, 'request_to_speak_timestamp': None})
+
+    return {
+        'id': guild_id, 'name': f'Guild {guild_id}', 'icon': None, 'owner_id': str(BOT_ID + 1),
+        'verification_level': 1, 'default_message_notifications': 1, 'explicit_content_filter': 0,
+        'features': ['COMMUNITY', 'NEWS'], 'mfa_level': 0, 'premium_tier': 0, 'preferred_locale': 'en-US',
+        'nsfw_level': 0, 'member_count': 500, 'large': True, 'unavailable': False,
+        'roles': roles, 'emojis': emojis, 'stickers': [], 'channels': channels, 'threads': [],
+        'members': members, 'voice_states': voice_states, 'presences': [],
+        'stage_instances': [], 'guild_scheduled_events': [], 'joined_at': '2024-01-01T00:00:00+00:00',
+    }
+
+
+# A MESSAGE_CREATE payload of a counting message by a guild member
+def message_payload(guild, next_id):
+    channel = random.choice([channel for channel in guild['channels'] if channel['type'] == 0])
+    user_id = BOT_ID + 2 + random.randrange(10 ** 6)
+    return {
+        'id': snowflake(next_id), 'channel_id': channel['id'], 'guild_id': guild['id'], 'type': 0,
+        'content': str(random.randrange(10 ** 4)), 'author': user_payload(user_id),
+        'member': {'roles': [], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False, 'mute': False},
+        'timestamp': '2024-01-01T00:00:00+00:00', 'edited_timestamp': None, 'tts': False,
+        'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': [],
+        'pinned': False, 'flags': 0,
+    }
+
+
+# Feed the payloads of one profile into a client and measure what stays allocated, runs in its own process
+def measure(profile, args):
+    import disnake
+    import helper.client_profile as client_profile
+
+    random.seed(args.seed)
+    next_id = iter(range(BOT_ID + 10 ** 7, 10 ** 19))
+    options = client_profile.client_options(profile)
+    intents = options['intents']
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    client = disnake.Client(**options)
+    state = client._connection
+    state.user = disnake.ClientUser(state=state, data=user_payload(BOT_ID))
+    for _ in range(args.guilds):
+        guild = guild_payload(args, intents, next_id)
+        state._get_create_guild(guild)
+        if intents.guild_messages:
+            for _ in range(args.messages):
+                state.parse_message_create(message_payload(guild, next_id))
+        del guild
+
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    return {
+        'profile': profile,
+        'intents': intents.value,
+        'retained': retained,
+        'guilds': len(state._guilds),
+        'members': sum(len(guild._members) for guild in state._guilds.values()),
+        'voice_states': sum(len(guild._voice_states) for guild in state._guilds.values()),
+        'messages': len(state._messages or ()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the memory retained by the client caches per profile.")
+    parser.add_argument('--guilds', type=int, default=1000, help="guilds the client receives")
+    parser.add_argument('--channels', type=int, default=25, help="channels per guild, every fifth is a voice channel")
+    parser.add_argument('--roles', type=int, default=20, help="roles per guild")
+    parser.add_argument('--emojis', type=int, default=20, help="custom emojis per guild")
+    parser.add_argument('--voice', type=int, default=3, help="members in a voice channel per guild")
+    parser.add_argument('--messages', type=int, default=20, help="messages received per guild")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # A fresh process per profile, so modules and caches of one run do not count towards the other
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        results = [pool.apply(measure, (profile, args)) for profile in PROFILES]
+
+    print(f"{args.guilds} guilds, {args.channels} channels, {args.roles} roles, {args.emojis} emojis, "
+          f"{args.voice} voice members and {args.messages} messages per guild")
+    print(f"{'profile':<10}{'intents':>10}{'MiB':>10}{'MiB/1k guilds':>16}{'members':>10}{'voice':>8}{'messages':>10}")
+    for result in results:
+        per_1k = result['retained'] / 2 ** 20 * 1000 / max(result['guilds'], 1)
+        print(f"{result['profile']:<10}{result['intents']:>10}{result['retained'] / 2 ** 20:>10.1f}{per_1k:>16.1f}"
+              f"{result['members']:>10}{result['voice_states']:>8}{result['messages']:>10}")
+    default, lean = results
+    print(f"lean saves {(1 - lean['retained'] / default['retained']) * 100:.1f}% of the retained memory")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+# Description: Replays a synthetic counting workload of fake disnake messages, edits and deletes through
+# bot.on_message, on_raw_message_edit and on_raw_message_delete against a temporary SQLite database, and reports
+# throughput, handler latency percentiles and database round trips per event.
+# Usage: python -m benchmarks.message_benchmark [--messages 20000] [--channels 20] [--users 200] [--write-behind]
+
+import argparse
+import asyncio
+import importlib
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import benchmarks  # noqa: F401 (sets placeholder environment variables for settings.py)
+
+CHAT = ["nice", "lol", "who broke it", "gg", "no u", "ok", "brb", "5 apples"]
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.bot = False
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.sent = 0
+
+    async def send(self, *args, **kwargs):
+        self.sent += 1
+
+
+class FakeMessage:
+    """The parts of a disnake.Message the counting handlers use, recording the bot's reactions."""
+
+    def __init__(self, message_id, content, author, channel):
+        self.id = message_id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = None
+        self.reactions = []
+        self.replies = 0
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
+
+    async def reply(self, *args, **kwargs):
+        self.replies += 1
+
+
+class FakeRawEvent:
+    """The parts of the raw edit and delete payloads the handlers use, for a message that is not cached."""
+
+    def __init__(self, message, data=None):
+        self.message_id = message.id
+        self.channel_id = message.channel.id
+        self.cached_message = None
+        self.data = data or {}
+
+
+# Expressions that evaluate to n, as people write them in counting channels
+def expression(n):
+    return random.choice([f"{n - 1} + 1", f"{n + 1} - 1", f"{n * 2} / 2", f"({n})", f"sqrt({n * n})"])
+
+
+# Build the events of one channel, following the counting rules so the expected outcome of every message is known
+def generate_channel(channel, users, count, args, next_id):
+    """Return a list of ('message', message, correct), ('edit', before, after) and ('delete', message) events."""
+    events = []
+    current, last_user = 0, None
+    for _ in range(count):
+        roll = random.random()
+        if roll < args.chat_rate:
+            author = random.choice(users)
+            events.append(('message', FakeMessage(next(next_id), random.choice(CHAT), author, channel), None))
+            continue
+
+        if roll < args.chat_rate + args.error_rate:
+            # Either the wrong number or the same user twice, both reset the count
+            if last_user is not None and random.random() < 0.5:
+                author, number = last_user, current + 1
+            else:
+                author, number = random.choice(users), current + random.randint(2, 9)
+            events.append(('message', FakeMessage(next(next_id), str(number), author, channel), False))
+            current, last_user = 0, None
+            continue
+
+        author = random.choice([user for user in random.sample(users, 2) if user is not last_user])
+        current += 1
+        content = expression(current) if random.random() < args.expression_rate else str(current)
+        message = FakeMessage(next(next_id), content, author, channel)
+        events.append(('message', message, True))
+        last_user = author
+
+        # Edits and deletes of the message that holds the current count trigger the notice embeds
+        if random.random() < args.edit_rate:
+            events.append(('edit', message, FakeMessage(message.id, content + " edited", author, channel)))
+        elif random.random() < args.delete_rate:
+            events.append(('delete', message))
+    return events
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))]
+
+
+# Replay the events of one channel in order, the way the gateway delivers them, recording each handler's latency
+async def replay_channel(bot, events, latencies):
+    for event in events:
+        start = time.perf_counter()
+        if event[0] == 'message':
+            await bot.on_message(event[1])
+        elif event[0] == 'edit':
+            edited = {'content': event[2].content, 'edited_timestamp': '2024-01-01T00:00:00+00:00'}
+            await bot.on_raw_message_edit(FakeRawEvent(event[1], edited))
+        else:
+            await bot.on_raw_message_delete(FakeRawEvent(event[1]))
+        latencies.append(time.perf_counter() - start)
+
+
+# Import bot.py for its handlers, runs inside the event loop because the cogs start their tasks when loaded
+def load_bot():
+    """Return the bot module and a dict that receives the outcome of every message, by message id."""
+    # Imported here so settings.py picks up the database settings chosen on the command line
+    bot = importlib.import_module('bot')
+    from disnake.ext import tasks
+
+    # The background tasks of the cogs would add database work of their own
+    for cog in bot.bot.cogs.values():
+        for name in dir(cog):
+            task = getattr(cog, name, None)
+            if isinstance(task, tasks.Loop):
+                task.cancel()
+
+    # Commands are not part of the counting path
+    async def process_commands(message):
+        pass
+    bot.bot.process_commands = process_commands
+
+    # Reactions are sent (or dropped) by the outbox in the background, so outcomes are recorded at the source
+    outcomes = {}
+    count_message = bot.count_message
+
+    async def recording_count_message(message):
+        result = await count_message(message)
+        outcomes[message.id] = result[0] if result else None
+        return result
+    bot.count_message = recording_count_message
+    return bot, outcomes
+
+
+def print_stats(events, elapsed, latencies, queries):
+    latencies = sorted(latencies)
+    print(f"throughput: {events / elapsed:10.1f} events/s")
+    for p in (50, 95, 99):
+        print(f"p{p}: {percentile(latencies, p) * 1e3:14.3f} ms")
+    print(f"max: {latencies[-1] * 1e3:14.3f} ms")
+    print(f"db round trips: {queries / events:.3f}/event ({queries} total)")
+
+
+# Point settings.py at a temporary SQLite database, returns the directory to remove afterwards
+def use_temporary_database(write_behind):
+    directory = tempfile.mkdtemp(prefix='sillycounting-benchmark-')
+    os.environ['DATABASE_BACKEND'] = 'sqlite'
+    os.environ['SQLITE_PATH'] = os.path.join(directory, 'benchmark.db')
+    os.environ['WRITE_BEHIND_ENABLED'] = 'true' if write_behind else 'false'
+    return directory
+
+
+async def run(args):
+    bot, outcomes = load_bot()
+    import helper.async_database as db
+
+    random.seed(args.seed)
+    next_id = iter(range(10 ** 6, 10 ** 12))
+    users = [FakeUser(10 ** 17 + i) for i in range(max(args.users, 2))]
+    channels = [FakeChannel(10 ** 18 + i) for i in range(args.channels)]
+    per_channel = args.messages // args.channels
+    workload = [generate_channel(channel, users, per_channel, args, next_id) for channel in channels]
+
+    # The edit and delete notices go to the channel by id, like for messages that are not cached
+    by_id = {channel.id: channel for channel in channels}
+    bot.bot.get_partial_messageable = lambda channel_id: by_id[channel_id]
+
+    await db.setup_database()
+    for channel in channels:
+        await db.add_channel(channel.id)
+    await db.load_allowed_channels()
+
+    backend = db.database.backend
+    latencies = []
+    before = backend.queries
+    start = time.perf_counter()
+    await asyncio.gather(*(replay_channel(bot, events, latencies) for events in workload))
+    elapsed = time.perf_counter() - start
+    queries = backend.queries - before
+
+    await db.flush_write_behind()
+    flushed = backend.queries - before - queries
+
+    events = [event for events in workload for event in events]
+    messages = [event for event in events if event[0] == 'message']
+    print(f"backend: {backend.name}, write-behind: {args.write_behind}")
+    print(f"events: {len(events)} ({len(messages)} messages) in {len(channels)} channels by {len(users)} users")
+    print_stats(len(events), elapsed, latencies, queries)
+    outbox = bot.outbox
+    print(f"outbox: {outbox.sent} sent, {outbox.dropped} stale reactions dropped, {outbox.pending()} pending")
+    print(f"edit/delete notices: {sum(channel.sent for channel in channels)}")
+    print(f"final write-behind flush: {flushed} statements")
+
+    # The bot must agree with the workload about every counted message, otherwise the numbers are meaningless
+    mismatches = sum(
+        1 for _, message, correct in messages
+        if correct is not None and (outcomes.get(message.id) == 'correct') != correct
+    )
+    if mismatches:
+        print(f"warning: {mismatches} messages were not counted as expected")
+
+    db.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay synthetic counting traffic through the message handlers.")
+    parser.add_argument('--messages', type=int, default=20000, help="messages sent in total")
+    parser.add_argument('--channels', type=int, default=20, help="counting channels, replayed concurrently")
+    parser.add_argument('--users', type=int, default=200, help="distinct users sending messages")
+    parser.add_argument('--error-rate', type=float, default=0.02, help="share of messages that break the count")
+    parser.add_argument('--expression-rate', type=float, default=0.1, help="share of correct counts written as math")
+    parser.add_argument('--chat-rate', type=float, default=0.05, help="share of messages that are not numbers")
+    parser.add_argument('--edit-rate', type=float, default=0.01, help="share of correct counts edited afterwards")
+    parser.add_argument('--delete-rate', type=float, default=0.01, help="share of correct counts deleted afterwards")
+    parser.add_argument('--write-behind', action='store_true', help="buffer the count updates")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    directory = use_temporary_database(args.write_behind)
+    try:
+        asyncio.run(run(args))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
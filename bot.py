@@ -3,24 +3,37 @@
 
 
 # import own modules
-import helper.database as db
+import helper.async_database as db
+import helper.client_profile as client_profile
+import helper.cluster as cluster
 import helper.error as error
 import helper.eval as eval
+from helper.locks import KeyedLock
+import helper.metrics as metrics
+from helper.outbox import outbox
+from helper.recent_messages import recent_messages
 import settings
 
 # Importing necessary libraries
 import disnake
 from disnake.ext import commands, tasks
 from random import choice
-
-# Initialize the Bot with command prefix and intents
-intents = disnake.Intents.default()
-intents.messages = True
-intents.message_content = True
-bot = commands.AutoShardedBot(command_prefix=settings.COMMAND_PREFIX, intents=intents)
-
-# Setup the logger
+import time
+
+# Initialize the Bot with command prefix, the intents and caches come from CLIENT_PROFILE
+# In cluster mode this process runs CLUSTER_SHARD_IDS of SHARD_COUNT shards and only the first one syncs the commands
+sync_flags = commands.CommandSyncFlags.default() if cluster.is_primary() else commands.CommandSyncFlags.none()
+bot = commands.AutoShardedBot(
+    command_prefix=settings.COMMAND_PREFIX,
+    shard_ids=settings.CLUSTER_SHARD_IDS or None,
+    shard_count=settings.SHARD_COUNT or None,
+    command_sync_flags=sync_flags,
+    **client_profile.client_options(),
+)
+
+# Setup the logger, counted messages are logged on the sampled and rate limited message logger
 logger = settings.logging.getLogger('bot')
+message_logger = settings.logging.getLogger('bot.messages')
 
 # Use `logger` to log messages
 logger.info("Bot is starting up...")
@@ -29,19 +42,26 @@ logger.info("Bot is starting up...")
 POSITIVE_EMOJI = '<:positive:1232460365183582239>'
 NEGATIVE_EMOJI = '<:negative:1232460363954651177>'
 
+# One lock per counting channel, serializing the read-modify-write of its count
+channel_locks = KeyedLock()
+
 
 # Event listener for when the bot is ready
 @bot.event
 async def on_ready():
-    # Prepare the database
-    logger.info("Bot is starting up and preparing database...")
-    db.setup_database()
-
-    # Start the tasks
-    update_status.start()
+    # Start the tasks, the allowlist is loaded by the first resync, on_ready fires again after reconnects
+    if not update_status.is_running():
+        update_status.start()
+    if not resync_allowed_channels.is_running():
+        resync_allowed_channels.start()
+    await metrics.start_server()
 
     # Log a message to the console
-    logger.info(f'Logged on as {bot.user} with {bot.shard_count} shards!')
+    if cluster.is_clustered():
+        logger.info(f'Logged on as {bot.user} as cluster {settings.CLUSTER_ID} with shards '
+                    f'{settings.CLUSTER_SHARD_IDS} of {bot.shard_count}!')
+    else:
+        logger.info(f'Logged on as {bot.user} with {bot.shard_count} shards!')
 
 
 # Load Cogs On Start
@@ -62,6 +82,12 @@ async def update_status():
     await bot.change_presence(activity=activity, status=disnake.Status.online)
 
 
+# Task to reload the counting channel allowlist, picks up channels enabled or disabled by other processes
+@tasks.loop(minutes=settings.ALLOWLIST_RESYNC_MINUTES)
+async def resync_allowed_channels():
+    await db.load_allowed_channels()
+
+
 # Event listener for when a message is sent
 @bot.event
 async def on_message(message):
@@ -69,136 +95,166 @@ async def on_message(message):
         await bot.process_commands(message)
         return
 
-    if await db.is_channel_allowed(message):
-        try:
-            # Attempt to evaluate the content of the message as a math expression
-            message_number = eval.safe_eval(message.content)
-            if isinstance(message_number, float):
-                message_number = round(message_number)  # Round the result to the nearest integer for counting
-        except:
-            # Fallback if the message is not a valid expression, ignore it
-            await bot.process_commands(message)
-            return
-
-        try:
-            current_count, last_user_id = db.get_current_count(int(message.channel.id))
-
-            logger.info(f"[{message.channel.id}] {message.author.id}: {message.content} ({message_number})")
-
-            if message_number == current_count + 1 and message.author.id != last_user_id:
-                # Update the count in the database
-                db.update_count(message.channel.id, message_number, message.author.id)
-
-                # Update user count
-                if not db.check_user(str(message.author.id)):
-                    db.add_user(message.author.id)
-                db.update_user_count(message.channel.id, message.author.id)
-
-                # Add a reaction to the message
-                await message.add_reaction(POSITIVE_EMOJI)
-            else:
-                if str(message.author.id) == last_user_id:
-                    db.update_count(message.channel.id, 0, 0)
-                    await message.add_reaction(NEGATIVE_EMOJI)
-                    embed = disnake.Embed(
-                        title="You cannot count twice in a row!",
-                        description="Starting from `1` again.",
-                        color=disnake.Colour(settings.EMBED_COLOR)
-                    )
-                    embed.set_footer(text="Your thoughts? Use /feedback to share!")
-                    await message.reply(embed=embed)
-                else:
-                    db.update_count(message.channel.id, 0, 0)
-                    await message.add_reaction(NEGATIVE_EMOJI)
-                    embed = disnake.Embed(
-                        title=f"The number was {current_count + 1}",
-                        description=f"Starting from `1` again.",
-                        color=disnake.Colour(settings.EMBED_COLOR)
-                    )
-                    embed.set_footer(text="Your thoughts? Use /feedback to share!")
-                    await message.reply(embed=embed)
-
-                """Check if current highscore is less than new highscore and update it."""
-                current_highscore = db.get_highscore(message.channel.id)
-
-                if current_count <= current_highscore:
-                    embed = disnake.Embed(
-                        title="Better luck next time!",
-                        description=f"Current highscore is {current_highscore}. Try to beat it!",
-                        color=disnake.Colour(settings.EMBED_COLOR)
-                    )
-                    await message.channel.send(embed=embed)
-                    return
-
-                db.update_highscore(message.channel.id, current_count)
-                embed = disnake.Embed(
-                    title="New highscore!",
-                    description=f"We reached a highscore of `{current_count}`!",
-                    color=disnake.Colour(settings.EMBED_COLOR)
-                )
-                await message.channel.send(embed=embed)
-        except ValueError:
-            pass  # Ignore messages that are not numbers
+    # Messages outside counting channels neither wait for nor create a channel lock
+    start = time.perf_counter()
+    with metrics.timer('on_message_stage_seconds', stage='allowlist'):
+        allowed = await db.is_channel_allowed(message)
+    if not allowed:
+        await bot.process_commands(message)
+        return
 
-    await bot.process_commands(message)
+    # Messages of one channel are counted strictly in order, different channels run concurrently
+    lock_start = time.perf_counter()
+    async with channel_locks.acquire(message.channel.id):
+        metrics.observe('on_message_stage_seconds', time.perf_counter() - lock_start, stage='lock')
+        result = await count_message(message)
 
+    if result is not None:
+        with metrics.timer('on_message_stage_seconds', stage='discord'):
+            send_count_result(message, *result)
+        metrics.observe('on_message_seconds', time.perf_counter() - start, outcome=result[0])
+
+    await bot.process_commands(message)
 
-# Event listener for when a message is deleted
-@bot.event
-async def on_message_delete(message):
-    if message.author == bot.user:
-        return
 
+# Check a message of a counting channel against the channel count and update the database, runs under the channel lock
+async def count_message(message):
+    """Return (outcome, current_count, current_highscore, new_highscore) or None if the message is not counted."""
     try:
-        evaluated_message = eval.safe_eval(message.content)
-        if not isinstance(evaluated_message, (int, float)):  # Check if it's a number
-            return
+        # Attempt to evaluate the content of the message as a math expression
+        with metrics.timer('on_message_stage_seconds', stage='eval'):
+            message_number = await eval.safe_eval_async(message.content)
+        if isinstance(message_number, float):
+            message_number = round(message_number)  # Round the result to the nearest integer for counting
     except Exception:
-        return  # Ignore if the message content is not a valid expression or causes an error
+        # Fallback if the message is not a valid expression, ignore it
+        return None
 
-    # Check if the channel is allowed for counting
-    if await db.is_channel_allowed(message):
-        current_count, last_user_id = db.get_current_count(message.channel.id)
+    with metrics.timer('on_message_stage_seconds', stage='db'):
+        return await update_channel_count(message, message_number)
 
-        # Check if the message matched the current count
-        if not evaluated_message == current_count:
-            return  # Ignore if the message was not the current count
 
+# Apply a counted number to the channel count, runs under the channel lock
+async def update_channel_count(message, message_number):
+    try:
+        current_count, last_user_id = await db.get_current_count(int(message.channel.id))
+
+        if message_number == current_count + 1 and message.author.id != last_user_id:
+            outcome = 'correct'
+        else:
+            outcome = 'twice' if message.author.id == last_user_id else 'wrong'
+
+        # The outcome is part of the line so benchmarks/log_replay.py can check a replay against it
+        message_logger.info("[%s] %s: %s (%s) %s", message.channel.id, message.author.id, message.content,
+                            message_number, outcome)
+        await db.record_count_event(message.channel.id, message.author.id, message.id, message_number, outcome)
+
+        if outcome == 'correct':
+            # Remember the message, edits and deletes of it are looked up by id
+            recent_messages.add(message.channel.id, message.id, message_number, message.author.id)
+
+            # Update the count in the database
+            await db.update_count(message.channel.id, message_number, message.author.id)
+
+            # Update user count, this also creates the user and updates their total
+            await db.update_user_count(message.channel.id, message.author.id)
+            return 'correct', current_count, None, False
+
+        # The highscore was raised as the count advanced, the run set it if it still holds the record
+        state = await db.get_channel_state(message.channel.id)
+        current_highscore, new_highscore = (state['highscore'], state['record']) if state else (0, False)
+        await db.update_count(message.channel.id, 0, 0)
+        recent_messages.clear(message.channel.id)
+        if new_highscore:
+            await db.flush_highscores()  # Write the record now that the run is over
+        return outcome, current_count, current_highscore, new_highscore
+    except ValueError:
+        return None  # Ignore messages that are not numbers
+
+
+# Queue the reaction and reply to a counted message, the outbox sends them without holding up counting
+def send_count_result(message, outcome, current_count, current_highscore, new_highscore):
+    if outcome == 'correct':
+        # Add a reaction to the message
+        outbox.submit('reaction', message.channel.id, lambda: message.add_reaction(POSITIVE_EMOJI))
+        return
+
+    outbox.submit('reaction', message.channel.id, lambda: message.add_reaction(NEGATIVE_EMOJI))
+    if outcome == 'twice':
         embed = disnake.Embed(
-            title="Number Deleted",
-            description=f"<@{message.author.id}> deleted a message!\nCurrent count is `{current_count}`.",
+            title="You cannot count twice in a row!",
+            description="Starting from `1` again.",
             color=disnake.Colour(settings.EMBED_COLOR)
         )
-        await message.channel.send(embed=embed)
+    else:
+        embed = disnake.Embed(
+            title=f"The number was {current_count + 1}",
+            description=f"Starting from `1` again.",
+            color=disnake.Colour(settings.EMBED_COLOR)
+        )
+    embed.set_footer(text="Your thoughts? Use /feedback to share!")
 
+    if not new_highscore:
+        highscore_embed = disnake.Embed(
+            title="Better luck next time!",
+            description=f"Current highscore is {current_highscore}. Try to beat it!",
+            color=disnake.Colour(settings.EMBED_COLOR)
+        )
+    else:
+        highscore_embed = disnake.Embed(
+            title="New highscore!",
+            description=f"We reached a highscore of `{current_count}`!",
+            color=disnake.Colour(settings.EMBED_COLOR)
+        )
 
-# Event listener for when a message is edited
+    # The failure and the highscore notice go out as one message
+    outbox.submit('reply', message.channel.id, lambda: message.reply(embeds=[embed, highscore_embed]))
+
+
+# Send the notice for an edited or deleted message if it holds the current count of its channel
+async def notify_changed_message(channel_id, message_id, title, action):
+    entry = recent_messages.get(channel_id, message_id)
+    if entry is None:
+        return  # Not one of the recent accepted counts of a counting channel
+    number, author_id, is_current = entry
+    if not is_current:
+        return  # A later count followed it
+    allowed_channels = db.database.allowed_channels
+    if allowed_channels.loaded and channel_id not in allowed_channels:
+        return  # Counting was disabled in the channel since
+
+    current_count, last_user_id = await db.get_current_count(channel_id)
+    if number != current_count:
+        return  # The count changed outside of this process since
+
+    embed = disnake.Embed(
+        title=title,
+        description=f"<@{author_id}> {action} a message!\nCurrent count is `{current_count}`.",
+        color=disnake.Colour(settings.EMBED_COLOR)
+    )
+    channel = bot.get_partial_messageable(channel_id)
+    outbox.submit('notice', channel_id, lambda: channel.send(embed=embed))
+
+
+# Event listener for when a message is deleted, raw events also cover messages the client no longer caches
 @bot.event
-async def on_message_edit(before, after):
-    if before.author == bot.user:
-        return
+async def on_raw_message_delete(payload):
+    await notify_changed_message(payload.channel_id, payload.message_id, "Number Deleted", "deleted")
 
-    try:
-        evaluated_before = eval.safe_eval(before.content)
-        if not isinstance(evaluated_before, (int, float)):  # Check if it's a number
-            return
-    except Exception:
-        return  # Ignore if the before message content is not a valid expression or causes an error
 
-    # Check if the channel is allowed for counting
-    if await db.is_channel_allowed(before):
-        current_count, last_user_id = db.get_current_count(before.channel.id)
+# Event listener for when messages are deleted in bulk, only the latest count can hold the current count
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    for message_id in payload.message_ids:
+        await notify_changed_message(payload.channel_id, message_id, "Number Deleted", "deleted")
 
-        # Check if the message matched the current count
-        if not evaluated_before == current_count:
-            return  # Ignore if the message was not the current count
 
-        embed = disnake.Embed(
-            title="Number Edited",
-            description=f"<@{before.author.id}> edited a message!\nCurrent count is `{current_count}`.",
-            color=disnake.Colour(settings.EMBED_COLOR)
-        )
-        await before.channel.send(embed=embed)
+# Event listener for when a message is edited
+@bot.event
+async def on_raw_message_edit(payload):
+    if payload.data.get('edited_timestamp') is None:
+        return  # Embeds resolved or pinned, not an edit of the content
+    await notify_changed_message(payload.channel_id, payload.message_id, "Number Edited", "edited")
 
 
 # Slash command error handler
@@ -219,5 +275,18 @@ async def on_slash_command_error(interaction: disnake.ApplicationCommandInteract
         await interaction.response.send_message(embed=error.create_error_embed(e), ephemeral=True)
 
 
-# Bot starts running here
-bot.run(settings.DISCORD_TOKEN, reconnect=True)
+# Run the bot until it is closed, cluster.py calls this in each of its processes
+def main():
+    # Migrate the schema once before connecting, on_ready fires again on every reconnect
+    logger.info("Preparing the database...")
+    db.database.setup_database()
+
+    bot.run(settings.DISCORD_TOKEN, reconnect=True)
+
+    # Wait for database work still in flight once the bot has closed
+    db.shutdown()
+
+
+# Bot starts running here, importing the module (e.g. from the benchmarks) only sets up the handlers
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+# Description: Runs the bot as a cluster of processes, each connecting a contiguous range of the shards.
+# The launcher splits the shards, starts the processes one after another so their shards do not identify at the
+# same time, restarts processes that crash or stop reporting, and sends every process the totals of the cluster.
+# The processes share the database, each channel belongs to one shard so its count is only handled by one process.
+# Usage: python cluster.py [--clusters N] [--shards N]
+
+import argparse
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+import urllib.request
+
+import helper.cluster as cluster
+import helper.database as database
+import settings
+
+# Setup the logger
+logger = settings.logging.getLogger('bot')
+
+# Seconds a new process gets per shard to become ready before the next one is started anyway
+STARTUP_SECONDS_PER_SHARD = 10
+
+# Seconds between status lines of the launcher
+STATUS_LOG_SECONDS = 300
+
+
+# Ask Discord how many shards the bot should run
+def recommended_shard_count():
+    request = urllib.request.Request(
+        'https://discord.com/api/v10/gateway/bot',
+        headers={'Authorization': f'Bot {settings.DISCORD_TOKEN}', 'User-Agent': 'DiscordBot (cluster.py, 1.0)'},
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.load(response)['shards']
+
+
+# Entry point of a cluster process, settings.py reads its shards from the environment the launcher set
+def run_worker(connection):
+    cluster.connection = connection
+    import bot
+    bot.main()
+
+
+class Worker:
+    """One cluster process, restarted with a growing delay while it keeps failing."""
+
+    def __init__(self, cluster_id, shard_ids):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process = None
+        self.connection = None
+        self.status = None
+        self.started = 0.0
+        self.last_seen = 0.0
+        self.failures = 0
+        self.restart_at = None
+
+    def start(self, context, shard_count):
+        parent_connection, child_connection = context.Pipe()
+        os.environ.update({
+            'CLUSTER_ID': str(self.cluster_id),
+            'CLUSTER_SHARD_IDS': ','.join(map(str, self.shard_ids)),
+            'SHARD_COUNT': str(shard_count),
+        })
+        self.process = context.Process(target=run_worker, args=(child_connection,),
+                                       name=f'cluster-{self.cluster_id}')
+        self.process.start()
+        child_connection.close()
+        self.connection = parent_connection
+        self.status = None
+        self.started = self.last_seen = time.monotonic()
+        self.restart_at = None
+        logger.info(f"Started cluster {self.cluster_id} (pid {self.process.pid}) with shards {self.shard_ids}")
+
+    def ready(self):
+        return self.status is not None and self.status['ready']
+
+    def startup_timeout(self):
+        return len(self.shard_ids) * STARTUP_SECONDS_PER_SHARD + settings.CLUSTER_HEARTBEAT_TIMEOUT
+
+    def receive(self):
+        """Read the status updates that arrived, returns whether there were any."""
+        received = False
+        try:
+            while self.connection.poll():
+                self.status = self.connection.recv()
+                self.last_seen = time.monotonic()
+                received = True
+        except (EOFError, OSError):
+            pass  # The process is exiting, the supervisor notices once it is gone
+        return received
+
+    def send(self, totals):
+        try:
+            self.connection.send(totals)
+        except (EOFError, OSError):
+            pass
+
+    def stop(self, timeout):
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            self.process.terminate()  # SIGTERM, the bot closes and flushes its buffered writes
+            self.process.join(timeout)
+        if self.process.is_alive():
+            logger.warning(f"Cluster {self.cluster_id} did not stop in {timeout}s, killing it")
+            self.process.kill()
+            self.process.join()
+
+    def handle_exit(self, now):
+        """Schedule the restart of a process that exited, quick restarts of a process that keeps failing back off."""
+        if now - self.started > settings.CLUSTER_HEARTBEAT_TIMEOUT:
+            self.failures = 0
+        delay = min(settings.CLUSTER_RESTART_DELAY * 2 ** self.failures, settings.CLUSTER_RESTART_MAX_DELAY)
+        self.failures += 1
+        logger.error(f"Cluster {self.cluster_id} exited with code {self.process.exitcode}, restarting in {delay:g}s")
+        self.process.close()
+        self.process = None
+        self.connection.close()
+        self.connection = None
+        self.status = None
+        self.restart_at = now + delay
+
+
+# Start, watch and restart the workers until interrupted
+def supervise(workers, shard_count):
+    context = multiprocessing.get_context('spawn')
+    queue = list(workers)  # Started one at a time, in order
+    starting = None
+    last_log = time.monotonic()
+
+    while True:
+        now = time.monotonic()
+
+        # Start the next process once the previous one is ready or took too long
+        if starting is not None and (starting.process is None or starting.ready()
+                                     or now - starting.started > starting.startup_timeout()):
+            starting = None
+        if starting is None and queue:
+            starting = queue.pop(0)
+            starting.start(context, shard_count)
+
+        running = [worker for worker in workers if worker.process is not None]
+        multiprocessing.connection.wait(
+            [worker.connection for worker in running] + [worker.process.sentinel for worker in running], timeout=1
+        )
+        now = time.monotonic()
+
+        changed = False
+        for worker in running:
+            changed |= worker.receive()
+            if not worker.process.is_alive():
+                worker.handle_exit(now)
+                changed = True
+            elif worker is not starting and now - worker.last_seen > settings.CLUSTER_HEARTBEAT_TIMEOUT:
+                logger.error(f"Cluster {worker.cluster_id} sent no status for {settings.CLUSTER_HEARTBEAT_TIMEOUT:g}s, "
+                             f"killing it")
+                worker.process.kill()
+
+        for worker in workers:
+            if worker.restart_at is not None and worker.restart_at <= now and worker not in queue:
+                worker.restart_at = None
+                queue.append(worker)
+
+        # Every process gets the totals of the whole cluster
+        statuses = [worker.status for worker in workers if worker.status is not None]
+        if changed:
+            totals = cluster.aggregate(statuses, shard_count)
+            for worker in workers:
+                if worker.process is not None:
+                    worker.send(totals)
+
+        if now - last_log > STATUS_LOG_SECONDS:
+            last_log = now
+            totals = cluster.aggregate(statuses, shard_count)
+            logger.info(f"Cluster status: {totals['ready_clusters']}/{len(workers)} processes ready, "
+                        f"{totals['shards']}/{shard_count} shards, {totals['guilds']} guilds")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bot as a cluster of processes.")
+    parser.add_argument('--clusters', type=int, default=settings.CLUSTER_COUNT, help="number of processes")
+    parser.add_argument('--shards', type=int, default=settings.SHARD_COUNT,
+                        help="total number of shards, 0 for Discord's recommended count")
+    args = parser.parse_args()
+
+    shard_count = args.shards or recommended_shard_count()
+    cluster_count = max(1, min(args.clusters, shard_count))
+    workers = [Worker(cluster_id, shard_ids)
+               for cluster_id, shard_ids in enumerate(cluster.split_shards(shard_count, cluster_count))]
+    logger.info(f"Running {shard_count} shards in {cluster_count} processes")
+
+    # Migrate once up front, the processes then find the schema up to date with a single query
+    database.setup_database()
+
+    try:
+        supervise(workers, shard_count)
+    except KeyboardInterrupt:
+        logger.info("Stopping the cluster")
+    finally:
+        for worker in workers:
+            worker.stop(timeout=30)
+
+
+if __name__ == '__main__':
+    main()
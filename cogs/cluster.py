@@ -0,0 +1,34 @@
+# Description: This file reports the status of this process to the cluster launcher and keeps the cluster totals.
+# Without the launcher the totals only cover this process.
+
+# Import the required libraries
+from disnake.ext import commands, tasks
+import helper.cluster as cluster
+import settings
+
+# Setup the logger
+logger = settings.logging.getLogger('bot')
+
+
+# Exchanges the status with the launcher every CLUSTER_STATUS_SECONDS, which is also the heartbeat it watches
+class Cluster(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.report_status.start()
+
+    def cog_unload(self):
+        self.report_status.cancel()
+
+    @tasks.loop(seconds=settings.CLUSTER_STATUS_SECONDS)
+    async def report_status(self):
+        try:
+            cluster.exchange_status(self.bot)
+        except (EOFError, OSError) as e:
+            # The launcher is gone, nobody would restart this process or tell it about the others
+            logger.error(f"Lost the connection to the cluster launcher, shutting down: {e}")
+            await self.bot.close()
+
+
+# Add the cog to the bot
+def setup(bot):
+    bot.add_cog(Cluster(bot))
@@ -4,8 +4,9 @@
 # Import the required libraries
 from disnake.ext import commands
 import disnake
-import helper.database as db
+import helper.async_database as db
 import helper.error as error
+from helper.guilds import resolver
 import settings
 
 # Setup the logger
@@ -28,7 +29,7 @@ class Disable(commands.Cog):
         try:
             logger.info(f"[{interaction.channel.id}] {interaction.author.id}: /disable {channel.id} ({interaction.id})")
 
-            if not db.check_channel(str(channel.id)):
+            if not await db.check_channel(str(channel.id)):
                 embed = disnake.Embed(
                     title="Sorry!",
                     description=f"Channel <#{channel.id}> is not a counting channel.",
@@ -37,7 +38,9 @@ class Disable(commands.Cog):
                 await interaction.send(embed=embed, ephemeral=True)
                 return
 
-            db.remove_channel(str(channel.id))
+            await db.remove_channel(str(channel.id))
+            await db.delete_channel_guilds([channel.id])
+            resolver.forget([channel.id])
             embed = disnake.Embed(
                 title="Channel Removed",
                 description=f"Channel <#{channel.id}> successfully removed!",
@@ -4,8 +4,9 @@
 # Import the required libraries
 from disnake.ext import commands
 import disnake
-import helper.database as db
+import helper.async_database as db
 import helper.error as error
+from helper.guilds import resolver
 import settings
 
 # Setup the logger
@@ -28,7 +29,7 @@ class Enable(commands.Cog):
         try:
             logger.info(f"[{interaction.channel.id}] {interaction.author.id}: /enable {channel.id} ({interaction.id})")
 
-            if db.check_channel(str(channel.id)):
+            if await db.check_channel(str(channel.id)):
                 embed = disnake.Embed(
                     title="Sorry!",
                     description=f"Channel <#{channel.id}> is already a counting channel.",
@@ -37,7 +38,13 @@ class Enable(commands.Cog):
                 await interaction.send(embed=embed, ephemeral=True)
                 return
 
-            db.add_channel(str(channel.id))
+            await db.add_channel(str(channel.id))
+
+            # Remember the guild of the channel for the server leaderboard
+            guild_row = (channel.id, channel.guild.id, channel.guild.name)
+            await db.upsert_channel_guilds([guild_row])
+            resolver.remember([guild_row])
+
             embed = disnake.Embed(
                 title="Channel Added",
                 description=f"Channel <#{channel.id}> successfully added!",
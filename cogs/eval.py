@@ -27,7 +27,7 @@ class Eval(commands.Cog):
                 f"[{interaction.channel.id}] {interaction.author.id}: /eval_number {expression} ({interaction.id})")
 
             # Attempt to evaluate the number
-            evaluated_number = eval.safe_eval(expression)
+            evaluated_number = await eval.safe_eval_async(expression)
             embed = disnake.Embed(
                 title="Evaluated Number",
                 description=f"Task: `{expression}`\nThe evaluated number is `{evaluated_number}` "
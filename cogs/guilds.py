@@ -0,0 +1,65 @@
+# Description: This file keeps the stored guild of every counting channel up to date for the server leaderboard.
+
+# Import the required libraries
+from disnake.ext import commands, tasks
+import disnake
+import helper.async_database as db
+from helper.guilds import resolver
+import settings
+
+# Setup the logger
+logger = settings.logging.getLogger('commands')
+
+
+# This cog has no commands, it listens to guild events and refreshes the channel_guilds table
+class Guilds(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.refresh_channel_guilds.start()
+
+    # Task to store the guild of every counting channel this process can see and prune dead channels
+    @tasks.loop(hours=settings.GUILD_REFRESH_HOURS)
+    async def refresh_channel_guilds(self):
+        stored = await db.get_channel_guilds()
+        channel_ids = set(stored) | db.database.allowed_channels.channel_ids
+
+        rows, dead = [], []
+        for channel_id in channel_ids:
+            channel = self.bot.get_channel(channel_id)
+            if channel is not None:
+                if stored.get(channel_id) != (channel.guild.id, channel.guild.name):
+                    rows.append((channel_id, channel.guild.id, channel.guild.name))
+            elif channel_id in stored:
+                # Only guilds this process can see tell whether one of their channels is gone
+                guild = self.bot.get_guild(stored[channel_id][0])
+                if guild is not None and guild.get_channel(channel_id) is None:
+                    dead.append(channel_id)
+
+        await db.upsert_channel_guilds(rows)
+        await db.delete_channel_guilds(dead)
+        pruned = await db.prune_channel_guilds()
+        resolver.remember(rows)
+        resolver.forget(dead)
+        logger.info(f"Refreshed {len(rows)} channel guilds, removed {len(dead)} dead and {pruned} disabled channels")
+
+    @refresh_channel_guilds.before_loop
+    async def before_refresh_channel_guilds(self):
+        await self.bot.wait_until_ready()
+
+    @commands.Cog.listener()
+    async def on_guild_update(self, before: disnake.Guild, after: disnake.Guild):
+        if before.name != after.name:
+            await db.update_guild_name(after.id, after.name)
+            resolver.rename_guild([channel.id for channel in after.channels if channel.id in resolver.names],
+                                  after.name)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: disnake.abc.GuildChannel):
+        if channel.id in resolver.names or channel.id in db.database.allowed_channels:
+            await db.delete_channel_guilds([channel.id])
+            resolver.forget([channel.id])
+
+
+# Add the cog to the bot
+def setup(bot):
+    bot.add_cog(Guilds(bot))
@@ -35,8 +35,10 @@ class Help(commands.Cog):
             embed.add_field(name="`/highscore`", value="Show the current highscore")
             embed.add_field(name="`/reset_highscore`", value="Reset the highscore")
             embed.add_field(name="`/leaderboard [action]`", value="Show some leaderboard information")
+            embed.add_field(name="`/rank [action] [user]`", value="Show where you or another user stand")
             embed.add_field(name="`/feedback [feedback]`", value="Send feedback to the developers")
             embed.add_field(name="`/eval_number [expression]`", value="Evaluate a number")
+            embed.add_field(name="`/metrics`", value="Show the latency metrics of the bot (administrators)")
             await interaction.send(embed=embed, ephemeral=True)
 
         except Exception as e:
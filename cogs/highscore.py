@@ -1,31 +1,29 @@
 # Description: This file contains the command to enable the counting function in a channel.
 
 # Import the required libraries
-from datetime import datetime
 from disnake.ext import commands, tasks
 import disnake
-import helper.database as db
+import helper.async_database as db
 import helper.error as error
 import settings
 
 # Setup the logger
 logger = settings.logging.getLogger('commands')
 
-highscore_change_timestamp = 0
-
 
 # This is a test command to check if the bot is working
 class Highscore(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.update_all_highscores.start()
+        self.reconcile_highscores.start()
+
+    def cog_unload(self):
+        self.reconcile_highscores.cancel()
 
-    # Task to update all highscores every 60 minutes
+    # Task to write the highscores raised since the last pass every 60 minutes, runs that end write them right away
     @tasks.loop(minutes=60)
-    async def update_all_highscores(self):
-        db.update_all_highscores()
-        global highscore_change_timestamp  # Use the global variable
-        highscore_change_timestamp = datetime.now().timestamp()
+    async def reconcile_highscores(self):
+        await db.flush_highscores()
 
     # Command to show the highscore
     @commands.slash_command(description='Show the highscore of the current channel.')
@@ -46,15 +44,17 @@ class Highscore(commands.Cog):
                 await interaction.send(embed=embed, ephemeral=True)
                 return
 
-            # Get the current highscore from the database
-            current_highscore = db.get_highscore(interaction.channel.id)
+            # Get the current highscore, kept up to date as the channel counts
+            state = await db.get_channel_state(interaction.channel.id)
+            description = f"The current highscore is `{state['highscore']}`"
+            if state['highscore_at']:
+                description += f"\nReached <t:{state['highscore_at']}:R>"
             embed = disnake.Embed(
                 title="Highscore",
-                description=(f"The current highscore is `{current_highscore}`"
-                             f"\nLast automatic change: <t:{int(highscore_change_timestamp)}:R>"),
+                description=description,
                 color=disnake.Colour(settings.EMBED_COLOR)
             )
-            embed.set_footer(text="The highscore is updated every 60 minutes.")
+            embed.set_footer(text="The highscore is updated as soon as the count beats it.")
             await interaction.send(embed=embed, ephemeral=True)
         # Catch any exceptions and send an error message
         except Exception as e:
@@ -82,7 +82,8 @@ class Highscore(commands.Cog):
                 return
 
             # Reset the highscore in the database
-            db.update_highscore(interaction.channel.id, 0)
+            await db.update_highscore(interaction.channel.id, 0)
+            await db.invalidate_channel_state(interaction.channel.id)
             embed = disnake.Embed(
                 title="Highscore Reset",
                 description=f"Highscore successfully reset!",
@@ -1,20 +1,104 @@
 # Description: This file contains the leaderboard command which is used to display the leaderboard of various things.
 
 # Import the required libraries
-from disnake.ext import commands
+from disnake.ext import commands, tasks
 import disnake
-import helper.database as db
+import helper.async_database as db
+import helper.cluster as cluster
 import helper.error as error
+from helper.guilds import resolver
+import helper.leaderboard as leaderboard
 import settings
 
 # Setup the logger
 logger = settings.logging.getLogger('commands')
 
+# Emotes for the 1st, 2nd, and 3rd place
+MEDALS = ["🥇", "🥈", "🥉"]
+TITLES = {
+    "all servers": "Server Leaderboard",
+    "all users": "User Leaderboard",
+    "current channel": "Channel Leaderboard",
+}
+
+
+# Buttons to page through a leaderboard, pages are fetched with keyset cursors instead of OFFSET
+class LeaderboardView(disnake.ui.View):
+    def __init__(self, cog, action, channel_id, author_id, has_more):
+        super().__init__(timeout=settings.LEADERBOARD_VIEW_TIMEOUT)
+        self.cog = cog
+        self.action = action
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.cursors = [None]  # Cursor of every page shown so far, the first page has none
+        self.page = 0
+        self.update_buttons(has_more)
+
+    def update_buttons(self, has_more):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = not has_more
+
+    async def interaction_check(self, interaction: disnake.MessageInteraction):
+        return interaction.author.id == self.author_id
+
+    async def show_page(self, interaction: disnake.MessageInteraction):
+        rows, has_more = await leaderboard.service.get_page(self.action, self.channel_id, self.cursors[self.page])
+        if has_more and len(self.cursors) == self.page + 1:
+            self.cursors.append(leaderboard.next_cursor(rows))
+        self.update_buttons(has_more)
+        embed = await self.cog.build_embed(self.action, rows, self.page * leaderboard.service.page_size)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @disnake.ui.button(label="Previous", style=disnake.ButtonStyle.secondary)
+    async def previous_page(self, button: disnake.ui.Button, interaction: disnake.MessageInteraction):
+        self.page -= 1
+        await self.show_page(interaction)
+
+    @disnake.ui.button(label="Next", style=disnake.ButtonStyle.secondary)
+    async def next_page(self, button: disnake.ui.Button, interaction: disnake.MessageInteraction):
+        self.page += 1
+        await self.show_page(interaction)
+
 
 # This is a test command to check if the bot is working
 class Leaderboard(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        if cluster.is_primary():  # One check for the whole cluster
+            self.check_user_totals.start()
+
+    def cog_unload(self):
+        self.check_user_totals.cancel()
+
+    # Task to check the maintained user totals against channeluser and repair drift
+    @tasks.loop(hours=settings.USER_TOTALS_CHECK_HOURS)
+    async def check_user_totals(self):
+        await db.check_user_totals()
+
+    # Build the embed of one leaderboard page, offset is the rank of the first row minus one
+    async def build_embed(self, action, rows, offset):
+        embed = disnake.Embed(
+            title=TITLES[action],
+            description="",
+            color=disnake.Colour(settings.EMBED_COLOR)
+        )
+        if action == "all servers":
+            # Resolve all guild names of the page at once, never with per-row API fetches
+            guild_names = await resolver.resolve(self.bot, [row_id for row_id, _ in rows])
+
+        for i, (row_id, count) in enumerate(rows, start=offset):
+            if action == "all servers":
+                name = guild_names[int(row_id)]
+            else:
+                name = f"<@{row_id}>"
+
+            if i < len(MEDALS):
+                embed.description += f"{MEDALS[i]} {name} - Count: `{count}`\n"
+            else:
+                embed.description += f"**#{i + 1}** {name} - Count: `{count}`\n"
+
+        embed.set_footer(text="Your thoughts? Use /feedback to share!")
+        return embed
 
     # leaderboard command
     @commands.slash_command(description='Show the leaderboard information of various things.')
@@ -27,32 +111,8 @@ class Leaderboard(commands.Cog):
             logger.info(
                 f"[{interaction.channel.id}] {interaction.author.id}: /leaderboard [{action}] ({interaction.id})")
 
-            # Get Top 10 highscore of all channels available in the db
-            # Add Emotes to 1st, 2nd, and 3rd place (🥇, 🥈, 🥉)
-            if action == "all servers":
-                embed = disnake.Embed(
-                    title="Server Leaderboard",
-                    description="",
-                    color=disnake.Colour(settings.EMBED_COLOR)
-                )
-                for i, (channel_id, highscore) in enumerate(db.get_top_channel_highscores()):
-                    bot = self.bot
-                    channel = bot.get_channel(int(channel_id))
-                    if i == 0:
-                        embed.description += f"🥇 {channel.guild.name} - Count: `{highscore}`\n"
-                    elif i == 1:
-                        embed.description += f"🥈 {channel.guild.name} - Count: `{highscore}`\n"
-                    elif i == 2:
-                        embed.description += f"🥉 {channel.guild.name} - Count: `{highscore}`\n"
-                    else:
-                        embed.description += f"**#{i + 1}** {channel.guild.name} - Count: `{highscore}`\n"
-
-                embed.set_footer(text="Your thoughts? Use /feedback to share!")
-                await interaction.send(embed=embed, ephemeral=True)
-
-            # Get Top 10 highscore of the current channel
-            # Add Emotes to 1st, 2nd, and 3rd place (🥇, 🥈, 🥉)
-            elif action == "current channel":
+            channel_id = None
+            if action == "current channel":
                 # Check if channel is a counting channel first
                 if not await db.is_channel_allowed(interaction):
                     embed = disnake.Embed(
@@ -62,45 +122,15 @@ class Leaderboard(commands.Cog):
                     )
                     await interaction.send(embed=embed, ephemeral=True)
                     return
+                channel_id = interaction.channel.id
 
-                embed = disnake.Embed(
-                    title="Channel Leaderboard",
-                    description="",
-                    color=disnake.Colour(settings.EMBED_COLOR)
-                )
-                for i, (user_id, count) in enumerate(db.get_top_user_highscores(channel_id=interaction.channel.id)):
-                    if i == 0:
-                        embed.description += f"🥇 <@{user_id}> - Count: `{count}`\n"
-                    elif i == 1:
-                        embed.description += f"🥈 <@{user_id}> - Count: `{count}`\n"
-                    elif i == 2:
-                        embed.description += f"🥉 <@{user_id}> - Count: `{count}`\n"
-                    else:
-                        embed.description += f"**#{i + 1}** <@{user_id}> - Count: `{count}`\n"
-
-                embed.set_footer(text="Your thoughts? Use /feedback to share!")
-                await interaction.send(embed=embed, ephemeral=True)
-
-            # Get Top 10 highscore of all users : get_top_users()
-            # Add Emotes to 1st, 2nd, and 3rd place (🥇, 🥈, 🥉)
-            elif action == "all users":
-                embed = disnake.Embed(
-                    title="User Leaderboard",
-                    description="",
-                    color=disnake.Colour(settings.EMBED_COLOR)
-                )
-                for i, (user_id, count) in enumerate(db.get_top_users()):
-                    if i == 0:
-                        embed.description += f"🥇 <@{user_id}> - Count: `{count}`\n"
-                    elif i == 1:
-                        embed.description += f"🥈 <@{user_id}> - Count: `{count}`\n"
-                    elif i == 2:
-                        embed.description += f"🥉 <@{user_id}> - Count: `{count}`\n"
-                    else:
-                        embed.description += f"**#{i + 1}** <@{user_id}> - Count: `{count}`\n"
-
-                embed.set_footer(text="Your thoughts? Use /feedback to share!")
-                await interaction.send(embed=embed, ephemeral=True)
+            # Get the first page, served from the leaderboard cache if it is fresh
+            rows, has_more = await leaderboard.service.get_page(action, channel_id)
+            view = LeaderboardView(self, action, channel_id, interaction.author.id, has_more)
+            if has_more:
+                view.cursors.append(leaderboard.next_cursor(rows))
+            embed = await self.build_embed(action, rows, 0)
+            await interaction.send(embed=embed, view=view, ephemeral=True)
 
         # Catch any exceptions and send an error message
         except Exception as e:
@@ -0,0 +1,38 @@
+# Description: This file compacts the ledger of counted messages in the background.
+# Compaction rolls new events into the hourly aggregates (and in source mode into the counts) and deletes old events.
+
+# Import the required libraries
+from disnake.ext import commands, tasks
+import helper.async_database as db
+import helper.cluster as cluster
+import settings
+
+# Setup the logger
+logger = settings.logging.getLogger('bot')
+
+
+# Compacts the ledger every LEDGER_COMPACT_MINUTES
+class Ledger(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        # One process compacts for the whole cluster
+        if settings.LEDGER_MODE != 'off' and cluster.is_primary():
+            self.compact_ledger.start()
+
+    def cog_unload(self):
+        self.compact_ledger.cancel()
+
+    # Task to append the buffered events, compact them and delete the expired ones
+    @tasks.loop(minutes=settings.LEDGER_COMPACT_MINUTES)
+    async def compact_ledger(self):
+        try:
+            await db.flush_count_events()
+            await db.compact_count_events()
+            await db.prune_count_events()
+        except Exception as e:
+            logger.error(f"Error when compacting the ledger: {e}")
+
+
+# Add the cog to the bot
+def setup(bot):
+    bot.add_cog(Ledger(bot))
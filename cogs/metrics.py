@@ -0,0 +1,94 @@
+# Description: This file records the latency of every slash command and contains the command to show the metrics.
+# The command is only available to users with the administrator permission.
+
+# Import the required libraries
+import time
+from disnake.ext import commands
+import disnake
+import helper.error as error
+import helper.metrics as metrics
+import settings
+
+# Setup the logger
+logger = settings.logging.getLogger('commands')
+
+# Interaction tokens expire after 15 minutes, a command that has not completed by then never will
+COMMAND_TIMEOUT_SECONDS = 15 * 60
+
+
+# Summarize the histograms as one line per series: count, average and estimated p95
+def summarize():
+    lines = []
+    for (name, labels), histogram in sorted(metrics.registry.histograms.items()):
+        _, total, count = histogram.snapshot()
+        if not count:
+            continue
+        label = ''.join(f" {label_value}" for _, label_value in labels)
+        lines.append(f"`{name}`{label}: {count}x, avg {total / count * 1e3:.2f} ms, "
+                     f"p95 < {histogram.quantile(0.95) * 1e3:g} ms")
+    for name, labels, value in sorted(metrics.registry.samples()):
+        label = ''.join(f" {label_value}" for _, label_value in labels)
+        lines.append(f"`{name}`{label}: {value}")
+    return lines
+
+
+# Records the latency of slash commands and shows the metrics
+class Metrics(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.started = {}
+
+    # Remember when a slash command was invoked, dropping commands that neither completed nor failed in time
+    @commands.Cog.listener()
+    async def on_slash_command(self, interaction):
+        now = time.perf_counter()
+        while self.started:
+            oldest = next(iter(self.started))  # Insertion order is the order of the start times
+            if now - self.started[oldest] < COMMAND_TIMEOUT_SECONDS:
+                break
+            del self.started[oldest]
+        self.started[interaction.id] = now
+
+    @commands.Cog.listener()
+    async def on_slash_command_completion(self, interaction):
+        self.record(interaction, 'ok')
+
+    @commands.Cog.listener()
+    async def on_slash_command_error(self, interaction, e):
+        self.record(interaction, 'error')
+
+    def record(self, interaction, status):
+        start = self.started.pop(interaction.id, None)
+        if start is not None:
+            metrics.observe('command_seconds', time.perf_counter() - start, command=interaction.data.name,
+                            status=status)
+
+    # Command to show the metrics
+    @commands.slash_command(description='Show the latency metrics of the bot.')
+    @commands.has_permissions(administrator=True)
+    async def metrics(
+            self,
+            interaction: disnake.ApplicationCommandInteraction
+    ):
+        try:
+            logger.info(f"[{interaction.channel.id}] {interaction.author.id}: /metrics ({interaction.id})")
+
+            description = '\n'.join(summarize()) or "No metrics recorded yet."
+            if len(description) > 4000:
+                description = description[:4000].rsplit('\n', 1)[0] + "\n…"
+            embed = disnake.Embed(
+                title="Metrics",
+                description=description,
+                color=disnake.Colour(settings.EMBED_COLOR)
+            )
+            if settings.METRICS_PORT:
+                embed.set_footer(text=f"Full metrics on http://{settings.METRICS_HOST}:{settings.METRICS_PORT}/metrics")
+            await interaction.send(embed=embed, ephemeral=True)
+        except Exception as e:
+            logger.error(f"Error when showing metrics: {e}")
+            await interaction.send(embed=error.create_error_embed(str(e)), ephemeral=True)
+
+
+# Add the cog to the bot
+def setup(bot):
+    bot.add_cog(Metrics(bot))
@@ -0,0 +1,77 @@
+# Description: This file contains the rank command, which shows where a user stands in the user leaderboards.
+
+# Import the required libraries
+from disnake.ext import commands, tasks
+import disnake
+import helper.async_database as db
+import helper.error as error
+import settings
+
+# Setup the logger
+logger = settings.logging.getLogger('commands')
+
+
+# Ranks are answered from the in-memory rank indexes, without counting rows in the database
+class Rank(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.refresh_ranks.start()
+
+    def cog_unload(self):
+        self.refresh_ranks.cancel()
+
+    # Task to load the rank index of all users at startup and reload it every RANK_REFRESH_MINUTES
+    @tasks.loop(minutes=settings.RANK_REFRESH_MINUTES)
+    async def refresh_ranks(self):
+        await db.load_user_ranks()
+
+    # Command to show the rank of a user
+    @commands.slash_command(description='Show your rank, or the rank of another user.')
+    async def rank(
+            self,
+            interaction: disnake.ApplicationCommandInteraction,
+            action: str = commands.param(default="all users", choices=["all users", "current channel"]),
+            user: disnake.User = None,
+    ):
+        try:
+            logger.info(f"[{interaction.channel.id}] {interaction.author.id}: /rank [{action}] ({interaction.id})")
+            user = user or interaction.author
+
+            if action == "current channel":
+                # Check if channel is a counting channel first
+                if not await db.is_channel_allowed(interaction):
+                    embed = disnake.Embed(
+                        title="Sorry!",
+                        description=f"This channel is not activated for counting.",
+                        color=disnake.Colour(settings.EMBED_COLOR)
+                    )
+                    await interaction.send(embed=embed, ephemeral=True)
+                    return
+                rank = await db.get_channel_rank(interaction.channel.id, user.id)
+                where = "in this channel"
+            else:
+                rank = await db.get_user_rank(user.id)
+                where = "across all channels"
+
+            if rank is None:
+                description = f"<@{user.id}> has not counted {where} yet."
+            else:
+                position, count, users = rank
+                description = f"<@{user.id}> is **#{position}** of {users} {where} with a count of `{count}`."
+            embed = disnake.Embed(
+                title="Rank",
+                description=description,
+                color=disnake.Colour(settings.EMBED_COLOR)
+            )
+            embed.set_footer(text="Your thoughts? Use /feedback to share!")
+            await interaction.send(embed=embed, ephemeral=True)
+
+        # Catch any exceptions and send an error message
+        except Exception as e:
+            logger.error(f"Error when getting rank: {e}")
+            await interaction.send(embed=error.create_error_embed(str(e)), ephemeral=True)
+
+
+# Add the cog to the bot
+def setup(bot):
+    bot.add_cog(Rank(bot))
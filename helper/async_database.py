@@ -0,0 +1,209 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import time
+import helper.database as database
+import helper.metrics as metrics
+import settings
+
+# Configure logging for database operations
+logger = settings.logging.getLogger("database")
+
+# Bounded executor for the blocking helper.database calls, whichever storage backend runs the queries, and the
+# cached helpers that may fall back to one. One thread per query connection of the pool (the buffer threads have
+# connections of their own), so a worker never has to wait for a free connection.
+executor = ThreadPoolExecutor(max_workers=settings.DATABASE_POOL_SIZE, thread_name_prefix='database')
+
+
+# Run a blocking database function in the executor without blocking the event loop
+async def run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(timed_call, time.perf_counter(), func, *args, **kwargs))
+
+
+# Call a database function in an executor thread, recording how long it waited for the thread and how long it ran
+def timed_call(submitted, func, *args, **kwargs):
+    started = time.perf_counter()
+    metrics.observe('database_executor_wait_seconds', started - submitted)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        metrics.observe('database_query_seconds', time.perf_counter() - started, function=func.__name__)
+
+
+# Shut down the executor, waiting for queries in flight, and flush buffered writes
+def shutdown():
+    logger.info("Shutting down database executor")
+    executor.shutdown(wait=True)
+    database.write_buffer.stop()
+    database.event_buffer.stop()
+    database.flush_highscores()
+
+
+async def setup_database():
+    return await run(database.setup_database)
+
+
+async def is_channel_allowed(message):
+    # Once the allowlist is loaded this is a set lookup without any I/O
+    if database.allowed_channels.loaded:
+        return message.channel.id in database.allowed_channels
+    return await run(database.is_channel_allowed, message)
+
+
+async def load_allowed_channels():
+    return await run(database.load_allowed_channels)
+
+
+async def update_count(channel_id, new_count, user_id):
+    # With the ledger as the write path this only updates the cache
+    if settings.LEDGER_MODE == 'source':
+        return database.update_count(channel_id, new_count, user_id)
+    return await run(database.update_count, channel_id, new_count, user_id)
+
+
+async def add_channel(channel_id):
+    return await run(database.add_channel, channel_id)
+
+
+async def remove_channel(channel_id):
+    return await run(database.remove_channel, channel_id)
+
+
+async def check_channel(channel_id):
+    return await run(database.check_channel, channel_id)
+
+
+async def check_user(user_id):
+    # Users already known to exist are answered from memory
+    if int(user_id) in database.known_users:
+        return True
+    return await run(database.check_user, user_id)
+
+
+async def add_user(user_id):
+    return await run(database.add_user, user_id)
+
+
+async def update_user_count(channel_id, user_id):
+    if settings.LEDGER_MODE == 'source':
+        return database.update_user_count(channel_id, user_id)
+    return await run(database.update_user_count, channel_id, user_id)
+
+
+async def get_highscore(channel_id):
+    # Cached channels are answered from memory
+    state = database.channel_cache.get(channel_id)
+    if state is not None:
+        return state['highscore']
+    return await run(database.get_highscore, channel_id)
+
+
+async def get_top_channel_highscores(limit=10, after=None):
+    return await run(database.get_top_channel_highscores, limit, after)
+
+
+async def get_top_user_highscores(channel_id, limit=10, after=None):
+    return await run(database.get_top_user_highscores, channel_id, limit, after)
+
+
+async def get_top_users(limit=10, after=None):
+    return await run(database.get_top_users, limit, after)
+
+
+async def load_user_ranks():
+    return await run(database.load_user_ranks)
+
+
+async def get_user_rank(user_id):
+    # Answered from the rank index once it is loaded
+    index = database.rank_index.users
+    if index is not None:
+        return database.rank_index.rank(index, int(user_id))
+    return await run(database.get_user_rank, user_id)
+
+
+async def get_channel_rank(channel_id, user_id):
+    index = database.rank_index.channel(int(channel_id))
+    if index is not None:
+        return database.rank_index.rank(index, int(user_id))
+    return await run(database.get_channel_rank, channel_id, user_id)
+
+
+async def check_user_totals():
+    return await run(database.check_user_totals)
+
+
+async def update_highscore(channel_id, new_highscore):
+    return await run(database.update_highscore, channel_id, new_highscore)
+
+
+async def flush_highscores():
+    return await run(database.flush_highscores)
+
+
+async def get_current_count(channel_id):
+    # Cached channels are answered from memory
+    state = database.channel_cache.get(channel_id)
+    if state is not None:
+        return state['count'], state['last_user_id']
+    return await run(database.get_current_count, channel_id)
+
+
+async def get_channel_state(channel_id):
+    state = database.channel_cache.get(channel_id)
+    if state is not None:
+        return state
+    return await run(database.get_channel_state, channel_id)
+
+
+async def flush_write_behind():
+    return await run(database.flush_write_behind)
+
+
+async def invalidate_channel_state(channel_id):
+    # Writing a raised highscore first is a query, everything else is in memory
+    if int(channel_id) in database.channel_cache.dirty:
+        return await run(database.invalidate_channel_state, channel_id)
+    database.invalidate_channel_state(channel_id)
+
+
+async def record_count_event(channel_id, user_id, message_id, number, outcome):
+    # Only appends to the ledger buffer, the buffer's thread writes it
+    database.record_count_event(channel_id, user_id, message_id, number, outcome)
+
+
+async def flush_count_events():
+    return await run(database.flush_count_events)
+
+
+async def compact_count_events():
+    return await run(database.compact_count_events)
+
+
+async def prune_count_events():
+    return await run(database.prune_count_events)
+
+
+async def upsert_channel_guilds(rows):
+    return await run(database.upsert_channel_guilds, rows)
+
+
+async def get_channel_guild_names(channel_ids):
+    return await run(database.get_channel_guild_names, channel_ids)
+
+
+async def get_channel_guilds():
+    return await run(database.get_channel_guilds)
+
+
+async def update_guild_name(guild_id, guild_name):
+    return await run(database.update_guild_name, guild_id, guild_name)
+
+
+async def delete_channel_guilds(channel_ids):
+    return await run(database.delete_channel_guilds, channel_ids)
+
+
+async def prune_channel_guilds():
+    return await run(database.prune_channel_guilds)
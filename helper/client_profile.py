@@ -0,0 +1,44 @@
+import disnake
+import settings
+
+# Setup the logger
+logger = settings.logging.getLogger('bot')
+
+# Messages disnake caches unless told otherwise
+DEFAULT_MESSAGE_CACHE_SIZE = 1000
+
+
+# Intents of the lean profile: guilds for the channels the commands and the guild names use, guild messages with
+# their content for counting, edits and deletes. No DMs, reactions, typing, voice, presences or members.
+def lean_intents():
+    intents = disnake.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.message_content = True
+    return intents
+
+
+# Keyword arguments for the bot's client in the given profile, 'default' or 'lean'
+def client_options(profile=None, message_cache_size=None):
+    profile = profile or settings.CLIENT_PROFILE
+    message_cache_size = settings.MESSAGE_CACHE_SIZE if message_cache_size is None else message_cache_size
+
+    if profile == 'lean':
+        intents = lean_intents()
+        options = {
+            'intents': intents,
+            'member_cache_flags': disnake.MemberCacheFlags.none(),  # Only the bot's own member is kept
+            'chunk_guilds_at_startup': False,
+            'max_messages': None,
+        }
+    else:
+        if profile != 'default':
+            logger.warning(f"Unknown CLIENT_PROFILE {profile!r}, using the default profile")
+        intents = disnake.Intents.default()
+        intents.messages = True
+        intents.message_content = True
+        options = {'intents': intents, 'max_messages': DEFAULT_MESSAGE_CACHE_SIZE}
+
+    if message_cache_size >= 0:
+        options['max_messages'] = message_cache_size or None  # disnake disables the cache with None
+    return options
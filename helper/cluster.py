@@ -0,0 +1,73 @@
+import math
+import helper.metrics as metrics
+import settings
+
+# Setup the logger
+logger = settings.logging.getLogger('bot')
+
+# Pipe to the launcher, set by cluster.py in the processes it starts, None when the bot runs on its own
+connection = None
+
+# Totals of the whole cluster, as last sent by the launcher
+totals = {}
+
+
+# Whether this process runs a part of the shards for cluster.py
+def is_clustered():
+    return bool(settings.CLUSTER_SHARD_IDS)
+
+
+# Only one process runs the jobs that work on the whole database, like the ledger compaction
+def is_primary():
+    return settings.CLUSTER_ID == 0
+
+
+# Split the shards into contiguous ranges, one per cluster
+def split_shards(shard_count, cluster_count):
+    return [list(range(index * shard_count // cluster_count, (index + 1) * shard_count // cluster_count))
+            for index in range(cluster_count)]
+
+
+# Status of this process as reported to the launcher
+def local_status(bot):
+    latency = bot.latency
+    return {
+        'cluster_id': settings.CLUSTER_ID,
+        'shard_ids': settings.CLUSTER_SHARD_IDS or list(range(bot.shard_count or 1)),
+        'guilds': len(bot.guilds),
+        'latency': None if math.isnan(latency) or math.isinf(latency) else latency,
+        'ready': bot.is_ready(),
+    }
+
+
+# Add up the status of every process of the cluster
+def aggregate(statuses, shard_count):
+    latencies = [status['latency'] for status in statuses if status['latency'] is not None]
+    return {
+        'clusters': len(statuses),
+        'ready_clusters': sum(1 for status in statuses if status['ready']),
+        'shard_count': shard_count,
+        'shards': sum(len(status['shard_ids']) for status in statuses),
+        'guilds': sum(status['guilds'] for status in statuses),
+        'max_latency': max(latencies) if latencies else None,
+    }
+
+
+# Send the status of this process to the launcher and pick up the latest totals, raises once the launcher is gone
+def exchange_status(bot):
+    global totals
+    status = local_status(bot)
+    if connection is None:
+        totals = aggregate([status], bot.shard_count or 1)
+        return totals
+
+    connection.send(status)
+    while connection.poll():
+        totals = connection.recv()
+    return totals
+
+
+# Expose the cluster totals with the other metrics
+metrics.register_collector(lambda: [
+    (f'cluster_{name}', {}, value) for name, value in totals.items() if value is not None
+])
@@ -1,47 +1,270 @@
-import mysql.connector
-from mysql.connector import pooling
+import atexit
+import threading
+import time
+import helper.metrics as metrics
+from helper.ranks import RankIndex, rank_index
+from helper.storage import create_backend
+import helper.storage.migrations as migrations
 import settings
 
-# Configure logging for database operations
+# Configure logging for database operations, every call logs on the sampled and rate limited query logger
 logger = settings.logging.getLogger("database")
+query_logger = settings.logging.getLogger("database.queries")
 
 
-class MariaDBConnectionPool:
-    def __init__(self, pool_name='pool', pool_size=5):
-        self.pool = mysql.connector.pooling.MySQLConnectionPool(
-            pool_name=pool_name,
-            pool_size=pool_size,
-            pool_reset_session=True,
-            host=settings.DATABASE_HOST,
-            database=settings.DATABASE_NAME,
-            user=settings.DATABASE_USER,
-            password=settings.DATABASE_PASSWORD,
-            port=settings.DATABASE_PORT
-        )
-
-    def get_connection(self):
-        return self.pool.get_connection()
-
-    @staticmethod
-    def release_connection(conn):
-        if conn is not None:
-            try:
-                if conn.is_connected():
-                    conn.close()
-            except Exception as e:
-                logger.error(f"Failed to close connection: {e}")
-        else:
-            logger.error("Attempted to release a None connection")
+class ChannelStateCache:
+    """In-memory state of counting channels (count, last_user_id and highscore), loaded on first touch.
+
+    Highscores are raised here as the counts advance and the channels are marked dirty until the new highscore
+    is written, `record` tells whether the current run holds the highscore.
+    """
+
+    def __init__(self):
+        self.states = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
 
+    def get(self, channel_id):
+        return self.states.get(int(channel_id))
 
-# Initialize the connection pool
-connection_pool = MariaDBConnectionPool()
+    def set(self, channel_id, count, last_user_id, highscore, highscore_at=0):
+        self.states[int(channel_id)] = {
+            'count': count,
+            'last_user_id': last_user_id,
+            'highscore': highscore,
+            'highscore_at': highscore_at,
+            'record': False,
+        }
+        self.advance(channel_id, count)  # Repairs a highscore that was not written before a restart
+
+    def update(self, channel_id, **fields):
+        """Write through to a cached entry. Channels that are not cached yet are left alone."""
+        state = self.states.get(int(channel_id))
+        if state is not None:
+            state.update(fields)
+
+    def advance(self, channel_id, count):
+        """Raise the highscore of a cached channel if the count beats it, a count of 0 ends the run."""
+        state = self.states.get(int(channel_id))
+        if state is None:
+            return
+        if count > state['highscore']:
+            state.update(highscore=count, highscore_at=int(time.time()), record=True)
+            with self.lock:
+                self.dirty.add(int(channel_id))
+        elif count == 0:
+            state['record'] = False
+
+    def take_dirty(self):
+        """Swap out the channels with unwritten highscores and return {channel_id: (highscore, highscore_at)}."""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        highscores = {}
+        for channel_id in dirty:
+            state = self.states.get(channel_id)
+            if state is not None:
+                highscores[channel_id] = (state['highscore'], state['highscore_at'])
+        return highscores
+
+    def mark_dirty(self, channel_ids):
+        with self.lock:
+            self.dirty.update(channel_ids)
+
+    def discard_dirty(self, channel_id):
+        with self.lock:
+            self.dirty.discard(int(channel_id))
+
+    def invalidate(self, channel_id):
+        self.discard_dirty(channel_id)
+        self.states.pop(int(channel_id), None)
+
+    def clear(self):
+        with self.lock:
+            self.dirty.clear()
+        self.states.clear()
+
+
+class ChannelAllowlist:
+    """Set of enabled counting channel ids, so messages in other channels are rejected without a query."""
+
+    def __init__(self):
+        self.channel_ids = set()
+        self.loaded = False
+
+    def replace(self, channel_ids):
+        self.channel_ids = {int(channel_id) for channel_id in channel_ids}
+        self.loaded = True
+
+    def add(self, channel_id):
+        self.channel_ids.add(int(channel_id))
+
+    def discard(self, channel_id):
+        self.channel_ids.discard(int(channel_id))
+
+    def __contains__(self, channel_id):
+        return int(channel_id) in self.channel_ids
+
+    def __len__(self):
+        return len(self.channel_ids)
+
+
+class FlushingBuffer:
+    """Base of the buffers written to the database by a background thread.
+
+    The thread calls `flush` every `flush_ms` milliseconds, or as soon as `max_ops` operations are pending.
+    """
+
+    def __init__(self, flush_ms, max_ops, flush):
+        self.ops = 0
+        self.flush_interval = flush_ms / 1000
+        self.max_ops = max_ops
+        self.flush = flush
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.running = False
+
+    def notify(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.start()
+        if self.ops >= self.max_ops:
+            self.wakeup.set()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=type(self).__name__, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def stop(self):
+        """Stop the flush thread and flush whatever is still pending."""
+        if self.thread is not None:
+            self.running = False
+            self.wakeup.set()
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+
+class WriteBehindBuffer(FlushingBuffer):
+    """Buffers channel counts (last value per channel wins) and per-(channel, user) increments."""
+
+    def __init__(self, flush_ms, max_ops):
+        super().__init__(flush_ms, max_ops, flush=lambda: flush_write_behind())
+        self.counts = {}
+        self.user_counts = {}
+
+    def add_count(self, channel_id, count, user_id):
+        with self.lock:
+            self.counts[int(channel_id)] = (count, user_id)
+            self.ops += 1
+        self.notify()
+
+    def add_user_count(self, channel_id, user_id, increment=1):
+        key = (int(channel_id), int(user_id))
+        with self.lock:
+            self.user_counts[key] = self.user_counts.get(key, 0) + increment
+            self.ops += 1
+        self.notify()
+
+    def pending_count(self, channel_id):
+        return self.counts.get(int(channel_id))
+
+    def discard_channel(self, channel_id):
+        """Drop the pending count and user increments of a channel."""
+        channel_id = int(channel_id)
+        with self.lock:
+            if self.counts.pop(channel_id, None) is not None:
+                self.ops -= 1
+            for key in [key for key in self.user_counts if key[0] == channel_id]:
+                del self.user_counts[key]
+                self.ops -= 1
+
+    def take(self):
+        """Swap out everything pending and return it as (counts, user_counts)."""
+        with self.lock:
+            counts, user_counts = self.counts, self.user_counts
+            self.counts, self.user_counts, self.ops = {}, {}, 0
+        return counts, user_counts
+
+    def restore(self, counts, user_counts):
+        """Put back the operations of a failed flush without overwriting newer counts."""
+        with self.lock:
+            for channel_id, value in counts.items():
+                self.counts.setdefault(channel_id, value)
+            for key, increment in user_counts.items():
+                self.user_counts[key] = self.user_counts.get(key, 0) + increment
+            self.ops += len(counts) + len(user_counts)
+
+
+class CountEventBuffer(FlushingBuffer):
+    """Buffers ledger events, appended to count_events in batches."""
+
+    def __init__(self, flush_ms, max_ops):
+        super().__init__(flush_ms, max_ops, flush=lambda: flush_count_events())
+        self.events = []
+
+    def add(self, event):
+        with self.lock:
+            self.events.append(event)
+            self.ops += 1
+        self.notify()
+
+    def take(self):
+        with self.lock:
+            events, self.events, self.ops = self.events, [], 0
+        return events
+
+    def restore(self, events):
+        """Put back the events of a failed flush in front of the newer ones."""
+        with self.lock:
+            self.events[:0] = events
+            self.ops += len(events)
+
+
+# Background threads that write to the database next to the query threads: the write-behind and ledger flushers
+BACKGROUND_THREADS = 2
+
+# Initialize the storage backend, with a connection for every query thread and every background thread
+backend = create_backend(pool_size=settings.DATABASE_POOL_SIZE + BACKGROUND_THREADS)
+
+# Initialize the write-behind buffer, only used if enabled in the settings
+write_buffer = WriteBehindBuffer(settings.WRITE_BEHIND_FLUSH_MS, settings.WRITE_BEHIND_MAX_OPS)
+atexit.register(write_buffer.stop)
+
+# Flushes run one at a time from taking the batch to committing it, the buffer thread and the callers that flush on
+# demand would otherwise commit their batches in either order, and an older count could overwrite a newer one
+write_behind_flush_lock = threading.RLock()
+ledger_flush_lock = threading.RLock()
+
+# Initialize the ledger buffer and the lock that keeps compactions from overlapping, used unless LEDGER_MODE is off
+event_buffer = CountEventBuffer(settings.LEDGER_FLUSH_MS, settings.LEDGER_MAX_EVENTS)
+atexit.register(event_buffer.stop)
+compaction_lock = threading.Lock()
+
+# Initialize the channel state cache, the allowlist and the set of users known to exist in the database
+channel_cache = ChannelStateCache()
+allowed_channels = ChannelAllowlist()
+known_users = set()
+
+# Expose the size of the write-behind and ledger buffers with the other metrics
+metrics.register_collector(lambda: [
+    ('write_behind_pending_ops', {}, write_buffer.ops),
+    ('ledger_pending_events', {}, event_buffer.ops),
+])
 
 
 # Create database connection
 def create_connection():
     try:
-        return connection_pool.get_connection()
+        return backend.get_connection()
     except Exception as e:
         logger.error(f"Failed to obtain database connection: {e}")
         return None
@@ -50,406 +273,532 @@ def create_connection():
 # Close database connection
 def close_connection(conn):
     """ Release a database connection back to the pool."""
-    connection_pool.release_connection(conn)
+    backend.release_connection(conn)
 
 
-# Set up database
-def setup_database():
-    """Set up the database and tables and ensure all columns are correct."""
-    connection = create_connection()
-    if connection is None:
-        logger.error("No database connection could be established.")
-        return
-    else:
-        logger.info("Database connection was established successfully.")
+# Set up database, runs once at process start
+def setup_database(dry_run=False):
+    """Apply the schema migrations the database is missing, a single query when it is up to date.
 
+    Returns the changes that were made, or in a dry run the changes that would be made.
+    """
     try:
-        cursor = connection.cursor()
-        # Define your tables and required columns
-        tables = {
-            'users': {
-                'user_id': 'BIGINT PRIMARY KEY',
-            },
-            'channels': {
-                'channel_id': 'BIGINT PRIMARY KEY',
-                'count': 'INT DEFAULT 0',  # Default value for count
-                'last_user_id': 'BIGINT DEFAULT 0',  # Default value for last_user_id
-                'highscore': 'INT DEFAULT 0'  # Default value for highscore
-            },
-            'channeluser': {
-                'channeluser_id': 'INT AUTO_INCREMENT PRIMARY KEY',
-                'user_id': 'BIGINT NOT NULL',
-                'channel_id': 'BIGINT NOT NULL',
-                'count': 'INT NOT NULL DEFAULT 0'  # Default value for count
-            }
-        }
+        changes = migrations.migrate(backend, dry_run)
+        if dry_run:
+            logger.info(f"{len(changes)} pending schema changes in the {backend.name} database")
+        elif changes:
+            logger.info(f"Migrated the {backend.name} database with {len(changes)} changes")
+        else:
+            logger.info(f"The {backend.name} database schema is up to date")
+        return changes
+    except Exception as e:
+        logger.error(f"Failed to migrate the database: {e}")
+    return None
 
-        # Create tables if they do not exist
-        for table_name, columns in tables.items():
-            create_table_sql = f"CREATE TABLE IF NOT EXISTS {table_name} ("
-            create_table_sql += ", ".join([f"{col_name} {col_details}" for col_name, col_details in columns.items()])
-            create_table_sql += ");"
-            cursor.execute(create_table_sql)
-
-        # Check and add missing columns with defaults
-        for table_name, columns in tables.items():
-            cursor.execute(f"SHOW COLUMNS FROM {table_name};")
-            existing_columns = {column[0]: column[1] for column in cursor.fetchall()}
-            for col_name, col_details in columns.items():
-                if col_name not in existing_columns:
-                    alter_table_sql = f"ALTER TABLE {table_name} ADD COLUMN {col_name} {col_details};"
-                    cursor.execute(alter_table_sql)
-                    logger.error(f"Added missing column {col_name} with default to {table_name}")
-
-        connection.commit()
-        logger.info("Database tables and columns verified successfully.")
 
+# Check users.total_count against channeluser and repair any drift
+def check_user_totals():
+    query_logger.info("requests: check user totals")
+    try:
+        drifted = backend.check_user_totals()
+        if drifted:
+            logger.warning(f"{drifted} user totals drifted from channeluser and were repaired")
+            rank_index.clear()  # Reloaded from the repaired totals
+        return drifted
     except Exception as e:
-        logger.error(f"Failed to create or alter table: {e}")
-    finally:
-        close_connection(connection)
+        logger.error(f"Failed to check user totals: {e}")
+    return 0
 
 
 # Check if the channel is allowed
-async def is_channel_allowed(message):
-    """Check if the message channel is in the allowed channels list using the database."""
-    conn = create_connection()
-    if conn is None:
-        logger.error("Failed to connect to database when checking channel allowance.")
-        return False
+def is_channel_allowed(message):
+    """Check if the message channel is in the allowed channels list, using the database until it is loaded."""
+    if allowed_channels.loaded:
+        return message.channel.id in allowed_channels
 
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM channels WHERE channel_id = %s", (str(message.channel.id),))
-        return cursor.fetchone() is not None
+        return backend.channel_exists(message.channel.id)
     except Exception as e:
         logger.error(f"Database error when checking if channel is allowed: {e}")
         return False
-    finally:
-        close_connection(conn)
 
 
 # Add a channel to the database
 def update_count(channel_id, new_count, user_id):
-    logger.info(f"{channel_id} requests: update count to {new_count} for user {user_id}")
+    query_logger.info("%s requests: update count to %s for user %s", channel_id, new_count, user_id)
     """Update the count in the database for a given channel."""
 
-    connection = create_connection()
-    sql_string = '''
-        UPDATE channels
-        SET count = %s, last_user_id = %s
-        WHERE channel_id = %s
-    '''
+    # The ledger is the write path, compaction rolls the events into channels
+    if settings.LEDGER_MODE == 'source':
+        channel_cache.update(channel_id, count=new_count, last_user_id=user_id)
+        channel_cache.advance(channel_id, new_count)
+        return
+
+    if settings.WRITE_BEHIND_ENABLED:
+        channel_cache.update(channel_id, count=new_count, last_user_id=user_id)
+        channel_cache.advance(channel_id, new_count)
+        write_buffer.add_count(channel_id, new_count, user_id)
+        return
 
     try:
-        cur = connection.cursor()
-        cur.execute(sql_string, (new_count, user_id, channel_id))
-        connection.commit()
+        backend.update_count(channel_id, new_count, user_id)
+        channel_cache.update(channel_id, count=new_count, last_user_id=user_id)
+        channel_cache.advance(channel_id, new_count)
     except Exception as e:
         logger.error(f"Failed to update count: {e}")
         print(e)
-    finally:
-        close_connection(connection)
+
+
+# Load the ids of all counting channels into the allowlist
+def load_allowed_channels():
+    query_logger.info("requests: load allowed channels")
+    try:
+        allowed_channels.replace(backend.get_channel_ids())
+        logger.info(f"Loaded {len(allowed_channels)} allowed channels")
+    except Exception as e:
+        logger.error(f"Failed to load allowed channels: {e}")
 
 
 # Add a channel to the database
 def add_channel(channel_id):
-    logger.info(f"{channel_id} requests: add channel")
-    conn = create_connection()
-    sql = '''
-        INSERT INTO channels(channel_id, count, last_user_id, highscore)
-        VALUES(%s, 0, 0, 0)
-    '''
+    query_logger.info("%s requests: add channel", channel_id)
     try:
-        cur = conn.cursor()
-        cur.execute(sql, (channel_id,))
-        conn.commit()
+        backend.add_channel(channel_id)
+        allowed_channels.add(channel_id)
     except Exception as e:
         logger.error(f"Failed to add channel: {e}")
         print(e)
     finally:
-        close_connection(conn)
+        channel_cache.invalidate(channel_id)
 
 
 # Remove a channel from the database
 def remove_channel(channel_id):
-    logger.info(f"{channel_id} requests: remove channel")
-    conn = create_connection()
-    sql = '''
-        DELETE FROM channels
-        WHERE channel_id = %s
-    '''
+    query_logger.info("%s requests: remove channel", channel_id)
     try:
-        cur = conn.cursor()
-        cur.execute(sql, (channel_id,))
-        conn.commit()
+        # Under the flush lock, so a flush that already took the channel's writes commits them before the delete
+        with write_behind_flush_lock:
+            write_buffer.discard_channel(channel_id)
+            backend.remove_channel(channel_id)
+        allowed_channels.discard(channel_id)
     except Exception as e:
         logger.error(f"Failed to remove channel: {e}")
         print(e)
     finally:
-        close_connection(conn)
+        channel_cache.invalidate(channel_id)
 
 
 # Check a channel is in the database
 def check_channel(channel_id):
-    logger.info(f"{channel_id} requests: check channel")
-    conn = create_connection()
-    sql = '''
-        SELECT channel_id
-        FROM channels
-        WHERE channel_id = %s
-    '''
+    query_logger.info("%s requests: check channel", channel_id)
     try:
-        cur = conn.cursor()
-        cur.execute(sql, (channel_id,))
-        row = cur.fetchone()
-        if row:
-            return True
+        return backend.channel_exists(channel_id)
     except Exception as e:
         print(e)
-    finally:
-        close_connection(conn)
     return False  # Default to False if not found
 
 
 # Check a user is in the database
 def check_user(user_id):
-    logger.info(f"{user_id} requests: check user")
-    conn = create_connection()
-    sql = '''
-        SELECT user_id
-        FROM users WHERE
-        user_id = %s
-    '''
+    query_logger.info("%s requests: check user", user_id)
+    if int(user_id) in known_users:
+        return True
+
     try:
-        cur = conn.cursor()
-        cur.execute(sql, (user_id,))
-        row = cur.fetchone()
-        if row:
+        if backend.user_exists(user_id):
+            known_users.add(int(user_id))
             return True
     except Exception as e:
         print(e)
-    finally:
-        close_connection(conn)
     return False  # Default to False if not found
 
 
 # Add a user to the database
 def add_user(user_id):
-    logger.info(f"{user_id} requests: add user")
-    conn = create_connection()
-    sql = '''
-        INSERT INTO users(user_id)
-        VALUES(%s)
-    '''
+    query_logger.info("%s requests: add user", user_id)
     try:
-        cur = conn.cursor()
-        cur.execute(sql, (user_id,))
-        conn.commit()
+        backend.add_user(user_id)
+        known_users.add(int(user_id))
     except Exception as e:
         logger.error(f"Failed to add user: {e}")
         print(e)
-    finally:
-        close_connection(conn)
 
 
 # Update the count for a user in a channel, count is always + 1
 def update_user_count(channel_id, user_id):
-    logger.info(f"{channel_id} requests: update user count for {user_id}")
-    conn = create_connection()
+    query_logger.info("%s requests: update user count for %s", channel_id, user_id)
+    # The rank indexes are incremented once the count is written or buffered, see load_ranks
+    if settings.LEDGER_MODE == 'source':
+        rank_index.increment(int(channel_id), int(user_id))
+        return  # Compaction counts the correct events of the ledger
+
+    if settings.WRITE_BEHIND_ENABLED:
+        write_buffer.add_user_count(channel_id, user_id)
+        rank_index.increment(int(channel_id), int(user_id))
+        return
+
+    # Upserts the channeluser row and the user's total in one transaction, creating the user if needed
     try:
-        with conn.cursor() as cur:
-            # First, attempt to fetch the current count
-            select_sql = '''
-                SELECT count
-                FROM channeluser
-                WHERE user_id = %s AND channel_id = %s
-            '''
-            cur.execute(select_sql, (user_id, channel_id))
-            row = cur.fetchone()
-            cur.fetchall()  # Clear any remaining results from the cursor
-
-            if row:
-                new_count = row[0] + 1
-                update_sql = '''
-                    UPDATE channeluser
-                    SET count = %s
-                    WHERE user_id = %s AND channel_id = %s
-                '''
-                cur.execute(update_sql, (new_count, user_id, channel_id))
-            else:
-                insert_sql = '''
-                    INSERT INTO channeluser (user_id, channel_id, count)
-                    VALUES (%s, %s, 1)
-                '''
-                cur.execute(insert_sql, (user_id, channel_id))
-            conn.commit()
+        backend.increment_user_counts({(int(channel_id), int(user_id)): 1})
+        known_users.add(int(user_id))
+        rank_index.increment(int(channel_id), int(user_id))
     except Exception as e:
-        conn.rollback()
         logger.error(f"Failed to update user count: {e}")
         print(e)
-    finally:
-        close_connection(conn)
 
 
 # Get the highscore for a channel
 def get_highscore(channel_id):
-    logger.info(f"{channel_id} requests: get highscore")
-    """Retrieve the highscore for a given channel from the database."""
-    conn = create_connection()
-    sql = '''
-        SELECT highscore
-        FROM channels
-        WHERE channel_id = %s
-    '''
+    query_logger.info("%s requests: get highscore", channel_id)
+    """Retrieve the highscore for a given channel, served from the channel state cache."""
+    state = get_channel_state(channel_id)
+    if state:
+        return state['highscore']
+    return 0  # Default to 0 if not found
+
+
+# Get top highscores of all channels, 10 by default
+def get_top_channel_highscores(limit=10, after=None):
+    query_logger.info("requests: get top highscores after %s", after)
+    """Retrieve the top channels by highscore, after=(highscore, channel_id) of the previous page's last row."""
     try:
-        cur = conn.cursor()
-        cur.execute(sql, (channel_id,))
-        row = cur.fetchone()
-        if row:
-            return row[0]
+        return backend.get_top_channel_highscores(limit, after)
     except Exception as e:
-        print(e)
-    finally:
-        close_connection(conn)
-    return 0  # Default to 0 if not found
+        logger.error(f"Failed to get top channel highscores: {e}")
+    return None  # Failed, not an empty leaderboard
 
 
-# Get top 10 highscores of all channels
-def get_top_channel_highscores():
-    logger.info(f"requests: get top highscores")
-    """Retrieve the highscore for a given channel from the database."""
-    conn = create_connection()
-    sql = '''
-        SELECT channel_id, highscore
-        FROM channels
-        ORDER BY highscore
-        DESC LIMIT 10
-    '''
+# Get top user highscores of 1 channel, 10 by default
+def get_top_user_highscores(channel_id, limit=10, after=None):
+    query_logger.info("%s requests: get top user highscores after %s", channel_id, after)
+    """Retrieve the top users of a channel by count, after=(count, user_id) of the previous page's last row."""
     try:
-        cur = conn.cursor()
-        cur.execute(sql)
-        rows = cur.fetchall()
-        return rows
+        return backend.get_top_user_highscores(channel_id, limit, after)
     except Exception as e:
-        print(e)
-    finally:
-        close_connection(conn)
-    return []  # Default to 0 if not found
-
-
-# Get Top 10 User Highscores of 1 channel
-def get_top_user_highscores(channel_id):
-    logger.info(f"{channel_id} requests: get top user highscores")
-    """Retrieve the highscore for a given channel from the database."""
-    conn = create_connection()
-    sql = '''
-        SELECT user_id, count
-        FROM channeluser
-        WHERE channel_id = %s
-        ORDER BY count
-        DESC LIMIT 10
-    '''
+        logger.error(f"Failed to get top user highscores: {e}")
+    return None  # Failed, not an empty leaderboard
+
+
+# Get top users in all channels, 10 by default
+def get_top_users(limit=10, after=None):
+    query_logger.info("requests: get top users after %s", after)
+    """Retrieve the top users by total count, after=(total_count, user_id) of the previous page's last row."""
     try:
-        cur = conn.cursor()
-        cur.execute(sql, (channel_id,))
-        rows = cur.fetchall()
-        return rows
+        return backend.get_top_users(limit, after)
     except Exception as e:
-        print(e)
-    finally:
-        close_connection(conn)
-    return []  # Default to 0 if not found
-
-
-# Get top 10 users in all channels
-def get_top_users():
-    logger.info(f"requests: get top users")
-    """Retrieve the highscore for a given channel from the database."""
-    conn = create_connection()
-    sql = '''
-        SELECT user_id, SUM(count) as total_count 
-        FROM channeluser 
-        GROUP BY user_id 
-        ORDER BY total_count 
-        DESC LIMIT 10
-    '''
+        logger.error(f"Failed to get top users: {e}")
+    return None  # Failed, not an empty leaderboard
+
+
+# Load a rank index, the scope is None for all users or a channel id
+def load_ranks(scope):
+    """Return the loaded index, installed unless a newer load of the scope started meanwhile.
 
+    Everything counted before the load begins is flushed and part of the snapshot, everything counted after is
+    recorded by the rank indexes and applied to the snapshot. The flushes hold off the buffer threads until the
+    snapshot is read, so nothing recorded is also written into it. Only without buffering, a count whose write
+    commits between the start of the load and the snapshot is in both. In source mode the snapshot adds the ledger
+    events not compacted yet, which the live tables do not have.
+    """
+    generation = rank_index.begin_load(scope)
     try:
-        cur = conn.cursor()
-        cur.execute(sql)
-        rows = cur.fetchall()
-        return rows
+        with write_behind_flush_lock, ledger_flush_lock:
+            flush_write_behind()
+            flush_count_events()
+            include_ledger = settings.LEDGER_MODE == 'source'
+            with metrics.timer('rank_index_load_seconds', scope='users' if scope is None else 'channel'):
+                if scope is None:
+                    rows = backend.get_user_totals(include_ledger)
+                else:
+                    rows = backend.get_channel_user_counts(scope, include_ledger)
+        index = RankIndex(rows)
+    except Exception:
+        rank_index.abandon_load(scope, generation)
+        raise
+    rank_index.finish_load(scope, generation, index)
+    return index
+
+
+# Reload the rank index of all users, channel indexes are dropped and reloaded when they are ranked next
+def load_user_ranks():
+    query_logger.info("requests: load user ranks")
+    try:
+        index = load_ranks(None)
+        rank_index.clear_channels()
+        logger.info(f"Loaded the rank index of {len(index)} users")
+        return len(index)
     except Exception as e:
-        print(e)
-    finally:
-        close_connection(conn)
-    return []  # Default to 0 if not found
+        logger.error(f"Failed to load the user rank index: {e}")
+    return None
+
+
+# Get the rank of a user by total count
+def get_user_rank(user_id):
+    """Return (rank, total_count, ranked users) of a user, or None if the user has not counted yet."""
+    index = rank_index.users
+    if index is None:
+        query_logger.info("requests: load user ranks")
+        try:
+            index = load_ranks(None)
+        except Exception as e:
+            logger.error(f"Failed to load the user rank index: {e}")
+            return None
+    return rank_index.rank(index, int(user_id))
+
+
+# Get the rank of a user in a channel, the channel's index is loaded on first use
+def get_channel_rank(channel_id, user_id):
+    """Return (rank, count, ranked users) of a user in a channel, or None if the user has not counted there."""
+    index = rank_index.channel(int(channel_id))
+    if index is None:
+        query_logger.info("%s requests: load channel ranks", channel_id)
+        try:
+            index = load_ranks(int(channel_id))
+        except Exception as e:
+            logger.error(f"Failed to load the channel rank index: {e}")
+            return None
+    return rank_index.rank(index, int(user_id))
 
 
 # Update the highscore for a channel
 def update_highscore(channel_id, new_highscore):
-    logger.info(f"{channel_id} requests: update highscore to {new_highscore}")
-    conn = create_connection()
-
-    """Update the highscore in the database for a given channel."""
-    sql = '''
-        UPDATE channels
-        SET highscore = %s
-        WHERE channel_id = %s
-    '''
+    query_logger.info("%s requests: update highscore to %s", channel_id, new_highscore)
+    """Set the highscore of a channel, also when it is lower than the current one."""
+    highscore_at = int(time.time()) if new_highscore else 0
     try:
-        cur = conn.cursor()
-        cur.execute(sql, (new_highscore, channel_id))
-        conn.commit()
+        channel_cache.discard_dirty(channel_id)  # The raised highscore must not be written over this one
+        backend.update_highscore(channel_id, new_highscore, highscore_at)
+        channel_cache.update(channel_id, highscore=new_highscore, highscore_at=highscore_at, record=False)
     except Exception as e:
         logger.error(f"Failed to update highscore: {e}")
         print(e)
-    finally:
-        close_connection(conn)
-
 
-# update all highscores, if current count is higher than highscore, update highscore
-def update_all_highscores():
-    logger.info("Requests: Update all highscores")
-    conn = create_connection()
 
-    # Directly update the highscore in the database where count is greater than highscore
-    update_sql = '''
-        UPDATE channels
-        SET highscore = count
-        WHERE count > highscore;
-    '''
+# Write the highscores raised since the last call, only touching the channels that changed
+def flush_highscores():
+    """Write the dirty highscores in one statement. Returns the number of channels written."""
+    highscores = channel_cache.take_dirty()
+    if not highscores:
+        return 0
+    query_logger.info("requests: write %s highscores", len(highscores))
     try:
-        with conn:
-            cur = conn.cursor()
-            cur.execute(update_sql)
-            conn.commit()
-            logger.info(f"Updated highscores for {cur.rowcount} channels")
+        return backend.raise_highscores(highscores)
     except Exception as e:
-        logger.error(f"An error occurred: {e}")
-    finally:
-        close_connection(conn)
+        logger.error(f"Failed to write highscores: {e}")
+        channel_cache.mark_dirty(highscores)
+    return 0
 
 
 # Get the current count and last user ID for a channel
 def get_current_count(channel_id):
-    logger.info(f"{channel_id} requests: get current count")
-    """Retrieve the current count and last user ID for a given channel from the database."""
-    conn = create_connection()
-    sql = '''
-        SELECT count, last_user_id
-        FROM channels
-        WHERE channel_id = %s
-    '''
+    query_logger.info("%s requests: get current count", channel_id)
+    """Retrieve the current count and last user ID for a given channel, served from the channel state cache."""
+    state = get_channel_state(channel_id)
+    if state:
+        return state['count'], state['last_user_id']
+    return 0, None  # Default to 0 and None if not found
+
+
+# Get the cached state of a channel, loading it from the database on first touch
+def get_channel_state(channel_id):
+    """Return the cached count, last_user_id and highscore of a channel, or None if it is not a counting channel."""
+    state = channel_cache.get(channel_id)
+    if state is not None:
+        return state
+
+    query_logger.info("%s requests: load channel state", channel_id)
     try:
-        cur = conn.cursor()
-        cur.execute(sql, (channel_id,))
-        row = cur.fetchone()
+        row = backend.get_channel_state(channel_id)
         if row:
-            return row[0], row[1]
+            # A count still waiting in the write-behind buffer is newer than the stored one
+            count, last_user_id = write_buffer.pending_count(channel_id) or (row[0], row[1])
+            if settings.LEDGER_MODE == 'source':
+                # The stored count only covers the compacted events, the newest event of the channel decides
+                flush_count_events()
+                count, last_user_id = backend.get_uncompacted_count(channel_id) or (count, last_user_id)
+            channel_cache.set(channel_id, count, last_user_id, row[2], row[3])
+            return channel_cache.get(channel_id)
     except Exception as e:
-        print(e)
+        logger.error(f"Failed to load channel state: {e}")
+    return None  # Default to None if not found
+
+
+# Drop the cached state of a channel so the next read reloads it from the database
+def invalidate_channel_state(channel_id):
+    query_logger.info("%s requests: invalidate channel state", channel_id)
+    if int(channel_id) in channel_cache.dirty:
+        flush_highscores()  # A raised highscore would be lost with the cached state
+    channel_cache.invalidate(channel_id)
+
+
+# Flush the write-behind buffer to the database in a single transaction
+def flush_write_behind():
+    with write_behind_flush_lock:
+        counts, user_counts = write_buffer.take()
+        if not counts and not user_counts:
+            return
+        query_logger.info("requests: flush %s channel counts and %s user counts", len(counts), len(user_counts))
+
+        try:
+            with metrics.timer('write_behind_flush_seconds'):
+                backend.write_batch(counts, user_counts)
+            known_users.update(user_id for _, user_id in user_counts)
+        except Exception as e:
+            logger.error(f"Failed to flush buffered writes: {e}")
+            write_buffer.restore(counts, user_counts)
+
+
+# Append a counted message to the ledger, written in batches by the ledger buffer
+def record_count_event(channel_id, user_id, message_id, number, outcome):
+    if settings.LEDGER_MODE == 'off':
+        return
+    if not isinstance(number, int) or not -2 ** 63 <= number < 2 ** 63:
+        number = None  # Does not fit the column, the outcome still tells what happened
+    event_buffer.add((int(channel_id), int(user_id), int(message_id), number, outcome, int(time.time() * 1000)))
+
+
+# Write the buffered ledger events with one multi-row insert
+def flush_count_events():
+    with ledger_flush_lock:
+        events = event_buffer.take()
+        if not events:
+            return
+        query_logger.info("requests: append %s count events", len(events))
+
+        try:
+            with metrics.timer('ledger_flush_seconds'):
+                backend.insert_count_events(events)
+        except Exception as e:
+            logger.error(f"Failed to append count events: {e}")
+            event_buffer.restore(events)
+
+
+# Fold new ledger events into the aggregates, and into the live tables when the ledger is the write path
+def compact_count_events(settle_seconds=None):
+    """Compact in batches of LEDGER_COMPACT_BATCH events until the ledger is caught up. Returns the number of events.
+
+    Events younger than `settle_seconds` (LEDGER_SETTLE_SECONDS by default) wait for the next compaction.
+    """
+    query_logger.info("requests: compact count events")
+    bucket_ms = int(settings.LEDGER_BUCKET_MINUTES * 60 * 1000)
+    if settle_seconds is None:
+        settle_seconds = settings.LEDGER_SETTLE_SECONDS
+    before_ms = int((time.time() - settle_seconds) * 1000)
+    total = 0
+    try:
+        with compaction_lock, metrics.timer('ledger_compaction_seconds'):
+            while True:
+                compacted = backend.compact_count_events(settings.LEDGER_COMPACT_BATCH, bucket_ms,
+                                                         apply=settings.LEDGER_MODE == 'source',
+                                                         before_ms=before_ms)
+                total += compacted
+                if compacted < settings.LEDGER_COMPACT_BATCH:
+                    break
+        if total:
+            logger.info(f"Compacted {total} count events")
+    except Exception as e:
+        logger.error(f"Failed to compact count events: {e}")
+    return total
+
+
+# Rebuild channels, channeluser, the user totals and the aggregates from the ledger
+def rebuild_from_ledger():
+    logger.warning("Rebuilding the live tables from the ledger")
+    flush_write_behind()
+    flush_count_events()
+    bucket_ms = int(settings.LEDGER_BUCKET_MINUTES * 60 * 1000)
+    try:
+        with compaction_lock:
+            replayed = backend.rebuild_from_ledger(settings.LEDGER_COMPACT_BATCH, bucket_ms)
+        logger.warning(f"Rebuilt the live tables from {replayed} count events")
+        return replayed
+    except Exception as e:
+        logger.error(f"Failed to rebuild from the ledger: {e}")
+        return None
     finally:
-        close_connection(conn)
-    return 0, None  # Default to 0 and None if not found
+        # Whatever is cached predates the rebuild
+        channel_cache.clear()
+        known_users.clear()
+        rank_index.clear()
+
+
+# Delete compacted ledger events older than LEDGER_RETENTION_DAYS, 0 keeps them forever
+def prune_count_events():
+    if not settings.LEDGER_RETENTION_DAYS:
+        return 0
+    query_logger.info("requests: prune count events")
+    try:
+        before_ms = int((time.time() - settings.LEDGER_RETENTION_DAYS * 86400) * 1000)
+        pruned = backend.prune_count_events(before_ms)
+        if pruned:
+            logger.info(f"Pruned {pruned} count events")
+        return pruned
+    except Exception as e:
+        logger.error(f"Failed to prune count events: {e}")
+    return 0
+
+
+# Store the guild of counting channels, rows are (channel_id, guild_id, guild_name)
+def upsert_channel_guilds(rows):
+    rows = list(rows)
+    if not rows:
+        return
+    query_logger.info("requests: upsert %s channel guilds", len(rows))
+    try:
+        backend.upsert_channel_guilds(rows)
+    except Exception as e:
+        logger.error(f"Failed to upsert channel guilds: {e}")
+
+
+# Get the guild names of many channels at once, returns {channel_id: guild_name} for the known ones
+def get_channel_guild_names(channel_ids):
+    channel_ids = [int(channel_id) for channel_id in channel_ids]
+    if not channel_ids:
+        return {}
+    query_logger.info("requests: get guild names of %s channels", len(channel_ids))
+    try:
+        return backend.get_channel_guild_names(channel_ids)
+    except Exception as e:
+        logger.error(f"Failed to get channel guild names: {e}")
+    return {}  # Default to no names if not found
+
+
+# Get the stored guild of every counting channel, returns {channel_id: (guild_id, guild_name)}
+def get_channel_guilds():
+    query_logger.info("requests: get channel guilds")
+    try:
+        return backend.get_channel_guilds()
+    except Exception as e:
+        logger.error(f"Failed to get channel guilds: {e}")
+    return {}
+
+
+# Rename a guild for all of its channels
+def update_guild_name(guild_id, guild_name):
+    query_logger.info("%s requests: update guild name", guild_id)
+    try:
+        backend.update_guild_name(guild_id, guild_name)
+    except Exception as e:
+        logger.error(f"Failed to update guild name: {e}")
+
+
+# Remove the stored guild of channels that were deleted
+def delete_channel_guilds(channel_ids):
+    channel_ids = [int(channel_id) for channel_id in channel_ids]
+    if not channel_ids:
+        return
+    query_logger.info("requests: delete %s channel guilds", len(channel_ids))
+    try:
+        backend.delete_channel_guilds(channel_ids)
+    except Exception as e:
+        logger.error(f"Failed to delete channel guilds: {e}")
+
+
+# Remove the stored guild of channels that are no longer counting channels
+def prune_channel_guilds():
+    query_logger.info("requests: prune channel guilds")
+    try:
+        return backend.prune_channel_guilds()
+    except Exception as e:
+        logger.error(f"Failed to prune channel guilds: {e}")
+    return 0
@@ -1,55 +1,366 @@
-import ast
+import asyncio
 import operator
 import math
+import re
+import multiprocessing
+from collections import OrderedDict
+import helper.metrics as metrics
+import settings
+
+
+class EvalLimitError(ValueError):
+    """Raised when an expression exceeds one of the evaluation budgets in the settings."""
+
+
+# Binary operators with their binding power, ** binds tighter than unary minus and is right associative
+binary_operators = {
+    '+': (10, operator.add),  # Addition
+    '-': (10, operator.sub),  # Subtraction
+    '*': (20, operator.mul),  # Multiplication
+    '/': (20, operator.truediv),  # True division
+    '**': (40, operator.pow),  # Power operator
+}
+UNARY_MINUS_POWER = 30
+
+# Use lower case for all function and constant names
+allowed_functions = {
+    'sin': math.sin,  # Trigonometric functions
+    'cos': math.cos,  # Trigonometric functions
+    'tan': math.tan,  # Trigonometric functions
+    'log': math.log,  # Natural logarithm
+    'log10': math.log10,  # Base 10 logarithm
+    'sqrt': math.sqrt,  # Square root
+    'exp': math.exp,  # Exponential function
+    'pi': math.pi,  # Math constant pi
+    'e': math.e,  # Math constant e
+}
+
+# Characters that can appear in a supported expression
+expression_characters = re.compile(r'[0-9A-Za-z_+\-*/().,\s]+')
+
+# Names in an expression, skipping letters that belong to number literals like 1e3
+expression_names = re.compile(r'(?<![\w.])[A-Za-z_]\w*')
+
+# Tokens of the counting grammar: numbers, names, operators and parentheses
+token_pattern = re.compile(r'''
+    \s*(?:
+        (?P<number>(?:\d[\d_]*(?:\.[\d_]*)?|\.\d[\d_]*)(?:[eE][+-]?\d+)?)
+      | (?P<name>[A-Za-z_]\w*)
+      | (?P<op>\*\*|[-+*/(),])
+    )''', re.VERBOSE)
+
+# Worker processes for the optional wall-clock cap, created on first use
+worker_pool = None
 
 
 def safe_eval(expr):
-    allowed_operators = {
-        ast.Add: operator.add,  # Addition
-        ast.Sub: operator.sub,  # Subtraction
-        ast.Mult: operator.mul,  # Multiplication
-        ast.Div: operator.truediv,  # True division
-        ast.Pow: operator.pow,  # Power operator
-        ast.USub: operator.neg,  # Unary minus
-    }
-
-    # Use lower case for all function and constant names
-    allowed_functions = {
-        'sin': math.sin,  # Trigonometric functions
-        'cos': math.cos,  # Trigonometric functions
-        'tan': math.tan,  # Trigonometric functions
-        'log': math.log,  # Natural logarithm
-        'log10': math.log10,  # Base 10 logarithm
-        'sqrt': math.sqrt,  # Square root
-        'exp': math.exp,  # Exponential function
-        'pi': math.pi,  # Math constant pi
-        'e': math.e,  # Math constant e
-    }
-
-    def eval_(node):
-        if isinstance(node, ast.Expression):
-            return eval_(node.body)
-        elif isinstance(node, ast.Num):
-            return node.n
-        elif isinstance(node, ast.UnaryOp):
-            return allowed_operators[type(node.op)](eval_(node.operand))
-        elif isinstance(node, ast.BinOp):
-            return allowed_operators[type(node.op)](eval_(node.left), eval_(node.right))
-        elif isinstance(node, ast.Name):
-            # Normalize the name to lower case before checking
-            normalized_name = node.id.lower()
-            if normalized_name in allowed_functions:
-                return allowed_functions[normalized_name]
-        elif isinstance(node, ast.Call):
-            # Normalize function name to lower case before checking
-            normalized_func_name = node.func.id.lower()
-            if normalized_func_name in allowed_functions:
-                arguments = [eval_(arg) for arg in node.args]
-                return allowed_functions[normalized_func_name](*arguments)
-        raise TypeError(f"Unsupported type or operation: {type(node)}")
-
-    tree = ast.parse(expr, mode='eval')
-    return eval_(tree.body)
+    # Fast path for plain integer literals like "4821", most counting messages are one
+    if is_integer_literal(expr):
+        return int(expr)
+
+    # Cheap lexical prefilter, rejects chat text before any parsing
+    if not is_expression(expr):
+        raise ValueError(f"Not a math expression: {expr!r}")
+
+    return evaluate(expr)
+
+
+async def safe_eval_async(expr):
+    """Evaluate like safe_eval, running suspicious expressions in a worker process under EVAL_TIMEOUT_SECONDS.
+
+    Only expressions that pass the prefilter and are not cached yet are sent to a worker, and its result is cached.
+    """
+    if is_integer_literal(expr):
+        return int(expr)
+    if not is_expression(expr):
+        raise ValueError(f"Not a math expression: {expr!r}")
+    if not settings.EVAL_TIMEOUT_SECONDS or not is_suspicious(expr):
+        return evaluate(expr)
+
+    value = evaluation_cache.get(expr)
+    if value is not None:
+        return value
+
+    global worker_pool
+    if worker_pool is None:
+        worker_pool = EvalWorkerPool(settings.EVAL_WORKERS)
+    value = await worker_pool.evaluate(expr, settings.EVAL_TIMEOUT_SECONDS)
+    evaluation_cache.put(expr, value)
+    return value
+
+
+# Entry point of an evaluation worker process, answers every expression with (True, value) or (False, error)
+def serve_evaluations(connection):
+    while True:
+        try:
+            expr = connection.recv()
+        except (EOFError, OSError):
+            return  # The bot closed the pipe
+        try:
+            connection.send((True, safe_eval(expr)))
+        except Exception as e:
+            connection.send((False, e))
+
+
+class EvalWorker:
+    """One evaluation worker process and the pipe to it."""
+
+    def __init__(self):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve_evaluations, args=(child_connection,), daemon=True)
+        self.process.start()
+        child_connection.close()
+
+    def evaluate(self, expr, timeout):
+        """Blocking, returns (ok, value or error) or raises TimeoutError if the worker did not answer in time."""
+        self.connection.send(expr)
+        if not self.connection.poll(timeout):
+            raise TimeoutError
+        return self.connection.recv()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class EvalWorkerPool:
+    """Up to `size` worker processes, each evaluating one expression at a time.
+
+    A running evaluation cannot be interrupted, so a worker that takes too long is killed and replaced on the next
+    evaluation. Only that worker is affected, evaluations running in the other workers carry on.
+    """
+
+    def __init__(self, size):
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+
+    async def evaluate(self, expr, timeout):
+        async with self.slots:
+            worker = self.idle.pop() if self.idle else EvalWorker()
+            try:
+                # The pipe is waited on in a thread, so the event loop keeps running
+                ok, value = await asyncio.get_running_loop().run_in_executor(None, worker.evaluate, expr, timeout)
+            except TimeoutError:
+                worker.kill()
+                raise EvalLimitError(f"Evaluation took longer than {timeout} seconds: {expr!r}")
+            except BaseException:
+                # Cancelled or the worker died, its answer could still arrive and be read by the next evaluation
+                worker.kill()
+                raise
+            self.idle.append(worker)
+
+        if not ok:
+            raise value
+        return value
+
+
+def is_integer_literal(expr):
+    return expr.isdigit() and expr.isascii() and (expr[0] != '0' or len(expr) == 1)
+
+
+def is_suspicious(expr):
+    """Powers and function calls are the only operations that can get expensive."""
+    return '**' in expr or '(' in expr and any(c.isalpha() for c in expr)
+
+
+def is_expression(expr):
+    """Check that an expression only uses supported characters and names."""
+    if not expression_characters.fullmatch(expr):
+        return False
+    return all(name.lower() in allowed_functions for name in expression_names.findall(expr))
+
+
+class EvaluationCache:
+    """LRU cache of the values of the `maxsize` most recently evaluated expressions, in this process or a worker."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, expr):
+        """Return the cached value of an expression, or None if it is not cached."""
+        value = self.values.get(expr)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.values.move_to_end(expr)
+        return value
+
+    def put(self, expr, value):
+        self.values[expr] = value
+        self.values.move_to_end(expr)
+        while len(self.values) > self.maxsize:
+            self.values.popitem(last=False)
+
+
+# Evaluated expressions are cached, a message is evaluated again on every edit and delete
+evaluation_cache = EvaluationCache(settings.EVAL_CACHE_SIZE)
+
+
+def evaluate(expr):
+    value = evaluation_cache.get(expr)
+    if value is None:
+        value = compile_expression(expr)()
+        check_real(value)
+        evaluation_cache.put(expr, value)
+    return value
+
+
+# Expose the cache statistics with the other metrics
+metrics.register_collector(lambda: [
+    ('eval_cache_hits_total', {}, evaluation_cache.hits),
+    ('eval_cache_misses_total', {}, evaluation_cache.misses),
+])
+
+
+def tokenize(expr):
+    """Split an expression into (kind, text) tokens, raising SyntaxError on anything else."""
+    tokens = []
+    position = 0
+    end = len(expr.rstrip())
+    while position < end:
+        match = token_pattern.match(expr, position)
+        if match is None:
+            raise SyntaxError(f"Unexpected character at position {position}: {expr!r}")
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        position = match.end()
+    return tokens
+
+
+def parse_number(text):
+    try:
+        if '.' in text or 'e' in text or 'E' in text:
+            return float(text)
+        if text[0] == '0' and len(text) > 1:
+            raise SyntaxError(f"Leading zeros are not allowed: {text!r}")
+        return int(text)
+    except ValueError:
+        raise SyntaxError(f"Invalid number: {text!r}")
+
+
+def compile_expression(expr):
+    """Parse an expression with precedence climbing and compile it into a closure returning its value."""
+    return Parser(tokenize(expr)).parse()
+
+
+class Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+        self.nodes = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise SyntaxError("Unexpected end of expression")
+        self.position += 1
+        return token
+
+    def expect(self, text):
+        kind, token = self.next()
+        if token != text or kind != 'op':
+            raise SyntaxError(f"Expected {text!r} but got {token!r}")
+
+    def count_node(self):
+        self.nodes += 1
+        if self.nodes > settings.EVAL_MAX_NODES:
+            raise EvalLimitError(f"Expression has more than {settings.EVAL_MAX_NODES} nodes")
+
+    def parse(self):
+        node = self.expression(0)
+        if self.position != len(self.tokens):
+            raise SyntaxError(f"Unexpected token {self.tokens[self.position][1]!r}")
+        return node
+
+    def expression(self, min_power):
+        left = self.prefix()
+        while True:
+            kind, token = self.peek()
+            if kind != 'op' or token not in binary_operators:
+                return left
+            power, function = binary_operators[token]
+            if power <= min_power:
+                return left
+            self.next()
+            self.count_node()
+            # ** is right associative, the others are left associative
+            right = self.expression(power - 1 if token == '**' else power)
+            left = binary(token, function, left, right)
+
+    def prefix(self):
+        self.count_node()
+        kind, token = self.next()
+        if kind == 'number':
+            value = parse_number(token)
+            return lambda: value
+        if kind == 'name':
+            return self.name(token.lower())
+        if token == '-':
+            operand = self.expression(UNARY_MINUS_POWER)
+            return lambda: -operand()
+        if token == '(':
+            node = self.expression(0)
+            self.expect(')')
+            return node
+        raise SyntaxError(f"Unexpected token {token!r}")
+
+    def name(self, name):
+        if name not in allowed_functions:
+            raise TypeError(f"Unsupported name: {name}")
+        value = allowed_functions[name]
+        if not callable(value):
+            return lambda: value
+
+        # Functions have to be called, with comma separated arguments
+        self.expect('(')
+        arguments = [self.expression(0)]
+        while self.peek() == ('op', ','):
+            self.next()
+            arguments.append(self.expression(0))
+        self.expect(')')
+        return lambda: value(*[argument() for argument in arguments])
+
+
+def binary(token, function, left, right):
+    """Build the closure of a binary operation, checking the budgets before computing it."""
+    def node():
+        left_value, right_value = left(), right()
+        check_operands(token, left_value, right_value)
+        result = function(left_value, right_value)
+        check_real(result)
+        return result
+    return node
+
+
+def check_real(value):
+    """Reject complex values, e.g. from (-1)**0.5, counting and the budgets only work with real numbers."""
+    if isinstance(value, complex):
+        raise EvalLimitError("Expression has a complex value")
+
+
+def check_operands(token, left, right):
+    """Reject an operation before computing it if its operands or result would exceed the budgets."""
+    for operand in (left, right):
+        if isinstance(operand, (int, float)) and abs(operand) > settings.EVAL_MAX_OPERAND:
+            raise EvalLimitError(f"Operand is larger than {settings.EVAL_MAX_OPERAND}")
+
+    if token == '**' and isinstance(right, (int, float)):
+        if abs(right) > settings.EVAL_MAX_EXPONENT:
+            raise EvalLimitError(f"Exponent is larger than {settings.EVAL_MAX_EXPONENT}")
+        if isinstance(left, int) and right > 0 and abs(left).bit_length() * right > settings.EVAL_MAX_RESULT_BITS:
+            raise EvalLimitError(f"Result would be longer than {settings.EVAL_MAX_RESULT_BITS} bits")
+    elif token == '*' and isinstance(left, int) and isinstance(right, int):
+        if abs(left).bit_length() + abs(right).bit_length() > settings.EVAL_MAX_RESULT_BITS:
+            raise EvalLimitError(f"Result would be longer than {settings.EVAL_MAX_RESULT_BITS} bits")
 
 
 # Examples
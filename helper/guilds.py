@@ -0,0 +1,70 @@
+from collections import OrderedDict
+import helper.async_database as db
+import settings
+
+# Configure logging for guild resolution
+logger = settings.logging.getLogger("database")
+
+UNKNOWN_GUILD = "Unknown Server"
+
+
+class GuildNameResolver:
+    """Resolves counting channels to the name of their guild without any per-row Discord API calls.
+
+    Names come from memory, then from one bulk query of the channel_guilds table, then from the bot's own
+    channel cache, and finally fall back to UNKNOWN_GUILD. Memory keeps the `max_names` most recently used names.
+    """
+
+    def __init__(self, max_names):
+        self.max_names = max_names
+        self.names = OrderedDict()
+
+    async def resolve(self, bot, channel_ids):
+        """Return {channel_id: guild_name} for all given channel ids."""
+        channel_ids = [int(channel_id) for channel_id in channel_ids]
+        missing = [channel_id for channel_id in channel_ids if channel_id not in self.names]
+        stored = await db.get_channel_guild_names(missing) if missing else {}
+
+        resolved = {}
+        learned = []
+        for channel_id in channel_ids:
+            name = stored.get(channel_id)
+            if name is None:
+                name = self.names.get(channel_id)
+            if name is None:
+                channel = bot.get_channel(channel_id)
+                if channel is not None:
+                    name = channel.guild.name
+                    learned.append((channel_id, channel.guild.id, name))
+            if name is not None:
+                self.store(channel_id, name)
+            resolved[channel_id] = name if name is not None else UNKNOWN_GUILD
+
+        # Persist what the bot cache knew, so other shards and processes can resolve it as well
+        if learned:
+            await db.upsert_channel_guilds(learned)
+        return resolved
+
+    def store(self, channel_id, guild_name):
+        self.names[channel_id] = guild_name
+        self.names.move_to_end(channel_id)
+        while len(self.names) > self.max_names:
+            self.names.popitem(last=False)
+
+    def remember(self, rows):
+        for channel_id, _, guild_name in rows:
+            self.store(int(channel_id), guild_name)
+
+    def rename_guild(self, channel_ids, guild_name):
+        # Only names still in memory are renamed, the others are read from the updated table when needed
+        for channel_id in channel_ids:
+            if int(channel_id) in self.names:
+                self.names[int(channel_id)] = guild_name
+
+    def forget(self, channel_ids):
+        for channel_id in channel_ids:
+            self.names.pop(int(channel_id), None)
+
+
+# Initialize the guild name resolver
+resolver = GuildNameResolver(settings.GUILD_NAME_CACHE_SIZE)
@@ -0,0 +1,94 @@
+import asyncio
+import time
+import helper.async_database as db
+import helper.metrics as metrics
+import settings
+
+
+class LeaderboardService:
+    """TTL cache in front of the leaderboard queries.
+
+    Every page of every board is cached for `ttl` seconds. Concurrent requests for a page that is being loaded
+    share the one query in flight instead of starting their own (single-flight).
+    """
+
+    def __init__(self, ttl, page_size, max_entries=1024):
+        self.ttl = ttl
+        self.page_size = page_size
+        self.max_entries = max_entries
+        self.entries = {}
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get_page(self, board, channel_id=None, after=None):
+        """Return (rows, has_more) of one page of a board ("all servers", "all users" or "current channel")."""
+        key = (board, channel_id, after)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.ensure_future(self.load(key))
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # Shielded so a cancelled command does not cancel the query other commands are waiting for
+        return await asyncio.shield(task)
+
+    async def load(self, key):
+        board, channel_id, after = key
+        # One row more than a page tells whether there is a next page
+        limit = self.page_size + 1
+        if board == "all servers":
+            rows = await db.get_top_channel_highscores(limit=limit, after=after)
+        elif board == "all users":
+            rows = await db.get_top_users(limit=limit, after=after)
+        elif board == "current channel":
+            rows = await db.get_top_user_highscores(channel_id, limit=limit, after=after)
+        else:
+            raise ValueError(f"Unknown leaderboard: {board}")
+        if rows is None:
+            # The query failed, raised instead of caching an empty page for the whole TTL
+            raise RuntimeError("The leaderboard could not be loaded, please try again later")
+
+        page = (rows[:self.page_size], len(rows) > self.page_size)
+        self.store(key, page)
+        return page
+
+    def store(self, key, page):
+        if len(self.entries) >= self.max_entries:
+            # Drop expired pages first, then the oldest ones
+            now = time.monotonic()
+            for expired in [k for k, (expires, _) in self.entries.items() if expires <= now]:
+                del self.entries[expired]
+            while len(self.entries) >= self.max_entries:
+                del self.entries[next(iter(self.entries))]
+        self.entries[key] = (time.monotonic() + self.ttl, page)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'inflight': len(self.inflight),
+        }
+
+
+# Cursor for the page after the given rows, (score, id) of the last row
+def next_cursor(rows):
+    row_id, score = rows[-1]
+    return score, row_id
+
+
+# Initialize the leaderboard service
+service = LeaderboardService(settings.LEADERBOARD_TTL_SECONDS, settings.LEADERBOARD_PAGE_SIZE)
+
+# Expose the cache statistics with the other metrics
+metrics.register_collector(lambda: [
+    ('leaderboard_cache_hits_total', {}, service.hits),
+    ('leaderboard_cache_misses_total', {}, service.misses),
+    ('leaderboard_cache_entries', {}, len(service.entries)),
+    ('leaderboard_cache_inflight', {}, len(service.inflight)),
+])
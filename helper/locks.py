@@ -0,0 +1,32 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class KeyedLock:
+    """A set of asyncio locks keyed by id (e.g. a channel id).
+
+    Holders of the same key run one after another in arrival order, different keys run concurrently.
+    Locks are created on first use and dropped again once nobody holds or waits for them.
+    """
+
+    def __init__(self):
+        self.locks = {}
+        self.waiters = {}
+
+    @asynccontextmanager
+    async def acquire(self, key):
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        self.waiters[key] = self.waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.waiters[key] -= 1
+            if self.waiters[key] == 0:
+                del self.waiters[key]
+                del self.locks[key]
+
+    def __len__(self):
+        return len(self.locks)
@@ -0,0 +1,108 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
+
+# Imported by settings.py to build the logging pipeline, so this module must not import settings itself
+
+
+class SamplingFilter(logging.Filter):
+    """Let through every record at WARNING and above and a random `rate` share of the others."""
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = float(rate)
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket letting through at most `per_second` records below WARNING, with bursts of up to `burst`.
+
+    The first record after some were dropped reports how many, a `per_second` of 0 disables the limit.
+    """
+
+    def __init__(self, per_second=0, burst=None):
+        super().__init__()
+        self.per_second = float(per_second)
+        self.burst = float(burst or max(self.per_second, 1))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.per_second or record.levelno >= logging.WARNING:
+            return True
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.per_second)
+            self.updated = now
+            if self.tokens < 1:
+                self.dropped += 1
+                return False
+            self.tokens -= 1
+            dropped, self.dropped = self.dropped, 0
+
+        if dropped and isinstance(record.args, tuple):
+            record.msg = f"{record.msg} (%d earlier records dropped)"
+            record.args = record.args + (dropped,)
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that leaves formatting to the writer thread.
+
+    The stock QueueHandler formats the message in the logging thread, here the record is queued as it is,
+    so a %-style call only costs the record creation on the event loop.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class RoutingQueueListener(logging.handlers.QueueListener):
+    """Writer thread handing every record to the handlers configured for its logger (or closest parent)."""
+
+    def __init__(self, log_queue, routes):
+        super().__init__(log_queue)
+        self.routes = routes
+
+    def handle(self, record):
+        name = record.name
+        while name not in self.routes and '.' in name:
+            name = name.rsplit('.', 1)[0]
+        for handler in self.routes.get(name, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+# Move the handlers of the configured loggers behind one queue written by a background thread
+def start_queue_logging(logger_names):
+    """Replace the handlers of the given loggers with a queue handler and start the writer thread."""
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    routes = {}
+    for name in logger_names:
+        logger = logging.getLogger(name)
+        if logger.handlers:
+            routes[name] = list(logger.handlers)
+            for handler in routes[name]:
+                logger.removeHandler(handler)
+            logger.addHandler(queue_handler)
+
+    listener = RoutingQueueListener(log_queue, routes)
+    listener.start()
+
+    # Write out the queued records and close the files at exit
+    def stop():
+        listener.stop()
+        for handler in {handler for handlers in routes.values() for handler in handlers}:
+            handler.close()
+    atexit.register(stop)
+    return listener
@@ -0,0 +1,225 @@
+import asyncio
+import bisect
+import threading
+import time
+import settings
+
+# Setup the logger
+logger = settings.logging.getLogger('bot')
+
+# Upper bounds of the latency histogram buckets in seconds, from cache hits to stuck queries
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Type and help of the metrics, exposed in the # HELP and # TYPE lines
+DESCRIPTIONS = {
+    'database_query_seconds': ('histogram', "Time spent in a helper.database function, by function."),
+    'database_executor_wait_seconds': ('histogram', "Time a database call waited for a free executor thread."),
+    'database_pool_wait_seconds': ('histogram', "Time spent checking out a connection from the pool."),
+    'database_connections_in_use': ('gauge', "Connections currently checked out of the pool."),
+    'write_behind_flush_seconds': ('histogram', "Time spent flushing the write-behind buffer."),
+    'write_behind_pending_ops': ('gauge', "Updates waiting in the write-behind buffer."),
+    'on_message_seconds': ('histogram', "End-to-end on_message latency of counted messages, by outcome."),
+    'on_message_stage_seconds': ('histogram', "on_message latency by stage: lock, allowlist, eval, db, discord."),
+    'command_seconds': ('histogram', "Slash command latency, by command and status."),
+    'outbox_wait_seconds': ('histogram', "Time an outbound Discord action waited in the queue, by kind."),
+    'outbox_send_seconds': ('histogram', "Time spent sending an outbound Discord action, by kind."),
+    'outbox_pending': ('gauge', "Outbound Discord actions waiting in the queue."),
+    'outbox_in_flight': ('gauge', "Outbound Discord actions being sent."),
+    'outbox_sent_total': ('counter', "Outbound Discord actions sent."),
+    'outbox_dropped_total': ('counter', "Stale reactions dropped from the outbound queue."),
+    'outbox_failed_total': ('counter', "Outbound Discord actions that failed."),
+    'ledger_flush_seconds': ('histogram', "Time spent appending buffered events to the ledger."),
+    'ledger_compaction_seconds': ('histogram', "Time spent compacting the ledger."),
+    'ledger_pending_events': ('gauge', "Events waiting in the ledger buffer."),
+    'recent_messages_channels': ('gauge', "Channels with accepted messages in the recent message index."),
+    'recent_messages_entries': ('gauge', "Accepted messages in the recent message index."),
+    'rank_index_load_seconds': ('histogram', "Time spent loading a rank index from the database, by scope."),
+    'rank_index_users': ('gauge', "Users in the rank index of all users."),
+    'rank_index_channels': ('gauge', "Channels with a loaded rank index."),
+    'eval_cache_hits_total': ('counter', "safe_eval LRU cache hits."),
+    'eval_cache_misses_total': ('counter', "safe_eval LRU cache misses."),
+    'leaderboard_cache_hits_total': ('counter', "Leaderboard pages served from the cache."),
+    'leaderboard_cache_misses_total': ('counter', "Leaderboard pages loaded from the database."),
+    'leaderboard_cache_entries': ('gauge', "Leaderboard pages in the cache."),
+    'leaderboard_cache_inflight': ('gauge', "Leaderboard pages being loaded."),
+}
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets, safe to observe from the database threads."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket it falls into."""
+        counts, _, count = self.snapshot()
+        rank, seen = q * count, 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Timer:
+    """Context manager that observes the time spent in its block."""
+
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+    """Histograms and gauges by (name, labels), plus collectors that report values owned by other modules."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.gauges = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def histogram(self, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def add(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def samples(self):
+        """Return every (name, labels, value) of the gauges and collectors."""
+        with self.lock:
+            samples = [(name, labels, value) for (name, labels), value in self.gauges.items()]
+        for collector in self.collectors:
+            try:
+                samples.extend((name, tuple(sorted(labels.items())), value) for name, labels, value in collector())
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {e}")
+        return samples
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format."""
+        families = {}
+        for (name, labels), histogram in list(self.histograms.items()):
+            families.setdefault(name, []).append((labels, histogram))
+        for name, labels, value in self.samples():
+            families.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(families):
+            kind, description = DESCRIPTIONS.get(name, ('gauge', name))
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in families[name]:
+                if isinstance(value, Histogram):
+                    counts, total, count = value.snapshot()
+                    cumulative = 0
+                    for bound, bucket_count in zip(value.buckets + ('+Inf',), counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                    lines.append(f"{name}_count{format_labels(labels)} {count}")
+                else:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+# Record a latency in the histogram of the given name and labels
+def observe(name, seconds, **labels):
+    if settings.METRICS_ENABLED:
+        registry.histogram(name, labels).observe(seconds)
+
+
+# Time a block into the histogram of the given name and labels
+def timer(name, **labels):
+    return Timer(name, labels)
+
+
+# Add to a gauge, negative values to decrease it
+def add(name, value, **labels):
+    if settings.METRICS_ENABLED:
+        registry.add(name, value, labels)
+
+
+# Register a function returning (name, labels, value) samples, read every time the metrics are rendered
+def register_collector(collector):
+    registry.collectors.append(collector)
+
+
+# Answer HTTP requests for /metrics with the rendered metrics, anything else with 404
+async def handle_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+            pass  # Headers are not needed
+
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = "200 OK", registry.render().encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.error(f"Failed to answer metrics request: {e}")
+    finally:
+        writer.close()
+
+
+# Start the metrics endpoint once, on METRICS_HOST:METRICS_PORT, a port of 0 disables it
+async def start_server():
+    global server
+    if server is not None or not settings.METRICS_ENABLED or not settings.METRICS_PORT:
+        return
+    try:
+        server = await asyncio.start_server(handle_request, settings.METRICS_HOST, settings.METRICS_PORT)
+        logger.info(f"Serving metrics on http://{settings.METRICS_HOST}:{settings.METRICS_PORT}/metrics")
+    except OSError as e:
+        logger.error(f"Failed to start the metrics endpoint: {e}")
+
+
+# Initialize the registry, the endpoint is started by on_ready
+registry = Registry()
+server = None
@@ -0,0 +1,172 @@
+import asyncio
+import heapq
+import itertools
+import time
+import helper.metrics as metrics
+import settings
+
+# Setup the logger
+logger = settings.logging.getLogger('bot')
+
+# Discord rate limits reactions and messages in separate per-channel buckets
+BUCKETS = {
+    'reaction': 'reaction',
+    'reply': 'message',
+    'notice': 'message',
+}
+
+
+class TokenBucket:
+    """Allows `rate` actions per second with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        """Seconds until the next action is allowed, 0 if it is allowed now."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class ActionQueue:
+    """Outbound Discord actions, sent in the background so counting never waits on the Discord API.
+
+    Actions wait in one priority queue per rate limit bucket (kind of action and channel). The dispatcher sends
+    the most important action of every bucket that has room, within a global rate and a cap on requests in
+    flight. Reactions that waited longer than `max_age`, or while more than `max_reactions` are pending, are
+    dropped, a late reaction is worth less than keeping up with the count.
+    """
+
+    def __init__(self, priorities, rates, global_rate, concurrency, max_age, max_reactions):
+        self.priorities = priorities
+        self.rates = rates
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.concurrency = concurrency
+        self.max_age = max_age
+        self.max_reactions = max_reactions
+        self.actions = {}
+        self.buckets = {}
+        self.sequence = itertools.count()
+        self.reactions = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.wakeup = None
+        self.task = None
+
+    def submit(self, kind, channel_id, send):
+        """Queue an action, `send` is called without arguments and returns the coroutine to await."""
+        key = (BUCKETS[kind], int(channel_id))
+        heapq.heappush(self.actions.setdefault(key, []),
+                       (self.priorities[kind], next(self.sequence), time.monotonic(), kind, send))
+        if kind == 'reaction':
+            self.reactions += 1
+
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.ensure_future(self.run())
+        self.wakeup.set()
+
+    def pending(self):
+        return sum(len(actions) for actions in self.actions.values())
+
+    def bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            rate, burst = self.rates[key[0]]
+            bucket = self.buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            wait = None
+
+            # The head of every bucket that has room, most important first
+            ready = []
+            for key, actions in list(self.actions.items()):
+                if not actions:
+                    del self.actions[key]
+                    self.buckets.pop(key, None)  # An idle bucket has refilled anyway
+                    continue
+                delay = self.bucket(key).delay(now)
+                if delay:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                ready.append((actions[0][0], actions[0][1], key))
+
+            for _, _, key in sorted(ready):
+                if self.in_flight >= self.concurrency:
+                    break  # A finished request wakes the dispatcher up again
+                delay = self.global_bucket.delay(now)
+                if delay:
+                    wait = delay if wait is None else min(wait, delay)
+                    break
+
+                _, _, created, kind, send = heapq.heappop(self.actions[key])
+                if kind == 'reaction':
+                    self.reactions -= 1
+                    if now - created > self.max_age or self.reactions >= self.max_reactions:
+                        self.dropped += 1
+                        wait = 0  # The bucket still has room for its next action
+                        continue
+
+                self.bucket(key).take()
+                self.global_bucket.take()
+                self.in_flight += 1
+                metrics.observe('outbox_wait_seconds', now - created, kind=kind)
+                asyncio.ensure_future(self.deliver(kind, send))
+
+            if wait == 0:
+                continue
+            # A timer setting the event instead of wait_for, which can swallow the cancellation at shutdown
+            timer = None if wait is None else asyncio.get_running_loop().call_later(wait, self.wakeup.set)
+            try:
+                await self.wakeup.wait()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+
+    async def deliver(self, kind, send):
+        try:
+            with metrics.timer('outbox_send_seconds', kind=kind):
+                await send()
+            self.sent += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Failed to send {kind}: {e}")
+        finally:
+            self.in_flight -= 1
+            self.wakeup.set()
+
+
+# Initialize the outbound action queue
+outbox = ActionQueue(
+    priorities=settings.OUTBOX_PRIORITIES,
+    rates={
+        'reaction': (settings.OUTBOX_REACTION_RATE, settings.OUTBOX_REACTION_BURST),
+        'message': (settings.OUTBOX_MESSAGE_RATE, settings.OUTBOX_MESSAGE_BURST),
+    },
+    global_rate=settings.OUTBOX_GLOBAL_RATE,
+    concurrency=settings.OUTBOX_CONCURRENCY,
+    max_age=settings.OUTBOX_REACTION_MAX_AGE,
+    max_reactions=settings.OUTBOX_MAX_REACTIONS,
+)
+
+# Expose the queue with the other metrics
+metrics.register_collector(lambda: [
+    ('outbox_pending', {}, outbox.pending()),
+    ('outbox_in_flight', {}, outbox.in_flight),
+    ('outbox_sent_total', {}, outbox.sent),
+    ('outbox_dropped_total', {}, outbox.dropped),
+    ('outbox_failed_total', {}, outbox.failed),
+])
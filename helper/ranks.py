@@ -0,0 +1,205 @@
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+import threading
+import helper.metrics as metrics
+import settings
+
+# Distinct counts a bucket of a rank index holds before the index is rebuilt with a bucket for every count
+MAX_BUCKET_COUNTS = 64
+
+
+class FenwickTree:
+    """Number of users per bucket, with O(log n) updates and prefix sums over the buckets 1..size."""
+
+    def __init__(self, frequencies):
+        # Built in O(n) from frequencies[bucket], position 0 is unused
+        self.tree = array('q', frequencies)
+        size = len(self.tree) - 1
+        for index in range(1, size + 1):
+            parent = index + (index & -index)
+            if parent <= size:
+                self.tree[parent] += self.tree[index]
+
+    @property
+    def size(self):
+        return len(self.tree) - 1
+
+    def add(self, index, delta):
+        tree = self.tree
+        size = len(tree) - 1
+        while index <= size:
+            tree[index] += delta
+            index += index & -index
+
+    def prefix_sum(self, index):
+        """Users in the buckets 1..index."""
+        tree = self.tree
+        index = min(index, len(tree) - 1)
+        total = 0
+        while index > 0:
+            total += tree[index]
+            index &= index - 1
+        return total
+
+
+class RankIndex:
+    """Ranks the users of one scope (a channel or all channels) by their count.
+
+    The rank of a user is one more than the number of users with a higher count, users with the same count share it.
+    The counts are compressed into buckets: a build starts a bucket at every distinct count, and a bucket covers the
+    counts up to the next one. Increments can add counts inside a bucket, every bucket keeps the number of users per
+    count it covers, and the index is rebuilt once a bucket holds more than MAX_BUCKET_COUNTS distinct counts. Memory
+    grows with the number of users, not with their counts, and updates stay O(log n) amortized.
+    """
+
+    def __init__(self, rows):
+        self.counts = {int(user_id): int(count) for user_id, count in rows if count > 0}
+        self.build()
+
+    def build(self):
+        # Bucket i + 1 of the tree starts at starts[i], the first one at 1 so every count has a bucket
+        self.starts = sorted(set(self.counts.values()) | {1})
+        self.buckets = [{} for _ in self.starts]
+        frequencies = [0] * (len(self.starts) + 1)
+        for count in self.counts.values():
+            bucket = self.bucket(count)
+            self.buckets[bucket][count] = self.buckets[bucket].get(count, 0) + 1
+            frequencies[bucket + 1] += 1
+        self.tree = FenwickTree(frequencies)
+
+    def bucket(self, count):
+        return bisect_right(self.starts, count) - 1
+
+    def increment(self, user_id, delta=1):
+        old = self.counts.get(user_id, 0)
+        new = old + delta
+        if new > 0:
+            self.counts[user_id] = new
+        else:
+            self.counts.pop(user_id, None)
+
+        if old > 0:
+            bucket = self.bucket(old)
+            users = self.buckets[bucket]
+            users[old] -= 1
+            if not users[old]:
+                del users[old]
+            self.tree.add(bucket + 1, -1)
+        if new > 0:
+            bucket = self.bucket(new)
+            users = self.buckets[bucket]
+            users[new] = users.get(new, 0) + 1
+            self.tree.add(bucket + 1, 1)
+            if len(users) > MAX_BUCKET_COUNTS:
+                self.build()
+
+    def rank(self, user_id):
+        """Return (rank, count, ranked users) of a user, or None if the user has not counted in this scope."""
+        count = self.counts.get(user_id)
+        if not count:
+            return None
+        users = len(self.counts)
+        bucket = self.bucket(count)
+        # Users in the buckets above, and the users of the user's own bucket with a higher count
+        higher = users - self.tree.prefix_sum(bucket + 1)
+        higher += sum(number for other, number in self.buckets[bucket].items() if other > count)
+        return higher + 1, count, users
+
+    def __len__(self):
+        return len(self.counts)
+
+
+class RankIndexes:
+    """The rank index of all users by total count and the indexes of the last `max_channels` ranked channels.
+
+    Counts are incremented here once they are written or buffered for writing. An index is loaded from a snapshot of
+    the database, and the increments made while a load runs are kept and applied to the loaded index before it is
+    used. The scope of a load is None for all users or the channel id. Every load gets a generation number, so only
+    the newest load of a scope is installed. The indexes are updated from the database threads and read from the
+    event loop, so every access holds the lock.
+    """
+
+    def __init__(self, max_channels):
+        self.max_channels = max_channels
+        self.users = None  # Loaded by load_user_ranks
+        self.channels = OrderedDict()
+        self.generation = 0
+        self.loads = {}  # Scope of every running load to (generation, increments made since it began)
+        self.lock = threading.Lock()
+
+    def increment(self, channel_id, user_id, delta=1):
+        with self.lock:
+            if self.users is not None:
+                self.users.increment(user_id, delta)
+            index = self.channels.get(channel_id)
+            if index is not None:
+                index.increment(user_id, delta)
+            for scope in (None, channel_id):
+                load = self.loads.get(scope)
+                if load is not None:
+                    load[1].append((user_id, delta))
+
+    def begin_load(self, scope):
+        """Start recording the increments of a scope, returns the generation of the load."""
+        with self.lock:
+            self.generation += 1
+            self.loads[scope] = (self.generation, [])
+            return self.generation
+
+    def finish_load(self, scope, generation, index):
+        """Install a loaded index with the increments made since its load began, unless a newer load replaced it."""
+        with self.lock:
+            load = self.loads.get(scope)
+            if load is None or load[0] != generation:
+                return False
+            del self.loads[scope]
+            for user_id, delta in load[1]:
+                index.increment(user_id, delta)
+            if scope is None:
+                self.users = index
+            else:
+                self.channels[scope] = index
+                self.channels.move_to_end(scope)
+                while len(self.channels) > self.max_channels:
+                    self.channels.popitem(last=False)
+            return True
+
+    def abandon_load(self, scope, generation):
+        with self.lock:
+            load = self.loads.get(scope)
+            if load is not None and load[0] == generation:
+                del self.loads[scope]
+
+    def channel(self, channel_id):
+        """Return the index of a channel if it is loaded, marking it as recently used."""
+        with self.lock:
+            index = self.channels.get(channel_id)
+            if index is not None:
+                self.channels.move_to_end(channel_id)
+            return index
+
+    def rank(self, index, user_id):
+        with self.lock:
+            return index.rank(user_id)
+
+    def clear_channels(self):
+        with self.lock:
+            self.channels.clear()
+
+    def clear(self):
+        """Drop every index, loads running now are not installed."""
+        with self.lock:
+            self.users = None
+            self.channels.clear()
+            self.loads.clear()
+
+
+# Initialize the rank indexes, the user index is loaded at startup and the channel indexes on demand
+rank_index = RankIndexes(settings.RANK_CHANNEL_INDEXES)
+
+# Expose the size of the rank indexes with the other metrics
+metrics.register_collector(lambda: [
+    ('rank_index_users', {}, len(rank_index.users or ())),
+    ('rank_index_channels', {}, len(rank_index.channels)),
+])
@@ -0,0 +1,53 @@
+from collections import deque
+import helper.metrics as metrics
+import settings
+
+
+class RecentMessages:
+    """The last `size` accepted counting messages of every channel, looked up by message id.
+
+    Edits and deletes are matched against this index instead of evaluating the old content again, which also
+    works for raw events of messages that are no longer in the client's message cache. A channel's messages are
+    dropped when its count is reset, so the newest entry of a channel is always the message holding its count.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.channels = {}
+
+    def add(self, channel_id, message_id, number, author_id):
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = (deque(maxlen=self.size), {})
+        order, entries = channel
+        if len(order) == self.size:
+            entries.pop(order[0], None)  # The deque drops the oldest id on append
+        order.append(message_id)
+        entries[message_id] = (number, author_id)
+
+    def get(self, channel_id, message_id):
+        """Return (number, author_id, is_current) of a recent accepted message, or None."""
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            return None
+        order, entries = channel
+        entry = entries.get(message_id)
+        if entry is None:
+            return None
+        return entry + (order[-1] == message_id,)
+
+    def clear(self, channel_id):
+        self.channels.pop(channel_id, None)
+
+    def __len__(self):
+        return sum(len(entries) for _, entries in self.channels.values())
+
+
+# Initialize the index of recent counting messages
+recent_messages = RecentMessages(settings.RECENT_MESSAGES_PER_CHANNEL)
+
+# Expose the size of the index with the other metrics
+metrics.register_collector(lambda: [
+    ('recent_messages_channels', {}, len(recent_messages.channels)),
+    ('recent_messages_entries', {}, len(recent_messages)),
+])
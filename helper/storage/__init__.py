@@ -0,0 +1,15 @@
+import settings
+
+
+# Create the storage backend selected with DATABASE_BACKEND in the settings
+def create_backend(name=None, pool_size=None):
+    name = name or settings.DATABASE_BACKEND
+    pool_size = pool_size or settings.DATABASE_POOL_SIZE
+    if name == 'mariadb':
+        # Imported here so the SQLite backend works without mysql-connector installed
+        from helper.storage.mariadb import MariaDBBackend
+        return MariaDBBackend(pool_size=pool_size)
+    if name == 'sqlite':
+        from helper.storage.sqlite import SQLiteBackend
+        return SQLiteBackend(settings.SQLITE_PATH, pool_size=pool_size)
+    raise ValueError(f"Unknown database backend: {name}")
@@ -0,0 +1,604 @@
+from contextlib import contextmanager
+import time
+import helper.metrics as metrics
+import settings
+
+# Configure logging for database operations
+logger = settings.logging.getLogger("database")
+
+
+class StorageBackend:
+    """Every storage operation helper.database needs, written in SQL both backends understand.
+
+    Subclasses provide the connections and override the few statements that differ between dialects.
+    Operations raise on failure, helper.database decides how errors are logged and what is returned instead.
+    """
+
+    name = None
+
+    # Define your tables and required columns
+    tables = {
+        'users': {
+            'user_id': 'BIGINT PRIMARY KEY',
+            'total_count': 'INT NOT NULL DEFAULT 0'  # Sum of the user's counts in all channels
+        },
+        'channels': {
+            'channel_id': 'BIGINT PRIMARY KEY',
+            'count': 'INT DEFAULT 0',  # Default value for count
+            'last_user_id': 'BIGINT DEFAULT 0',  # Default value for last_user_id
+            'highscore': 'INT DEFAULT 0',  # Default value for highscore
+            'highscore_at': 'BIGINT DEFAULT 0'  # Unix time in seconds the highscore was reached, 0 if unknown
+        },
+        'channeluser': {
+            'channeluser_id': 'INT AUTO_INCREMENT PRIMARY KEY',
+            'user_id': 'BIGINT NOT NULL',
+            'channel_id': 'BIGINT NOT NULL',
+            'count': 'INT NOT NULL DEFAULT 0'  # Default value for count
+        },
+        'channel_guilds': {
+            'channel_id': 'BIGINT PRIMARY KEY',
+            'guild_id': 'BIGINT NOT NULL',
+            'guild_name': 'VARCHAR(100) NOT NULL'  # Guild names are at most 100 characters
+        },
+        # Append-only ledger of every counted message
+        'count_events': {
+            'event_id': 'BIGINT AUTO_INCREMENT PRIMARY KEY',
+            'channel_id': 'BIGINT NOT NULL',
+            'user_id': 'BIGINT NOT NULL',
+            'message_id': 'BIGINT NOT NULL',
+            'number': 'BIGINT',  # NULL when the evaluated number does not fit
+            'outcome': 'VARCHAR(8) NOT NULL',  # correct, twice or wrong
+            'created_at': 'BIGINT NOT NULL'  # Unix time in milliseconds
+        },
+        # Counting activity per channel and time bucket, compacted from the ledger
+        'count_aggregates': {
+            'channel_id': 'BIGINT NOT NULL',
+            'bucket_start': 'BIGINT NOT NULL',  # Unix time in milliseconds
+            'correct_count': 'INT NOT NULL DEFAULT 0',
+            'failed_count': 'INT NOT NULL DEFAULT 0',
+            'max_number': 'BIGINT NOT NULL DEFAULT 0'
+        },
+        # Last event folded in by each job reading the ledger
+        'ledger_checkpoints': {
+            'name': 'VARCHAR(32) PRIMARY KEY',
+            'event_id': 'BIGINT NOT NULL DEFAULT 0'
+        }
+    }
+
+    # Define the required indexes of each table as (unique, columns)
+    indexes = {
+        'users': {
+            'idx_users_total_count': (False, 'total_count'),
+        },
+        'channels': {
+            'idx_channels_highscore': (False, 'highscore'),
+        },
+        'channeluser': {
+            'uq_channeluser_channel_user': (True, 'channel_id, user_id'),
+            'idx_channeluser_channel_count': (False, 'channel_id, count'),
+        },
+        'channel_guilds': {
+            'idx_channel_guilds_guild': (False, 'guild_id'),
+        },
+        'count_events': {
+            'idx_count_events_channel': (False, 'channel_id, event_id'),
+            'idx_count_events_created': (False, 'created_at'),
+        },
+        'count_aggregates': {
+            'uq_count_aggregates_channel_bucket': (True, 'channel_id, bucket_start'),
+        },
+    }
+
+    def __init__(self):
+        self.queries = 0  # Statements executed, read by the benchmarks
+
+    # Connections
+
+    def get_connection(self):
+        raise NotImplementedError
+
+    def release_connection(self, conn):
+        raise NotImplementedError
+
+    def new_cursor(self, conn):
+        return conn.cursor()
+
+    @contextmanager
+    def cursor(self, commit=False):
+        """Check out a connection and yield a cursor, committing at the end or rolling back on errors."""
+        start = time.perf_counter()
+        conn = self.get_connection()
+        metrics.observe('database_pool_wait_seconds', time.perf_counter() - start)
+        metrics.add('database_connections_in_use', 1)
+        try:
+            cur = self.new_cursor(conn)
+            yield cur
+            if commit:
+                conn.commit()
+        except Exception:
+            if commit:
+                conn.rollback()
+            raise
+        finally:
+            metrics.add('database_connections_in_use', -1)
+            self.release_connection(conn)
+
+    def execute(self, cur, sql, params=()):
+        self.queries += 1
+        cur.execute(sql, params)
+        return cur
+
+    # Dialect specific pieces
+
+    def on_conflict(self, conflict_columns):
+        """Start of the upsert clause, followed by comma separated `column = expression` assignments."""
+        raise NotImplementedError
+
+    def excluded(self, column):
+        """The value an upsert tried to insert into a column."""
+        raise NotImplementedError
+
+    def greatest(self, first, second):
+        return f"GREATEST({first}, {second})"
+
+    def lock_clause(self):
+        """Suffix of a SELECT that locks the rows it reads until the transaction ends."""
+        return "FOR UPDATE"
+
+    def begin_locked(self, cur):
+        """Start a transaction that reads rows with lock_clause() before writing them."""
+
+    def existing_tables(self, cur):
+        raise NotImplementedError
+
+    def existing_columns(self, cur, table_name):
+        raise NotImplementedError
+
+    def existing_indexes(self, cur, table_name):
+        raise NotImplementedError
+
+    def add_index_sql(self, table_name, index_name, unique, columns):
+        raise NotImplementedError
+
+    def merge_duplicate_channelusers(self, cur):
+        raise NotImplementedError
+
+    def lock_migrations(self, cur):
+        """Keep other processes from migrating at the same time, until unlock_migrations."""
+
+    def unlock_migrations(self, cur):
+        pass
+
+    # Schema repairs, the schema itself is created and changed by helper.storage.migrations
+
+    def repair_user_totals(self, cur):
+        """Recompute users.total_count from channeluser, inserting users that are missing."""
+        self.execute(cur, f'''
+            INSERT INTO users (user_id, total_count)
+            SELECT user_id, SUM(count)
+            FROM channeluser
+            WHERE 1 = 1
+            GROUP BY user_id
+            {self.on_conflict(('user_id',))} total_count = {self.excluded('total_count')}
+        ''')
+        self.execute(cur, '''
+            UPDATE users
+            SET total_count = 0
+            WHERE total_count <> 0 AND user_id NOT IN (SELECT DISTINCT user_id FROM channeluser)
+        ''')
+
+    def check_user_totals(self):
+        """Count the users whose total drifted from channeluser and repair them. Returns the drift."""
+        with self.cursor(commit=True) as cur:
+            self.execute(cur, '''
+                SELECT COUNT(*)
+                FROM users u
+                LEFT JOIN (
+                    SELECT user_id, SUM(count) AS total_count
+                    FROM channeluser
+                    GROUP BY user_id
+                ) totals ON u.user_id = totals.user_id
+                WHERE u.total_count <> COALESCE(totals.total_count, 0)
+            ''')
+            drifted = cur.fetchone()[0]
+            if drifted:
+                self.repair_user_totals(cur)
+            return drifted
+
+    # Channels
+
+    def channel_exists(self, channel_id):
+        with self.cursor() as cur:
+            self.execute(cur, "SELECT 1 FROM channels WHERE channel_id = %s", (channel_id,))
+            return cur.fetchone() is not None
+
+    def get_channel_ids(self):
+        with self.cursor() as cur:
+            self.execute(cur, "SELECT channel_id FROM channels")
+            return [row[0] for row in cur.fetchall()]
+
+    def add_channel(self, channel_id):
+        with self.cursor(commit=True) as cur:
+            self.execute(cur, '''
+                INSERT INTO channels(channel_id, count, last_user_id, highscore)
+                VALUES(%s, 0, 0, 0)
+            ''', (channel_id,))
+
+    def remove_channel(self, channel_id):
+        with self.cursor(commit=True) as cur:
+            self.execute(cur, "DELETE FROM channels WHERE channel_id = %s", (channel_id,))
+
+    def get_channel_state(self, channel_id):
+        """Return (count, last_user_id, highscore, highscore_at) of a channel or None."""
+        with self.cursor() as cur:
+            self.execute(cur, '''
+                SELECT count, last_user_id, highscore, highscore_at
+                FROM channels
+                WHERE channel_id = %s
+            ''', (channel_id,))
+            return cur.fetchone()
+
+    def update_count(self, channel_id, new_count, user_id):
+        with self.cursor(commit=True) as cur:
+            self.execute(cur, '''
+                UPDATE channels
+                SET count = %s, last_user_id = %s
+                WHERE channel_id = %s
+            ''', (new_count, user_id, channel_id))
+
+    def update_highscore(self, channel_id, new_highscore, highscore_at):
+        with self.cursor(commit=True) as cur:
+            self.execute(cur, '''
+                UPDATE channels
+                SET highscore = %s, highscore_at = %s
+                WHERE channel_id = %s
+            ''', (new_highscore, highscore_at, channel_id))
+
+    def raise_highscores(self, highscores):
+        """Write {channel_id: (highscore, highscore_at)} where it beats the stored highscore. Returns the channels."""
+        # One UPDATE for all channels like update_counts, a stored highscore is never lowered
+        cases = " ".join(["WHEN %s THEN %s"] * len(highscores))
+        placeholders = ", ".join(["%s"] * len(highscores))
+        highscore_params, at_params = [], []
+        for channel_id, (highscore, highscore_at) in highscores.items():
+            highscore_params += [channel_id, highscore]
+            at_params += [channel_id, highscore_at]
+        with self.cursor(commit=True) as cur:
+            self.execute(cur, f'''
+                UPDATE channels
+                SET highscore = CASE channel_id {cases} END,
+                    highscore_at = CASE channel_id {cases} END
+                WHERE channel_id IN ({placeholders})
+                AND highscore < CASE channel_id {cases} END
+            ''', highscore_params + at_params + list(highscores) + highscore_params)
+            return cur.rowcount
+
+    # Users
+
+    def user_exists(self, user_id):
+        with self.cursor() as cur:
+            self.execute(cur, "SELECT 1 FROM users WHERE user_id = %s", (user_id,))
+            return cur.fetchone() is not None
+
+    def add_user(self, user_id):
+        with self.cursor(commit=True) as cur:
+            self.execute(cur, "INSERT INTO users(user_id) VALUES(%s)", (user_id,))
+
+    def increment_user_counts(self, user_counts):
+        """Add {(channel_id, user_id): increment} to channeluser and the users' totals in one transaction."""
+        with self.cursor(commit=True) as cur:
+            self.upsert_user_counts(cur, user_counts)
+
+    def upsert_user_counts(self, cur, user_counts):
+        totals = {}
+        for (_, user_id), increment in user_counts.items():
+            totals[user_id] = totals.get(user_id, 0) + increment
+
+        values = ", ".join(["(%s, %s, %s)"] * len(user_counts))
+        params = [value for (channel_id, user_id), increment in user_counts.items()
+                  for value in (user_id, channel_id, increment)]
+        self.execute(cur, f'''
+            INSERT INTO channeluser (user_id, channel_id, count)
+            VALUES {values}
+            {self.on_conflict(('channel_id', 'user_id'))} count = count + {self.excluded('count')}
+        ''', params)
+
+        # The users' totals are maintained in the same transaction, creating users if needed
+        values = ", ".join(["(%s, %s)"] * len(totals))
+        params = [value for user_id, increment in totals.items() for value in (user_id, increment)]
+        self.execute(cur, f'''
+            INSERT INTO users (user_id, total_count)
+            VALUES {values}
+            {self.on_conflict(('user_id',))} total_count = total_count + {self.excluded('total_count')}
+        ''', params)
+
+    def write_batch(self, counts, user_counts):
+        """Write {channel_id: (count, last_user_id)} and {(channel_id, user_id): increment} in one transaction."""
+        with self.cursor(commit=True) as cur:
+            if counts:
+                self.update_counts(cur, counts)
+            if user_counts:
+                self.upsert_user_counts(cur, user_counts)
+
+    def update_counts(self, cur, counts):
+        # One UPDATE for all channels, picking each channel's value with CASE
+        cases = " ".join(["WHEN %s THEN %s"] * len(counts))
+        placeholders = ", ".join(["%s"] * len(counts))
+        params = []
+        for channel_id, (count, _) in counts.items():
+            params += [channel_id, count]
+        for channel_id, (_, last_user_id) in counts.items():
+            params += [channel_id, last_user_id]
+        params += list(counts)
+        self.execute(cur, f'''
+            UPDATE channels
+            SET count = CASE channel_id {cases} END,
+                last_user_id = CASE channel_id {cases} END
+            WHERE channel_id IN ({placeholders})
+        ''', params)
+
+    # Leaderboards, keyset pagination continues below the last row of the previous page instead of using OFFSET
+
+    def get_top_channel_highscores(self, limit, after):
+        where, params = "", ()
+        if after is not None:
+            where = "WHERE highscore < %s OR (highscore = %s AND channel_id < %s)"
+            params = (after[0], after[0], after[1])
+        with self.cursor() as cur:
+            self.execute(cur, f'''
+                SELECT channel_id, highscore
+                FROM channels
+                {where}
+                ORDER BY highscore DESC, channel_id DESC
+                LIMIT %s
+            ''', params + (limit,))
+            return cur.fetchall()
+
+    def get_top_user_highscores(self, channel_id, limit, after):
+        where, params = "", (channel_id,)
+        if after is not None:
+            where = "AND (count < %s OR (count = %s AND user_id < %s))"
+            params += (after[0], after[0], after[1])
+        with self.cursor() as cur:
+            self.execute(cur, f'''
+                SELECT user_id, count
+                FROM channeluser
+                WHERE channel_id = %s {where}
+                ORDER BY count DESC, user_id DESC
+                LIMIT %s
+            ''', params + (limit,))
+            return cur.fetchall()
+
+    def get_top_users(self, limit, after):
+        where, params = "", ()
+        if after is not None:
+            where = "WHERE total_count < %s OR (total_count = %s AND user_id < %s)"
+            params = (after[0], after[0], after[1])
+        with self.cursor() as cur:
+            self.execute(cur, f'''
+                SELECT user_id, total_count
+                FROM users
+                {where}
+                ORDER BY total_count DESC, user_id DESC
+                LIMIT %s
+            ''', params + (limit,))
+            return cur.fetchall()
+
+    # Rank indexes
+
+    # Correct ledger events past the compaction checkpoint, counted per user
+    UNCOMPACTED_USER_COUNTS = '''
+        SELECT user_id, COUNT(*) AS n
+        FROM count_events
+        WHERE outcome = 'correct'
+        AND event_id > COALESCE((SELECT event_id FROM ledger_checkpoints WHERE name = 'compaction'), 0)
+    '''
+
+    def get_user_totals(self, include_ledger=False):
+        """Return (user_id, total_count) of every user who counted.
+
+        With `include_ledger` the correct events past the compaction checkpoint are added, in one statement, so a
+        compaction running meanwhile is seen either completely or not at all.
+        """
+        sql = "SELECT user_id, total_count AS n FROM users WHERE total_count > 0"
+        if include_ledger:
+            sql = f'''
+                SELECT user_id, SUM(n)
+                FROM ({sql} UNION ALL {self.UNCOMPACTED_USER_COUNTS} GROUP BY user_id) counts
+                GROUP BY user_id
+            '''
+        with self.cursor() as cur:
+            self.execute(cur, sql)
+            return cur.fetchall()
+
+    def get_channel_user_counts(self, channel_id, include_ledger=False):
+        """Return (user_id, count) of every user who counted in a channel, `include_ledger` as in get_user_totals."""
+        sql = "SELECT user_id, count AS n FROM channeluser WHERE channel_id = %s AND count > 0"
+        params = (channel_id,)
+        if include_ledger:
+            sql = f'''
+                SELECT user_id, SUM(n)
+                FROM ({sql} UNION ALL {self.UNCOMPACTED_USER_COUNTS} AND channel_id = %s GROUP BY user_id) counts
+                GROUP BY user_id
+            '''
+            params = (channel_id, channel_id)
+        with self.cursor() as cur:
+            self.execute(cur, sql, params)
+            return cur.fetchall()
+
+    # Guilds of counting channels
+
+    def upsert_channel_guilds(self, rows):
+        values = ", ".join(["(%s, %s, %s)"] * len(rows))
+        with self.cursor(commit=True) as cur:
+            self.execute(cur, f'''
+                INSERT INTO channel_guilds (channel_id, guild_id, guild_name)
+                VALUES {values}
+                {self.on_conflict(('channel_id',))} guild_id = {self.excluded('guild_id')},
+                    guild_name = {self.excluded('guild_name')}
+            ''', [value for row in rows for value in row])
+
+    def get_channel_guild_names(self, channel_ids):
+        placeholders = ", ".join(["%s"] * len(channel_ids))
+        with self.cursor() as cur:
+            self.execute(cur, f'''
+                SELECT channel_id, guild_name
+                FROM channel_guilds
+                WHERE channel_id IN ({placeholders})
+            ''', channel_ids)
+            return {row[0]: row[1] for row in cur.fetchall()}
+
+    def get_channel_guilds(self):
+        with self.cursor() as cur:
+            self.execute(cur, "SELECT channel_id, guild_id, guild_name FROM channel_guilds")
+            return {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+
+    def update_guild_name(self, guild_id, guild_name):
+        with self.cursor(commit=True) as cur:
+            self.execute(cur, "UPDATE channel_guilds SET guild_name = %s WHERE guild_id = %s", (guild_name, guild_id))
+
+    def delete_channel_guilds(self, channel_ids):
+        placeholders = ", ".join(["%s"] * len(channel_ids))
+        with self.cursor(commit=True) as cur:
+            self.execute(cur, f"DELETE FROM channel_guilds WHERE channel_id IN ({placeholders})", channel_ids)
+
+    def prune_channel_guilds(self):
+        with self.cursor(commit=True) as cur:
+            self.execute(cur, '''
+                DELETE FROM channel_guilds
+                WHERE channel_id NOT IN (SELECT channel_id FROM channels)
+            ''')
+            return cur.rowcount
+
+    # Ledger of counted messages
+
+    def insert_count_events(self, events):
+        """Append (channel_id, user_id, message_id, number, outcome, created_at) rows with one multi-row insert."""
+        values = ", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(events))
+        with self.cursor(commit=True) as cur:
+            self.execute(cur, f'''
+                INSERT INTO count_events (channel_id, user_id, message_id, number, outcome, created_at)
+                VALUES {values}
+            ''', [value for event in events for value in event])
+
+    def compact_count_events(self, batch_size, bucket_ms, apply, before_ms=None):
+        """Fold up to `batch_size` events after the checkpoint in, in one transaction. Returns the number of events."""
+        with self.cursor(commit=True) as cur:
+            self.begin_locked(cur)
+            return self.compact_batch(cur, batch_size, bucket_ms, apply, before_ms)
+
+    def compact_batch(self, cur, batch_size, bucket_ms, apply, before_ms=None):
+        """Add the events after the checkpoint to count_aggregates, and to channels, channeluser and users if `apply`.
+
+        With `before_ms` the batch stops at the first event created after it. Several processes append to the
+        ledger, an event_id can become visible after higher ones, so only events old enough that every lower
+        event_id has been committed are folded in before the checkpoint moves past them.
+        """
+        self.execute(cur, f"SELECT event_id FROM ledger_checkpoints WHERE name = 'compaction' {self.lock_clause()}")
+        row = cur.fetchone()
+        self.execute(cur, '''
+            SELECT event_id, channel_id, user_id, number, outcome, created_at
+            FROM count_events
+            WHERE event_id > %s
+            ORDER BY event_id
+            LIMIT %s
+        ''', (row[0] if row else 0, batch_size))
+        events = cur.fetchall()
+        if before_ms is not None:
+            settled = next((i for i, event in enumerate(events) if event[5] >= before_ms), len(events))
+            events = events[:settled]
+        if not events:
+            return 0
+
+        # The last event of a channel decides its count, every correct one adds to its user's count
+        counts, user_counts, aggregates = {}, {}, {}
+        for _, channel_id, user_id, number, outcome, created_at in events:
+            key = (channel_id, created_at - created_at % bucket_ms)
+            correct, failed, max_number = aggregates.get(key, (0, 0, 0))
+            if outcome == 'correct':
+                counts[channel_id] = (number, user_id)
+                user_counts[(channel_id, user_id)] = user_counts.get((channel_id, user_id), 0) + 1
+                aggregates[key] = (correct + 1, failed, max(max_number, number))
+            else:
+                counts[channel_id] = (0, 0)
+                aggregates[key] = (correct, failed + 1, max_number)
+
+        if apply:
+            self.update_counts(cur, counts)
+            if user_counts:
+                self.upsert_user_counts(cur, user_counts)
+
+        values = ", ".join(["(%s, %s, %s, %s, %s)"] * len(aggregates))
+        self.execute(cur, f'''
+            INSERT INTO count_aggregates (channel_id, bucket_start, correct_count, failed_count, max_number)
+            VALUES {values}
+            {self.on_conflict(('channel_id', 'bucket_start'))}
+                correct_count = correct_count + {self.excluded('correct_count')},
+                failed_count = failed_count + {self.excluded('failed_count')},
+                max_number = {self.greatest('max_number', self.excluded('max_number'))}
+        ''', [value for key, aggregate in aggregates.items() for value in key + aggregate])
+
+        self.execute(cur, f'''
+            INSERT INTO ledger_checkpoints (name, event_id)
+            VALUES ('compaction', %s)
+            {self.on_conflict(('name',))} event_id = {self.excluded('event_id')}
+        ''', (events[-1][0],))
+        return len(events)
+
+    def rebuild_from_ledger(self, batch_size, bucket_ms):
+        """Replace the counts, user counts, totals and aggregates with what the ledger holds, in one transaction.
+
+        Highscores are only ever raised to the highest count in the ledger. Returns the number of events replayed.
+        """
+        with self.cursor(commit=True) as cur:
+            self.begin_locked(cur)
+            self.execute(cur, "UPDATE channels SET count = 0, last_user_id = 0")
+            self.execute(cur, "DELETE FROM channeluser")
+            self.execute(cur, "UPDATE users SET total_count = 0")
+            self.execute(cur, "DELETE FROM count_aggregates")
+            self.execute(cur, "DELETE FROM ledger_checkpoints WHERE name = 'compaction'")
+
+            total = 0
+            while True:
+                replayed = self.compact_batch(cur, batch_size, bucket_ms, apply=True)
+                total += replayed
+                if replayed < batch_size:
+                    break
+
+            self.execute(cur, '''
+                UPDATE channels
+                SET highscore = (
+                    SELECT MAX(max_number) FROM count_aggregates a WHERE a.channel_id = channels.channel_id
+                )
+                WHERE highscore < (
+                    SELECT MAX(max_number) FROM count_aggregates a WHERE a.channel_id = channels.channel_id
+                )
+            ''')
+            return total
+
+    def get_uncompacted_count(self, channel_id):
+        """Return (count, last_user_id) after the newest event of a channel past the checkpoint, or None."""
+        with self.cursor() as cur:
+            self.execute(cur, '''
+                SELECT number, user_id, outcome
+                FROM count_events
+                WHERE channel_id = %s
+                AND event_id > COALESCE((SELECT event_id FROM ledger_checkpoints WHERE name = 'compaction'), 0)
+                ORDER BY event_id DESC
+                LIMIT 1
+            ''', (channel_id,))
+            row = cur.fetchone()
+        if row is None:
+            return None
+        number, user_id, outcome = row
+        return (number, user_id) if outcome == 'correct' else (0, 0)
+
+    def prune_count_events(self, before_ms):
+        """Delete compacted events created before `before_ms`. Returns the number of events deleted."""
+        with self.cursor(commit=True) as cur:
+            self.execute(cur, "SELECT event_id FROM ledger_checkpoints WHERE name = 'compaction'")
+            row = cur.fetchone()
+            if not row:
+                return 0
+            self.execute(cur, "DELETE FROM count_events WHERE event_id <= %s AND created_at < %s", (row[0], before_ms))
+            return cur.rowcount
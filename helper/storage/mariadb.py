@@ -0,0 +1,105 @@
+import mysql.connector
+from mysql.connector import pooling
+from helper.storage.base import StorageBackend, logger
+import settings
+
+
+class MariaDBConnectionPool:
+    def __init__(self, pool_name='pool', pool_size=settings.DATABASE_POOL_SIZE):
+        self.pool = mysql.connector.pooling.MySQLConnectionPool(
+            pool_name=pool_name,
+            pool_size=pool_size,
+            pool_reset_session=True,
+            host=settings.DATABASE_HOST,
+            database=settings.DATABASE_NAME,
+            user=settings.DATABASE_USER,
+            password=settings.DATABASE_PASSWORD,
+            port=settings.DATABASE_PORT
+        )
+
+    def get_connection(self):
+        return self.pool.get_connection()
+
+    @staticmethod
+    def release_connection(conn):
+        if conn is not None:
+            try:
+                if conn.is_connected():
+                    conn.close()
+            except Exception as e:
+                logger.error(f"Failed to close connection: {e}")
+        else:
+            logger.error("Attempted to release a None connection")
+
+
+class MariaDBBackend(StorageBackend):
+    """The MariaDB server backend, using a mysql.connector connection pool."""
+
+    name = 'mariadb'
+
+    def __init__(self, pool_size):
+        super().__init__()
+        self.connection_pool = MariaDBConnectionPool(pool_size=pool_size)
+
+    def get_connection(self):
+        return self.connection_pool.get_connection()
+
+    def release_connection(self, conn):
+        self.connection_pool.release_connection(conn)
+
+    def new_cursor(self, conn):
+        # Buffered, so statements that only read one row do not leave unread results on the connection
+        return conn.cursor(buffered=True)
+
+    def on_conflict(self, conflict_columns):
+        return "ON DUPLICATE KEY UPDATE"
+
+    def excluded(self, column):
+        return f"VALUES({column})"
+
+    def existing_tables(self, cur):
+        self.execute(cur, "SHOW TABLES;")
+        return {table[0] for table in cur.fetchall()}
+
+    def existing_columns(self, cur, table_name):
+        self.execute(cur, f"SHOW COLUMNS FROM {table_name};")
+        return {column[0] for column in cur.fetchall()}
+
+    def existing_indexes(self, cur, table_name):
+        self.execute(cur, f"SHOW INDEX FROM {table_name};")
+        return {index[2] for index in cur.fetchall()}
+
+    def add_index_sql(self, table_name, index_name, unique, columns):
+        kind = "UNIQUE KEY" if unique else "INDEX"
+        return f"ALTER TABLE {table_name} ADD {kind} {index_name} ({columns});"
+
+    def merge_duplicate_channelusers(self, cur):
+        """Sum the counts of duplicate rows into the oldest row and delete the others."""
+        self.execute(cur, '''
+            UPDATE channeluser cu
+            JOIN (
+                SELECT MIN(channeluser_id) AS keep_id, SUM(count) AS total_count
+                FROM channeluser
+                GROUP BY channel_id, user_id
+                HAVING COUNT(*) > 1
+            ) duplicates ON cu.channeluser_id = duplicates.keep_id
+            SET cu.count = duplicates.total_count
+        ''')
+        self.execute(cur, '''
+            DELETE cu
+            FROM channeluser cu
+            JOIN channeluser keep
+                ON cu.channel_id = keep.channel_id
+                AND cu.user_id = keep.user_id
+                AND cu.channeluser_id > keep.channeluser_id
+        ''')
+        logger.info(f"Merged {cur.rowcount} duplicate channeluser rows")
+
+    def lock_migrations(self, cur):
+        # A named lock, DDL cannot run inside a transaction that would serialize the processes otherwise
+        self.execute(cur, "SELECT GET_LOCK('sillycounting_migrations', 300)")
+        cur.fetchone()
+
+    def unlock_migrations(self, cur):
+        self.execute(cur, "SELECT RELEASE_LOCK('sillycounting_migrations')")
+        cur.fetchone()
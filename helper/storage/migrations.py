@@ -0,0 +1,119 @@
+import time
+from helper.storage.base import logger
+
+# Versioned schema migrations, applied in order and recorded in schema_version.
+#
+# Version 1 is the baseline: it brings any database, empty or created by an unversioned bot, to the schema
+# declared in StorageBackend.tables and StorageBackend.indexes by looking at what exists. Once a database is at
+# version 1 the schema is only changed by appending a migration here, the declared tables stay at the baseline.
+# A migration is (version, description, function), the function gets the backend, a cursor and a Changes object
+# and makes every change through it, so a dry run can list the changes without making them. MariaDB commits every
+# DDL statement on its own, so a migration has to be safe to run again after failing part way.
+
+SCHEMA_VERSION_TABLE = '''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INT PRIMARY KEY,
+        description VARCHAR(200) NOT NULL,
+        applied_at BIGINT NOT NULL
+    )
+'''
+
+
+class Changes:
+    """Makes the changes of a migration, or only records them in a dry run."""
+
+    def __init__(self, backend, cur, dry_run):
+        self.backend = backend
+        self.cur = cur
+        self.dry_run = dry_run
+        self.planned = []
+
+    def execute(self, sql, params=()):
+        self.run(' '.join(sql.split()), lambda: self.backend.execute(self.cur, sql, params))
+
+    def run(self, description, action):
+        """Call `action` unless this is a dry run, `description` says what it changes."""
+        self.planned.append(description)
+        if not self.dry_run:
+            logger.info(f"Migration change: {description}")
+            action()
+
+
+# Create missing tables, columns and indexes, with the one-time repairs some of them need
+def baseline(backend, cur, changes):
+    existing_tables = backend.existing_tables(cur)
+    for table_name, columns in backend.tables.items():
+        if table_name not in existing_tables:
+            changes.execute(f"CREATE TABLE {table_name} ("
+                            + ", ".join(f"{col_name} {col_details}" for col_name, col_details in columns.items())
+                            + ")")
+
+    # Columns added to existing tables get their defaults
+    for table_name, columns in backend.tables.items():
+        if table_name not in existing_tables:
+            continue
+        existing_columns = backend.existing_columns(cur, table_name)
+        for col_name, col_details in columns.items():
+            if col_name not in existing_columns:
+                changes.execute(f"ALTER TABLE {table_name} ADD COLUMN {col_name} {col_details}")
+                # Backfill the user totals once when the column is new
+                if (table_name, col_name) == ('users', 'total_count'):
+                    changes.run("Recompute users.total_count from channeluser",
+                                lambda: backend.repair_user_totals(cur))
+
+    for table_name, table_indexes in backend.indexes.items():
+        existing_indexes = backend.existing_indexes(cur, table_name) if table_name in existing_tables else set()
+        for index_name, (unique, columns) in table_indexes.items():
+            if index_name in existing_indexes:
+                continue
+            if index_name == 'uq_channeluser_channel_user' and table_name in existing_tables:
+                changes.run("Merge duplicate channeluser rows", lambda: backend.merge_duplicate_channelusers(cur))
+            changes.execute(backend.add_index_sql(table_name, index_name, unique, columns))
+
+
+# Every migration in order, append new ones with the next version
+MIGRATIONS = [
+    (1, "Baseline schema", baseline),
+]
+
+
+# The version the database is at, None if it has never been migrated
+def current_version(backend, cur):
+    try:
+        backend.execute(cur, "SELECT MAX(version) FROM schema_version")
+        return cur.fetchone()[0]
+    except Exception:
+        return None  # No schema_version table yet
+
+
+# Apply the migrations the database is missing, returns the descriptions of the changes (planned in a dry run)
+def migrate(backend, dry_run=False):
+    latest = MIGRATIONS[-1][0]
+    with backend.cursor() as cur:
+        version = current_version(backend, cur)
+    if version == latest:
+        return []  # Up to date, one query and no DDL
+
+    changes = []
+    with backend.cursor(commit=not dry_run) as cur:
+        backend.lock_migrations(cur)
+        try:
+            if not dry_run:
+                backend.execute(cur, SCHEMA_VERSION_TABLE)
+            version = current_version(backend, cur)  # Another process may have migrated while this one waited
+            for migration_version, description, function in MIGRATIONS:
+                if version is not None and migration_version <= version:
+                    continue
+                migration = Changes(backend, cur, dry_run)
+                function(backend, cur, migration)
+                changes += [f"{migration_version} ({description}): {change}" for change in migration.planned]
+                if not dry_run:
+                    backend.execute(cur, '''
+                        INSERT INTO schema_version (version, description, applied_at)
+                        VALUES (%s, %s, %s)
+                    ''', (migration_version, description, int(time.time())))
+                    logger.info(f"Applied migration {migration_version} ({description}) "
+                                f"with {len(migration.planned)} changes")
+        finally:
+            backend.unlock_migrations(cur)
+    return changes
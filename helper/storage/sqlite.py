@@ -0,0 +1,121 @@
+import queue
+import sqlite3
+from helper.storage.base import StorageBackend, logger
+
+# Pragmas applied to every connection: WAL lets readers run next to the writer, NORMAL sync is durable
+# in WAL mode except for the last transactions on power loss, and the cache and mmap keep hot pages in memory
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -20000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA busy_timeout = 5000",
+)
+
+
+class SQLiteBackend(StorageBackend):
+    """Embedded SQLite backend in WAL mode, with a small pool of connections to one database file."""
+
+    name = 'sqlite'
+
+    # SQLite spells the auto incrementing key differently, everything else is shared
+    tables = {
+        **StorageBackend.tables,
+        'channeluser': {
+            **StorageBackend.tables['channeluser'],
+            'channeluser_id': 'INTEGER PRIMARY KEY AUTOINCREMENT',
+        },
+        'count_events': {
+            **StorageBackend.tables['count_events'],
+            'event_id': 'INTEGER PRIMARY KEY AUTOINCREMENT',
+        },
+    }
+
+    def __init__(self, path, pool_size):
+        super().__init__()
+        self.path = path
+        self.connections = queue.LifoQueue()
+        for _ in range(pool_size):
+            self.connections.put(self.connect())
+
+    def connect(self):
+        # Connections move between the executor threads, but only one thread uses a connection at a time
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def get_connection(self):
+        return self.connections.get()
+
+    def release_connection(self, conn):
+        if conn is None:
+            logger.error("Attempted to release a None connection")
+            return
+        self.connections.put(conn)
+
+    def execute(self, cur, sql, params=()):
+        # sqlite3 only knows ? placeholders
+        return super().execute(cur, sql.replace('%s', '?'), params)
+
+    def on_conflict(self, conflict_columns):
+        return f"ON CONFLICT ({', '.join(conflict_columns)}) DO UPDATE SET"
+
+    def excluded(self, column):
+        return f"excluded.{column}"
+
+    def greatest(self, first, second):
+        return f"MAX({first}, {second})"
+
+    def lock_clause(self):
+        # SQLite has no row locks, a write transaction locks the whole database
+        return ""
+
+    def begin_locked(self, cur):
+        # sqlite3 only begins a transaction before the first write, so the reads would run unlocked. IMMEDIATE takes
+        # the write lock up front, other processes wait until the transaction ends just like FOR UPDATE makes them.
+        if not cur.connection.in_transaction:
+            self.execute(cur, "BEGIN IMMEDIATE")
+
+    def existing_tables(self, cur):
+        self.execute(cur, "SELECT name FROM sqlite_master WHERE type = 'table'")
+        return {table[0] for table in cur.fetchall()}
+
+    def existing_columns(self, cur, table_name):
+        self.execute(cur, f"PRAGMA table_info({table_name})")
+        return {column[1] for column in cur.fetchall()}
+
+    def existing_indexes(self, cur, table_name):
+        self.execute(cur, f"PRAGMA index_list({table_name})")
+        return {index[1] for index in cur.fetchall()}
+
+    def add_index_sql(self, table_name, index_name, unique, columns):
+        kind = "UNIQUE INDEX" if unique else "INDEX"
+        return f"CREATE {kind} IF NOT EXISTS {index_name} ON {table_name} ({columns})"
+
+    def merge_duplicate_channelusers(self, cur):
+        """Sum the counts of duplicate rows into the oldest row and delete the others."""
+        self.execute(cur, '''
+            UPDATE channeluser
+            SET count = (
+                SELECT SUM(duplicates.count)
+                FROM channeluser duplicates
+                WHERE duplicates.channel_id = channeluser.channel_id AND duplicates.user_id = channeluser.user_id
+            )
+            WHERE channeluser_id IN (
+                SELECT MIN(channeluser_id)
+                FROM channeluser
+                GROUP BY channel_id, user_id
+                HAVING COUNT(*) > 1
+            )
+        ''')
+        self.execute(cur, '''
+            DELETE FROM channeluser
+            WHERE channeluser_id NOT IN (
+                SELECT MIN(channeluser_id)
+                FROM channeluser
+                GROUP BY channel_id, user_id
+            )
+        ''')
+        logger.info(f"Merged {cur.rowcount} duplicate channeluser rows")
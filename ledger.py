@@ -0,0 +1,34 @@
+# Description: Maintenance of the ledger of counted messages, run it while the bot is stopped.
+# compact folds every pending event into the aggregates (and in source mode into the counts), rebuild recomputes
+# channels, channeluser, the user totals and the aggregates from the ledger alone. A rebuild loses whatever was
+# counted before the ledger existed or was pruned, so it has to be confirmed with --yes.
+# Usage: python ledger.py compact
+#        python ledger.py rebuild --yes
+
+import argparse
+import helper.database as database
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact the count event ledger or rebuild the counts from it.")
+    parser.add_argument('command', choices=('compact', 'rebuild'))
+    parser.add_argument('--yes', action='store_true', help="confirm the rebuild")
+    args = parser.parse_args()
+
+    if args.command == 'rebuild' and not args.yes:
+        parser.error("rebuild replaces the counts with what the ledger holds, confirm with --yes")
+
+    database.setup_database()
+    try:
+        if args.command == 'compact':
+            print(f"compacted {database.compact_count_events(settle_seconds=0)} events")
+        else:
+            replayed = database.rebuild_from_ledger()
+            print("rebuild failed, see the log" if replayed is None else f"rebuilt from {replayed} events")
+    finally:
+        database.event_buffer.stop()
+        database.write_buffer.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+# Description: Applies the schema migrations the database is missing, the bot also does this when it starts.
+# With --dry-run it only lists the changes the pending migrations would make.
+# Usage: python migrate.py [--dry-run]
+
+import argparse
+import helper.database as database
+import helper.storage.migrations as migrations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply the pending schema migrations.")
+    parser.add_argument('--dry-run', action='store_true', help="list the changes without making them")
+    args = parser.parse_args()
+
+    with database.backend.cursor() as cur:
+        version = migrations.current_version(database.backend, cur)
+    latest = migrations.MIGRATIONS[-1][0]
+    print(f"{database.backend.name} database at version {version or 'none'}, latest is {latest}")
+
+    changes = database.setup_database(dry_run=args.dry_run)
+    if changes is None:
+        print("migration failed, see the log")
+        return
+    for change in changes:
+        print(f"  {change}")
+    if not changes:
+        print("nothing to do")
+    elif args.dry_run:
+        print(f"{len(changes)} changes pending, run without --dry-run to apply them")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ import logging
 from colorlog import ColoredFormatter
 from dotenv import load_dotenv
 from logging.config import dictConfig
+from helper.logs import start_queue_logging
 import pathlib
 
 load_dotenv()
@@ -13,20 +14,158 @@ COMMAND_PREFIX = os.getenv('COMMAND_PREFIX')
 EMBED_COLOR = int(os.getenv('EMBED_COLOR'), 16)
 FEEDBACK_CHANNEL_ID = int(os.getenv('FEEDBACK_CHANNEL_ID'))
 
-# Database
+# Database, DATABASE_BACKEND is 'mariadb' or 'sqlite' (embedded, stored in SQLITE_PATH)
+DATABASE_BACKEND = os.getenv('DATABASE_BACKEND', 'mariadb')
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'sillycounting.db')
 DATABASE_NAME = os.getenv('DATABASE_NAME')
 DATABASE_USER = os.getenv('DATABASE_USER')
 DATABASE_PASSWORD = os.getenv('DATABASE_PASSWORD')
 DATABASE_HOST = os.getenv('DATABASE_HOST')
 DATABASE_PORT = os.getenv('DATABASE_PORT')
+# Number of pooled connections, also the number of worker threads running queries off the event loop
+DATABASE_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE', 5))
+
+# Minutes between reloads of the counting channel allowlist, picks up changes made by other processes
+ALLOWLIST_RESYNC_MINUTES = float(os.getenv('ALLOWLIST_RESYNC_MINUTES', 5))
+
+# Hours between consistency checks of the maintained user totals used by the "all users" leaderboard
+USER_TOTALS_CHECK_HOURS = float(os.getenv('USER_TOTALS_CHECK_HOURS', 24))
+
+# Accepted counting messages remembered per channel, edits and deletes of them are matched by message id
+RECENT_MESSAGES_PER_CHANNEL = int(os.getenv('RECENT_MESSAGES_PER_CHANNEL', 8))
+
+# Leaderboard pages are cached for LEADERBOARD_TTL_SECONDS, buttons page through them for LEADERBOARD_VIEW_TIMEOUT
+LEADERBOARD_TTL_SECONDS = float(os.getenv('LEADERBOARD_TTL_SECONDS', 60))
+LEADERBOARD_PAGE_SIZE = int(os.getenv('LEADERBOARD_PAGE_SIZE', 10))
+LEADERBOARD_VIEW_TIMEOUT = float(os.getenv('LEADERBOARD_VIEW_TIMEOUT', 180))
+
+# /rank is answered from in-memory rank indexes: the one of all users is reloaded from the database every
+# RANK_REFRESH_MINUTES (picking up counts of other cluster processes), channels are loaded when first ranked and the
+# RANK_CHANNEL_INDEXES most recently ranked ones are kept. An index takes memory in proportion to its users, not to
+# their counts.
+RANK_REFRESH_MINUTES = float(os.getenv('RANK_REFRESH_MINUTES', 60))
+RANK_CHANNEL_INDEXES = int(os.getenv('RANK_CHANNEL_INDEXES', 256))
+
+# Hours between refreshes of the stored guild names of counting channels, which also prunes dead channels, and the
+# number of channel guild names kept in the LRU cache of the server leaderboard
+GUILD_REFRESH_HOURS = float(os.getenv('GUILD_REFRESH_HOURS', 6))
+GUILD_NAME_CACHE_SIZE = int(os.getenv('GUILD_NAME_CACHE_SIZE', 10000))
+
+# Write-behind mode: buffer count updates and flush them in batches every WRITE_BEHIND_FLUSH_MS milliseconds
+# or once WRITE_BEHIND_MAX_OPS updates are pending. Up to one flush interval of counts can be lost on a crash.
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'false').lower() == 'true'
+WRITE_BEHIND_FLUSH_MS = int(os.getenv('WRITE_BEHIND_FLUSH_MS', 1000))
+WRITE_BEHIND_MAX_OPS = int(os.getenv('WRITE_BEHIND_MAX_OPS', 500))
+
+# Ledger of counted messages in count_events. LEDGER_MODE is off, audit (events are recorded next to the usual writes)
+# or source (the ledger is the write path and compaction rolls the events into channels, channeluser and users,
+# so the leaderboards lag by up to one compaction interval). Events are appended in batches like write-behind,
+# compacted into hourly (LEDGER_BUCKET_MINUTES) aggregates, and compacted events older than LEDGER_RETENTION_DAYS
+# are deleted (0 keeps them, which rebuilding from the ledger needs). Compaction leaves events younger than
+# LEDGER_SETTLE_SECONDS for the next run, so appends of other cluster processes still in flight are not skipped.
+LEDGER_MODE = os.getenv('LEDGER_MODE', 'audit')
+LEDGER_FLUSH_MS = int(os.getenv('LEDGER_FLUSH_MS', 1000))
+LEDGER_MAX_EVENTS = int(os.getenv('LEDGER_MAX_EVENTS', 500))
+LEDGER_COMPACT_MINUTES = float(os.getenv('LEDGER_COMPACT_MINUTES', 5))
+LEDGER_COMPACT_BATCH = int(os.getenv('LEDGER_COMPACT_BATCH', 5000))
+LEDGER_BUCKET_MINUTES = float(os.getenv('LEDGER_BUCKET_MINUTES', 60))
+LEDGER_RETENTION_DAYS = float(os.getenv('LEDGER_RETENTION_DAYS', 0))
+LEDGER_SETTLE_SECONDS = float(os.getenv('LEDGER_SETTLE_SECONDS', 30))
+
+# Number of evaluated counting expressions kept in the LRU cache
+EVAL_CACHE_SIZE = int(os.getenv('EVAL_CACHE_SIZE', 4096))
+
+# Budgets for evaluating counting expressions, violating expressions are rejected before they are computed
+EVAL_MAX_NODES = int(os.getenv('EVAL_MAX_NODES', 64))
+EVAL_MAX_EXPONENT = int(os.getenv('EVAL_MAX_EXPONENT', 64))
+EVAL_MAX_OPERAND = int(os.getenv('EVAL_MAX_OPERAND', 10 ** 15))
+EVAL_MAX_RESULT_BITS = int(os.getenv('EVAL_MAX_RESULT_BITS', 128))
+# Optional wall-clock cap, runs powers and function calls in EVAL_WORKERS worker processes (0 disables it)
+EVAL_TIMEOUT_SECONDS = float(os.getenv('EVAL_TIMEOUT_SECONDS', 0))
+EVAL_WORKERS = int(os.getenv('EVAL_WORKERS', 2))
+
+# Outbound Discord actions (reactions, failure replies and edit/delete notices) are sent from a background queue.
+# Lower priority numbers are sent first. Rates are per channel and second, like Discord's buckets, plus a global rate.
+# Reactions older than OUTBOX_REACTION_MAX_AGE seconds or beyond OUTBOX_MAX_REACTIONS pending are dropped.
+OUTBOX_PRIORITIES = {
+    kind: int(priority) for kind, priority in
+    (pair.split(':') for pair in os.getenv('OUTBOX_PRIORITIES', 'reply:0,notice:1,reaction:2').split(','))
+}
+OUTBOX_REACTION_RATE = float(os.getenv('OUTBOX_REACTION_RATE', 4))
+OUTBOX_REACTION_BURST = float(os.getenv('OUTBOX_REACTION_BURST', 1))
+OUTBOX_MESSAGE_RATE = float(os.getenv('OUTBOX_MESSAGE_RATE', 1))
+OUTBOX_MESSAGE_BURST = float(os.getenv('OUTBOX_MESSAGE_BURST', 5))
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', 45))
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', 8))
+OUTBOX_REACTION_MAX_AGE = float(os.getenv('OUTBOX_REACTION_MAX_AGE', 10))
+OUTBOX_MAX_REACTIONS = int(os.getenv('OUTBOX_MAX_REACTIONS', 500))
+
+# Gateway client profile. 'default' keeps disnake's default intents and caches, 'lean' only subscribes to the guild and
+# guild message events counting needs and caches no members and no messages. MESSAGE_CACHE_SIZE overrides the number
+# of cached messages (0 disables the cache, the edit and delete notices work from raw events), -1 keeps the profile's.
+CLIENT_PROFILE = os.getenv('CLIENT_PROFILE', 'default')
+MESSAGE_CACHE_SIZE = int(os.getenv('MESSAGE_CACHE_SIZE', -1))
+
+# Cluster mode: cluster.py runs the shards in CLUSTER_COUNT bot processes, SHARD_COUNT shards in total (0 asks Discord
+# for the recommended count). Crashed or unresponsive (no status for CLUSTER_HEARTBEAT_TIMEOUT seconds) processes are
+# restarted after CLUSTER_RESTART_DELAY seconds, doubling up to CLUSTER_RESTART_MAX_DELAY while they keep failing.
+CLUSTER_COUNT = int(os.getenv('CLUSTER_COUNT', 2))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0))
+CLUSTER_STATUS_SECONDS = float(os.getenv('CLUSTER_STATUS_SECONDS', 15))
+CLUSTER_HEARTBEAT_TIMEOUT = float(os.getenv('CLUSTER_HEARTBEAT_TIMEOUT', 120))
+CLUSTER_RESTART_DELAY = float(os.getenv('CLUSTER_RESTART_DELAY', 5))
+CLUSTER_RESTART_MAX_DELAY = float(os.getenv('CLUSTER_RESTART_MAX_DELAY', 300))
+# Set by cluster.py for its processes, a process started without them runs every shard itself
+CLUSTER_ID = int(os.getenv('CLUSTER_ID', 0))
+CLUSTER_SHARD_IDS = [int(shard_id) for shard_id in os.getenv('CLUSTER_SHARD_IDS', '').split(',') if shard_id]
+
+# Latency metrics, served in the Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics (port 0 disables
+# the endpoint, the /metrics command still works)
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
+if CLUSTER_SHARD_IDS and METRICS_PORT:
+    METRICS_PORT += CLUSTER_ID  # One port per cluster process
 
 # Define directories
 BASE_DIR = pathlib.Path(__file__).parent
 COGS_DIR = BASE_DIR / 'cogs'
 
-# Make sure ./logs directory exists
-if not os.path.exists('logs'):
-    os.makedirs('logs')
+# Log files rotate by size (LOG_MAX_BYTES) or time (LOG_ROTATE_WHEN, e.g. midnight), keeping LOG_BACKUP_COUNT old files
+LOG_ROTATION = os.getenv('LOG_ROTATION', 'size')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', 'midnight')
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 7))
+
+# Sampling (share of records kept, 0 to 1) and rate limits (records per second, 0 for none) of the INFO lines
+# written for every counted message and every database call, warnings and errors are always written.
+# benchmarks/log_replay.py needs every counted message, keep LOG_MESSAGE_* at their defaults to record traffic.
+LOG_MESSAGE_SAMPLE_RATE = float(os.getenv('LOG_MESSAGE_SAMPLE_RATE', 1))
+LOG_MESSAGE_RATE_LIMIT = float(os.getenv('LOG_MESSAGE_RATE_LIMIT', 0))
+LOG_QUERY_SAMPLE_RATE = float(os.getenv('LOG_QUERY_SAMPLE_RATE', 1))
+LOG_QUERY_RATE_LIMIT = float(os.getenv('LOG_QUERY_RATE_LIMIT', 0))
+
+
+# Handler configuration of a rotating log file
+def file_handler(filename):
+    handler = {
+        'level': 'INFO',
+        'formatter': 'verbose',
+        'filename': filename,
+        'backupCount': LOG_BACKUP_COUNT,
+        'encoding': 'utf-8',
+    }
+    if LOG_ROTATION == 'time':
+        handler.update({'class': 'logging.handlers.TimedRotatingFileHandler', 'when': LOG_ROTATE_WHEN})
+    else:
+        handler.update({'class': 'logging.handlers.RotatingFileHandler', 'maxBytes': LOG_MAX_BYTES})
+    return handler
+
+
+# Make sure the log directory exists, every cluster process writes its own files
+LOG_DIR = f'logs/cluster{CLUSTER_ID}' if CLUSTER_SHARD_IDS else 'logs'
+if not os.path.exists(LOG_DIR):
+    os.makedirs(LOG_DIR)
 
 # Logging configuration
 LOGGING_CONFIG = {
@@ -56,20 +195,14 @@ LOGGING_CONFIG = {
             'class': 'logging.StreamHandler',
             'formatter': 'default',
         },
-        'file_bot': {
-            'level': 'INFO',
-            'class': 'logging.FileHandler',
-            'formatter': 'verbose',
-            'filename': 'logs/bot.log',
-            'mode': 'w',
-        },
-        'file_user': {
-            'level': 'INFO',
-            'class': 'logging.FileHandler',
-            'formatter': 'verbose',
-            'filename': 'logs/user.log',
-            'mode': 'w',
-        },
+        'file_bot': file_handler(f'{LOG_DIR}/bot.log'),
+        'file_user': file_handler(f'{LOG_DIR}/user.log'),
+    },
+    'filters': {
+        'message_sampling': {'()': 'helper.logs.SamplingFilter', 'rate': LOG_MESSAGE_SAMPLE_RATE},
+        'message_rate_limit': {'()': 'helper.logs.RateLimitFilter', 'per_second': LOG_MESSAGE_RATE_LIMIT},
+        'query_sampling': {'()': 'helper.logs.SamplingFilter', 'rate': LOG_QUERY_SAMPLE_RATE},
+        'query_rate_limit': {'()': 'helper.logs.RateLimitFilter', 'per_second': LOG_QUERY_RATE_LIMIT},
     },
     'loggers': {
         'bot': {
@@ -88,7 +221,17 @@ LOGGING_CONFIG = {
             'handlers': ['console', 'file_user'],
             'level': 'INFO',
         },
+        # The per-message and per-query lines, they propagate to the handlers of bot and database
+        'bot.messages': {
+            'filters': ['message_sampling', 'message_rate_limit'],
+        },
+        'database.queries': {
+            'filters': ['query_sampling', 'query_rate_limit'],
+        },
     },
 }
 
 dictConfig(LOGGING_CONFIG)
+
+# The handlers write from a background thread, logging calls only put the record on a queue
+start_queue_logging(name for name, config in LOGGING_CONFIG['loggers'].items() if config.get('handlers'))
@@ -0,0 +1,14 @@
+# Description: Unit tests, run them from the repository root with python -m unittest (or python -m pytest).
+
+import os
+import tempfile
+
+# settings.py requires these, tests never talk to Discord so placeholders are enough
+os.environ.setdefault('DISCORD_TOKEN', 'test')
+os.environ.setdefault('COMMAND_PREFIX', 'test!')
+os.environ.setdefault('EMBED_COLOR', '0')
+os.environ.setdefault('FEEDBACK_CHANNEL_ID', '0')
+
+# helper.database creates its backend on import, the tests use a throwaway SQLite database
+os.environ['DATABASE_BACKEND'] = 'sqlite'
+os.environ['SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='sillycounting-tests-'), 'tests.db')
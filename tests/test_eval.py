@@ -0,0 +1,126 @@
+import unittest
+from unittest import mock
+
+import tests  # noqa: F401 (sets placeholder environment variables for settings.py)
+import helper.eval as eval
+import settings
+
+
+class PrecedenceTest(unittest.TestCase):
+    def test_multiplication_binds_tighter_than_addition(self):
+        self.assertEqual(eval.safe_eval('2+3*4'), 14)
+        self.assertEqual(eval.safe_eval('2*3+4'), 10)
+        self.assertEqual(eval.safe_eval('(2+3)*4'), 20)
+
+    def test_power_binds_tighter_than_unary_minus(self):
+        self.assertEqual(eval.safe_eval('-2**2'), -4)
+        self.assertEqual(eval.safe_eval('(-2)**2'), 4)
+        self.assertEqual(eval.safe_eval('2**-1'), 0.5)
+
+    def test_unary_minus_binds_tighter_than_multiplication(self):
+        self.assertEqual(eval.safe_eval('-2*3'), -6)
+        self.assertEqual(eval.safe_eval('3--2'), 5)
+
+    def test_functions_and_constants(self):
+        self.assertEqual(eval.safe_eval('SQRT(16)+1'), 5.0)
+        self.assertEqual(eval.safe_eval('log(e)'), 1.0)
+        self.assertEqual(eval.safe_eval('log(8, 2)'), 3.0)
+
+
+class AssociativityTest(unittest.TestCase):
+    def test_subtraction_and_division_are_left_associative(self):
+        self.assertEqual(eval.safe_eval('10-4-3'), 3)
+        self.assertEqual(eval.safe_eval('8/4/2'), 1.0)
+
+    def test_power_is_right_associative(self):
+        self.assertEqual(eval.safe_eval('2**3**2'), 512)
+
+
+class RejectedInputTest(unittest.TestCase):
+    def assertRejected(self, expr):
+        with self.assertRaises((ValueError, SyntaxError, TypeError)):
+            eval.safe_eval(expr)
+
+    def test_chat_text(self):
+        self.assertRejected('hello there')
+        self.assertRejected('12 apples')
+        self.assertRejected('')
+
+    def test_unsupported_names(self):
+        self.assertRejected('__import__("os")')
+        self.assertRejected('abs(1)')
+
+    def test_malformed_expressions(self):
+        self.assertRejected('01+1')
+        self.assertRejected('1+')
+        self.assertRejected('(1+2')
+        self.assertRejected('1+2)')
+        self.assertRejected('2 3')
+        self.assertRejected('sqrt 4')
+
+    def test_budgets(self):
+        with self.assertRaises(eval.EvalLimitError):
+            eval.safe_eval('+'.join(['1'] * (settings.EVAL_MAX_NODES + 1)))
+        with self.assertRaises(eval.EvalLimitError):
+            eval.safe_eval(f'2**{settings.EVAL_MAX_EXPONENT + 1}')
+        with self.assertRaises(eval.EvalLimitError):
+            eval.safe_eval(f'{settings.EVAL_MAX_OPERAND + 1}*2')
+
+    def test_complex_value(self):
+        with self.assertRaises(eval.EvalLimitError):
+            eval.safe_eval('(-1)**0.5')
+
+
+class FakeWorkerPool:
+    def __init__(self):
+        self.expressions = []
+
+    async def evaluate(self, expr, timeout):
+        self.expressions.append(expr)
+        return eval.safe_eval(expr)
+
+
+class SafeEvalAsyncTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.pool = FakeWorkerPool()
+        patches = [mock.patch.object(settings, 'EVAL_TIMEOUT_SECONDS', 1),
+                   mock.patch.object(eval, 'worker_pool', self.pool),
+                   mock.patch.object(eval, 'evaluation_cache', eval.EvaluationCache(16))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def test_chat_text_never_reaches_a_worker(self):
+        for text in ('lol (jk)', 'abs(1)', 'see you in 5 (or 10)'):
+            with self.assertRaises(ValueError):
+                await eval.safe_eval_async(text)
+        self.assertEqual(await eval.safe_eval_async('42'), 42)
+        self.assertEqual(await eval.safe_eval_async('2*(3+4)'), 14)
+        self.assertEqual(self.pool.expressions, [])
+
+    async def test_worker_results_are_cached(self):
+        for _ in range(3):
+            self.assertEqual(await eval.safe_eval_async('2**10'), 1024)
+        self.assertEqual(await eval.safe_eval_async('sqrt(16)'), 4.0)
+        self.assertEqual(self.pool.expressions, ['2**10', 'sqrt(16)'])
+
+    async def test_cached_expressions_are_not_sent_to_a_worker(self):
+        eval.safe_eval('3**3')
+        self.assertEqual(await eval.safe_eval_async('3**3'), 27)
+        self.assertEqual(self.pool.expressions, [])
+
+
+class EvaluationCacheTest(unittest.TestCase):
+    def test_least_recently_used_expression_is_evicted(self):
+        cache = eval.EvaluationCache(2)
+        cache.put('1+1', 2)
+        cache.put('2+2', 4)
+        self.assertEqual(cache.get('1+1'), 2)
+        cache.put('3+3', 6)
+        self.assertIsNone(cache.get('2+2'))
+        self.assertEqual((cache.get('1+1'), cache.get('3+3')), (2, 6))
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+from unittest import mock
+
+import tests  # noqa: F401 (sets placeholder environment variables for settings.py)
+import helper.leaderboard as leaderboard
+
+
+class LeaderboardServiceTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.service = leaderboard.LeaderboardService(ttl=60, page_size=2)
+        self.results = []
+        self.queries = 0
+
+        async def get_top_users(limit, after):
+            self.queries += 1
+            return self.results.pop(0)
+        patch = mock.patch.object(leaderboard.db, 'get_top_users', get_top_users)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    async def test_pages_are_cached(self):
+        self.results = [[(1, 30), (2, 20), (3, 10)]]
+        for _ in range(2):
+            self.assertEqual(await self.service.get_page("all users"), ([(1, 30), (2, 20)], True))
+        self.assertEqual(self.queries, 1)
+
+    async def test_failed_query_is_not_cached(self):
+        self.results = [None, [(1, 30)]]
+        with self.assertRaises(RuntimeError):
+            await self.service.get_page("all users")
+        self.assertEqual(self.service.entries, {})
+        self.assertEqual(await self.service.get_page("all users"), ([(1, 30)], False))
+        self.assertEqual(self.queries, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import tests  # noqa: F401 (sets placeholder environment variables for settings.py)
+import helper.database as database
+from helper.storage import migrations
+from helper.storage.sqlite import SQLiteBackend
+
+
+class RecordCountEventTest(unittest.TestCase):
+    def record(self, number):
+        with mock.patch.object(database.settings, 'LEDGER_MODE', 'audit'), \
+                mock.patch.object(database.event_buffer, 'notify'):
+            database.record_count_event(1, 2, 3, number, 'wrong')
+            return database.event_buffer.take()[-1][3]
+
+    def test_integer_is_stored(self):
+        self.assertEqual(self.record(42), 42)
+
+    def test_out_of_range_integer_is_dropped(self):
+        self.assertIsNone(self.record(2 ** 63))
+        self.assertIsNone(self.record(-2 ** 63 - 1))
+
+    def test_complex_is_dropped(self):
+        # (-1)**0.5 used to raise TypeError in the range check and escape on_message
+        self.assertIsNone(self.record((-1) ** 0.5))
+
+
+class SQLiteCompactionTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix='sillycounting-test-')
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'ledger.db')
+        self.backend = SQLiteBackend(self.path, pool_size=1)
+        migrations.migrate(self.backend)
+        self.backend.insert_count_events([(1, 2, message_id, message_id + 1, 'correct', 0) for message_id in range(3)])
+
+    def test_compaction_locks_before_reading_the_checkpoint(self):
+        other = SQLiteBackend(self.path, pool_size=1)
+        with self.backend.cursor(commit=True) as cur:
+            self.backend.begin_locked(cur)
+            self.backend.execute(cur, "SELECT event_id FROM ledger_checkpoints WHERE name = 'compaction'")
+
+            # Another process compacting the same file waits instead of reading the same checkpoint
+            connection = other.get_connection()
+            connection.execute("PRAGMA busy_timeout = 0")
+            other.release_connection(connection)
+            with self.assertRaisesRegex(sqlite3.OperationalError, "locked"):
+                other.compact_count_events(100, 3600000, apply=False)
+
+        self.assertEqual(other.compact_count_events(100, 3600000, apply=False), 3)
+        self.assertEqual(self.backend.compact_count_events(100, 3600000, apply=False), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import tests  # noqa: F401 (sets placeholder environment variables for settings.py)
+from helper.storage import migrations
+from helper.storage.sqlite import SQLiteBackend
+
+# The schema an unversioned bot created, before schema_version existed
+UNVERSIONED_SCHEMA = '''
+    CREATE TABLE users (user_id BIGINT PRIMARY KEY);
+    CREATE TABLE channels (channel_id BIGINT PRIMARY KEY, count INT DEFAULT 0, last_user_id BIGINT DEFAULT 0,
+                           highscore INT DEFAULT 0);
+    CREATE TABLE channeluser (channeluser_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id BIGINT NOT NULL,
+                              channel_id BIGINT NOT NULL, count INT NOT NULL DEFAULT 0);
+    INSERT INTO users (user_id) VALUES (1), (2);
+    INSERT INTO channels (channel_id, count, last_user_id, highscore) VALUES (10, 5, 2, 7);
+    INSERT INTO channeluser (user_id, channel_id, count) VALUES (1, 10, 2), (1, 10, 1), (2, 10, 2);
+'''
+
+
+class UnversionedDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix='sillycounting-test-')
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'unversioned.db')
+        with sqlite3.connect(self.path) as conn:
+            conn.executescript(UNVERSIONED_SCHEMA)
+        self.backend = SQLiteBackend(self.path, pool_size=1)
+
+    def dump(self):
+        """Every schema object and row, to compare the database before and after."""
+        with sqlite3.connect(self.path) as conn:
+            schema = conn.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall()
+            rows = {name: conn.execute(f"SELECT * FROM {name} ORDER BY 1").fetchall()
+                    for kind, name, _ in schema if kind == 'table' and name != 'sqlite_sequence'}
+        return schema, rows
+
+    def test_dry_run_lists_the_changes_without_making_them(self):
+        before = self.dump()
+        changes = migrations.migrate(self.backend, dry_run=True)
+
+        self.assertEqual(self.dump(), before)
+        self.assertTrue(all(change.startswith("1 (Baseline schema): ") for change in changes))
+        changes = [change.split(": ", 1)[1] for change in changes]
+        self.assertIn("ALTER TABLE users ADD COLUMN total_count INT NOT NULL DEFAULT 0", changes)
+        self.assertIn("ALTER TABLE channels ADD COLUMN highscore_at BIGINT DEFAULT 0", changes)
+        self.assertIn("Recompute users.total_count from channeluser", changes)
+        self.assertIn("Merge duplicate channeluser rows", changes)
+        self.assertTrue(any(change.startswith("CREATE TABLE count_events ") for change in changes))
+        self.assertFalse(any(change.startswith(("CREATE TABLE users ", "CREATE TABLE channeluser "))
+                             for change in changes))
+
+        # A dry run is what the migration then does
+        self.assertEqual([change.split(": ", 1)[1] for change in migrations.migrate(self.backend)], changes)
+
+    def test_migration_repairs_the_data_once(self):
+        migrations.migrate(self.backend)
+        with sqlite3.connect(self.path) as conn:
+            self.assertEqual(conn.execute("SELECT user_id, channel_id, count FROM channeluser ORDER BY user_id")
+                             .fetchall(), [(1, 10, 3), (2, 10, 2)])
+            self.assertEqual(conn.execute("SELECT user_id, total_count FROM users ORDER BY user_id").fetchall(),
+                             [(1, 3), (2, 2)])
+            self.assertEqual(conn.execute("SELECT version FROM schema_version").fetchall(), [(1,)])
+
+        self.assertEqual(migrations.migrate(self.backend, dry_run=True), [])
+        self.assertEqual(migrations.migrate(self.backend), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import asyncio
+import types
+import unittest
+from unittest import mock
+
+import tests  # noqa: F401 (sets placeholder environment variables for settings.py)
+import helper.outbox as outbox
+
+
+class ActionQueueTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # A clock that only moves when a test moves it, so the age of an action is exact
+        self.now = 100.0
+        clock = mock.patch.object(outbox, 'time', types.SimpleNamespace(monotonic=lambda: self.now))
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.sent = []
+
+    def queue(self, max_age=10, max_reactions=100, concurrency=10):
+        queue = outbox.ActionQueue(
+            priorities={'reply': 0, 'notice': 1, 'reaction': 2},
+            rates={'reaction': (100, 100), 'message': (100, 100)},
+            global_rate=100,
+            concurrency=concurrency,
+            max_age=max_age,
+            max_reactions=max_reactions,
+        )
+        self.addCleanup(lambda: queue.task and queue.task.cancel())
+        return queue
+
+    def submit(self, queue, kind, name, channel_id=1):
+        async def send():
+            self.sent.append(name)
+        queue.submit(kind, channel_id, send)
+
+    async def drain(self, queue):
+        for _ in range(100):
+            await asyncio.sleep(0)
+            if not queue.pending() and not queue.in_flight:
+                return
+        self.fail("The queue did not drain")
+
+    async def test_stale_reactions_are_dropped(self):
+        queue = self.queue(max_age=10)
+        self.submit(queue, 'reaction', 'stale reaction')
+        self.submit(queue, 'reply', 'stale reply')
+        self.now += 11
+        self.submit(queue, 'reaction', 'fresh reaction', channel_id=2)
+        await self.drain(queue)
+
+        self.assertEqual(sorted(self.sent), ['fresh reaction', 'stale reply'])
+        self.assertEqual((queue.sent, queue.dropped, queue.reactions), (2, 1, 0))
+
+    async def test_reactions_beyond_the_backlog_are_dropped(self):
+        queue = self.queue(max_reactions=2)
+        for index in range(5):
+            self.submit(queue, 'reaction', f'reaction {index}')
+        await self.drain(queue)
+
+        # The oldest are dropped until the backlog is below max_reactions
+        self.assertEqual(self.sent, ['reaction 3', 'reaction 4'])
+        self.assertEqual((queue.sent, queue.dropped, queue.reactions), (2, 3, 0))
+
+    async def test_most_important_action_is_sent_first(self):
+        queue = self.queue(concurrency=1)
+        self.submit(queue, 'reaction', 'reaction', channel_id=1)
+        self.submit(queue, 'notice', 'notice', channel_id=2)
+        self.submit(queue, 'reply', 'reply', channel_id=3)
+        await self.drain(queue)
+
+        self.assertEqual(self.sent, ['reply', 'notice', 'reaction'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+import random
+import unittest
+from unittest import mock
+
+import tests  # noqa: F401 (sets placeholder environment variables for settings.py)
+import helper.database as database
+import helper.ranks as ranks
+from helper.ranks import FenwickTree, RankIndex, RankIndexes
+
+
+# Rank by counting the users with a higher count, what the index replaces
+def naive_rank(counts, user_id):
+    count = counts.get(user_id)
+    if not count:
+        return None
+    return sum(other > count for other in counts.values()) + 1, count, len(counts)
+
+
+class FenwickTreeTest(unittest.TestCase):
+    def test_prefix_sums(self):
+        frequencies = [0, 3, 0, 2, 5, 1, 0, 4]
+        tree = FenwickTree(frequencies)
+        for index in range(len(frequencies) + 2):
+            self.assertEqual(tree.prefix_sum(index), sum(frequencies[:index + 1]))
+
+        tree.add(3, -2)
+        tree.add(6, 7)
+        self.assertEqual(tree.prefix_sum(5), 9)
+        self.assertEqual(tree.prefix_sum(7), 20)
+
+
+class RankIndexTest(unittest.TestCase):
+    def test_ranks_share_equal_counts(self):
+        index = RankIndex([(1, 10), (2, 30), (3, 10), (4, 5), (5, 0)])
+        self.assertEqual(index.rank(2), (1, 30, 4))
+        self.assertEqual(index.rank(1), (2, 10, 4))
+        self.assertEqual(index.rank(3), (2, 10, 4))
+        self.assertEqual(index.rank(4), (4, 5, 4))
+        self.assertIsNone(index.rank(5))
+        self.assertIsNone(index.rank(6))
+
+    def test_empty_index_grows(self):
+        index = RankIndex([])
+        index.increment(1)
+        index.increment(2, 3)
+        self.assertEqual(index.rank(2), (1, 3, 2))
+        self.assertEqual(index.rank(1), (2, 1, 2))
+
+    def test_tree_is_sized_by_distinct_counts(self):
+        index = RankIndex([(1, 10 ** 9), (2, 10 ** 9), (3, 5)])
+        self.assertEqual(index.tree.size, 3)  # The counts 1, 5 and 10 ** 9
+        index.increment(3, 10 ** 6)
+        self.assertEqual(index.tree.size, 3)  # Inside the bucket of 5
+        self.assertEqual(index.rank(3), (3, 10 ** 6 + 5, 3))
+        index.increment(3, 10 ** 9)
+        self.assertEqual(index.rank(3), (1, 10 ** 9 + 10 ** 6 + 5, 3))
+        self.assertEqual(index.rank(1), (2, 10 ** 9, 3))
+
+    def test_full_bucket_is_rebuilt(self):
+        # Users climbing from the same count spread over the counts of its bucket
+        index = RankIndex([(user_id, 1) for user_id in range(ranks.MAX_BUCKET_COUNTS + 1)])
+        for user_id in range(1, ranks.MAX_BUCKET_COUNTS):
+            index.increment(user_id, user_id)
+        self.assertEqual(index.tree.size, 1)
+        index.increment(ranks.MAX_BUCKET_COUNTS, ranks.MAX_BUCKET_COUNTS)
+        self.assertEqual(index.tree.size, ranks.MAX_BUCKET_COUNTS + 1)
+        self.assertEqual(index.rank(0), (ranks.MAX_BUCKET_COUNTS + 1, 1, ranks.MAX_BUCKET_COUNTS + 1))
+        self.assertEqual(index.rank(ranks.MAX_BUCKET_COUNTS), (1, ranks.MAX_BUCKET_COUNTS + 1,
+                                                               ranks.MAX_BUCKET_COUNTS + 1))
+
+    def test_decrement_to_zero_removes_the_user(self):
+        index = RankIndex([(1, 1), (2, 2)])
+        index.increment(1, -1)
+        self.assertIsNone(index.rank(1))
+        self.assertEqual(index.rank(2), (1, 2, 1))
+
+    def test_matches_naive_ranks(self):
+        for max_bucket_counts in (2, ranks.MAX_BUCKET_COUNTS):
+            with mock.patch.object(ranks, 'MAX_BUCKET_COUNTS', max_bucket_counts):
+                self.check_naive_ranks(random.Random(max_bucket_counts))
+
+    def check_naive_ranks(self, rng):
+        counts = {user_id: rng.randrange(1, 50) for user_id in range(100)}
+        index = RankIndex(counts.items())
+        for _ in range(2000):
+            user_id = rng.randrange(120)
+            delta = rng.choice([1, 1, 1, -1, 25])
+            counts[user_id] = counts.get(user_id, 0) + delta
+            if counts[user_id] <= 0:
+                del counts[user_id]
+            index.increment(user_id, delta)
+        for user_id in range(120):
+            self.assertEqual(index.rank(user_id), naive_rank(counts, user_id))
+
+
+class RankIndexesTest(unittest.TestCase):
+    def test_increments_reach_the_loaded_indexes(self):
+        indexes = RankIndexes(max_channels=2)
+        indexes.increment(10, 1)  # Nothing is loaded yet
+        self.assertTrue(indexes.finish_load(None, indexes.begin_load(None), RankIndex([(1, 1)])))
+        self.assertTrue(indexes.finish_load(10, indexes.begin_load(10), RankIndex([(1, 1)])))
+
+        indexes.increment(10, 1)
+        indexes.increment(20, 2)
+        self.assertEqual(indexes.rank(indexes.users, 1), (1, 2, 2))
+        self.assertEqual(indexes.rank(indexes.users, 2), (2, 1, 2))
+        self.assertEqual(indexes.rank(indexes.channel(10), 1), (1, 2, 1))
+        self.assertIsNone(indexes.channel(20))
+
+    def test_increments_during_a_load_are_applied(self):
+        indexes = RankIndexes(max_channels=2)
+        generation = indexes.begin_load(10)
+        indexes.increment(10, 1)  # After the snapshot below was read
+        indexes.increment(20, 1)  # Another channel
+        self.assertTrue(indexes.finish_load(10, generation, RankIndex([(1, 3)])))
+        self.assertEqual(indexes.rank(indexes.channel(10), 1), (1, 4, 1))
+
+    def test_only_the_newest_load_is_installed(self):
+        indexes = RankIndexes(max_channels=2)
+        old = indexes.begin_load(None)
+        new = indexes.begin_load(None)
+        self.assertFalse(indexes.finish_load(None, old, RankIndex([(1, 1)])))
+        self.assertIsNone(indexes.users)
+        self.assertTrue(indexes.finish_load(None, new, RankIndex([(1, 2)])))
+        self.assertEqual(indexes.rank(indexes.users, 1), (1, 2, 1))
+
+    def test_abandoned_and_cleared_loads_are_not_installed(self):
+        indexes = RankIndexes(max_channels=2)
+        generation = indexes.begin_load(10)
+        indexes.abandon_load(10, generation)
+        self.assertFalse(indexes.finish_load(10, generation, RankIndex([])))
+
+        generation = indexes.begin_load(None)
+        indexes.clear()
+        self.assertFalse(indexes.finish_load(None, generation, RankIndex([])))
+        self.assertIsNone(indexes.users)
+
+    def test_least_recently_used_channel_is_evicted(self):
+        indexes = RankIndexes(max_channels=2)
+        for channel_id in (10, 20):
+            indexes.finish_load(channel_id, indexes.begin_load(channel_id), RankIndex([]))
+        indexes.channel(10)
+        indexes.finish_load(30, indexes.begin_load(30), RankIndex([]))
+        self.assertIsNotNone(indexes.channel(10))
+        self.assertIsNone(indexes.channel(20))
+        self.assertIsNotNone(indexes.channel(30))
+
+
+class LoadRanksTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        database.setup_database()
+
+    def setUp(self):
+        patches = [mock.patch.object(database.settings, 'LEDGER_MODE', 'source'),
+                   mock.patch.object(database.event_buffer, 'notify')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(database.rank_index.clear)
+
+    def test_source_mode_loads_uncompacted_ledger_counts(self):
+        for message_id in range(3):
+            database.record_count_event(70, 700, message_id, message_id + 1, 'correct')
+        database.record_count_event(70, 701, 3, 5, 'wrong')
+        database.record_count_event(71, 701, 4, 1, 'correct')
+
+        # Buffered events are flushed by the load, compacted ones are read from the live tables instead
+        for compacted in (False, True):
+            if compacted:
+                database.compact_count_events(settle_seconds=0)
+            users = database.load_ranks(None)
+            self.assertEqual((users.counts.get(700), users.counts.get(701)), (3, 1))
+            channel = database.load_ranks(70)
+            self.assertEqual(channel.counts, {700: 3})
+            self.assertIs(database.rank_index.channel(70), channel)
+
+
+if __name__ == '__main__':
+    unittest.main()
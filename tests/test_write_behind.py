@@ -0,0 +1,44 @@
+import unittest
+from unittest import mock
+
+import tests  # noqa: F401 (sets placeholder environment variables for settings.py)
+import helper.database as database
+
+
+class RemoveChannelTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        database.setup_database()
+
+    def setUp(self):
+        patches = [mock.patch.object(database.settings, 'WRITE_BEHIND_ENABLED', True),
+                   mock.patch.object(database.settings, 'LEDGER_MODE', 'audit'),
+                   mock.patch.object(database.write_buffer, 'notify')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def channel_users(self, channel_id):
+        return [user_id for user_id, _ in database.backend.get_channel_user_counts(channel_id)]
+
+    def test_pending_writes_of_a_removed_channel_are_dropped(self):
+        database.add_channel(80)
+        database.update_count(80, 1, 800)
+        database.update_user_count(80, 800)
+        database.update_count(81, 1, 800)  # Another channel keeps its writes
+        database.update_user_count(81, 800)
+
+        database.remove_channel(80)
+        self.assertIsNone(database.write_buffer.pending_count(80))
+        database.flush_write_behind()
+        self.assertEqual(self.channel_users(80), [])
+        self.assertEqual(self.channel_users(81), [800])
+
+        # Enabling the channel again starts from the stored count, not the dropped one
+        database.add_channel(80)
+        self.assertEqual(database.get_channel_state(80)['count'], 0)
+        database.remove_channel(80)
+
+
+if __name__ == '__main__':
+    unittest.main()